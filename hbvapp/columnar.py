@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Binary columnar format of the simulation results.
+
+Instead of a JSON list of per-time-step dictionaries, a response holds one
+little-endian float64 buffer per series after a small JSON header:
+
+    b'HBVC' | uint32 header length | header (JSON, utf-8) | body
+
+The header describes the columns {'name', 'length', 'offset'} (offsets in bytes
+from the start of the body), whether the body is zlib-compressed and any other
+value of the response. It is padded so that the body starts at a multiple of 8
+bytes and maps directly onto a Float64Array in the browser. Time is sent as
+milliseconds since the epoch.
+'''
+from __future__ import unicode_literals
+import json
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .datasets import to_columns
+from .hbvcore.engine import FLUXES, STATES
+
+MAGIC = b'HBVC'
+
+
+def model_columns(model, names=None):
+	'''
+	Series {name: float64 array} of the data and intermediate values of the last
+	run of model, only those in names if given, all of the same length as the
+	data. The arrays of the columnar engine are used as they are, series
+	recorded every N time steps only (see HBV96._recording) with np.nan at the
+	other steps; otherwise they are built from model.data and model.int_tab.
+	'''
+	if 'q_sim' in model.columns and len(model.columns['q_sim']) == model.n_rows():
+		columns = OrderedDict(model.columns)
+		inters = dict(model.inters)
+		every = model.recorded[1]
+		if every != 1:
+			for series, n in ((columns, model.n_rows()), (inters, model.n_rows()-1)):
+				for name in set(series) & set(STATES + FLUXES) & set(names or series):
+					full = np.full(n, np.nan)
+					full[::every] = series[name]
+					series[name] = full
+	else:
+		columns = to_columns(model.data)
+		inters = to_columns(model.int_tab)
+
+	for name in FLUXES:
+		if name in inters and (names is None or name in names):
+			# Intermediate values start at the first time step, data at time 0
+			columns[name] = np.append(inters[name], np.nan)
+
+	rows = model.held_rows()[0]
+	if model.forcings is None and rows and 'time' in rows[0]:
+		times = [d['time'] for d in rows]
+	else:
+		times = (model.forcings or {}).get('time')
+	if times is not None and (names is None or 'time' in names):
+		times = pd.to_datetime(times)
+		columns['time'] = times.values.astype('datetime64[ms]').astype(np.float64)
+
+	return OrderedDict((name, np.asarray(a, dtype=np.float64)) for name, a in columns.items()
+					   if (names is None or name in names) and a.dtype.kind in 'fiu')
+
+
+def pack(columns, header=None, compress=False):
+	'''
+	Payload of columns {name: array} and of the JSON-serializable dict header
+	'''
+	header = dict(header or {})
+	header['columns'] = list()
+	header['compressed'] = bool(compress)
+
+	buffers, offset = list(), 0
+	for name, a in columns.items():
+		buffers.append(np.ascontiguousarray(a, dtype='<f8').tobytes())
+		header['columns'].append({'name': name, 'length': len(a), 'offset': offset})
+		offset += len(buffers[-1])
+
+	body = b''.join(buffers)
+	if compress:
+		body = zlib.compress(body, 1)
+
+	text = json.dumps(header, cls=DjangoJSONEncoder).encode('utf-8')
+	text += b' '*(-(len(text) + 8) % 8)
+
+	return MAGIC + struct.pack('<I', len(text)) + text + body
+
+
+def unpack(payload):
+	'''
+	Columns and header of a payload of pack
+	'''
+	if payload[:4] != MAGIC:
+		raise ValueError('Not a columnar payload')
+
+	n = struct.unpack('<I', payload[4:8])[0]
+	header = json.loads(payload[8:8+n].decode('utf-8'))
+	body = payload[8+n:]
+	if header.pop('compressed'):
+		body = zlib.decompress(body)
+
+	columns = OrderedDict((c['name'], np.frombuffer(body, dtype='<f8', count=c['length'], offset=c['offset']))
+						  for c in header.pop('columns'))
+
+	return columns, header
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+Store of the uploaded forcing datasets.
+
+A dataset is uploaded once, as the JSON list of rows the front end builds, and
+referenced afterwards by the SHA-1 of that text. Its parsed columns are saved
+on disk as a memory-mapped store of .npy files (see hbvcore.storage), so that
+the actions of a session, of other sessions or of a restarted server do not
+parse the same multi-megabyte JSON again, and the worker processes of the
+application share the pages of the dataset instead of holding copies.
+'''
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .hbvcore import storage
+
+
+def to_columns(rows):
+	'''
+	Columns {name: np.ndarray} of a list of rows. Numeric columns are float64
+	with np.nan for missing values, the others (e.g. time) unicode.
+	'''
+	columns = OrderedDict()
+	for name in (rows[0] if rows else ()):
+		values = [d.get(name) for d in rows]
+		try:
+			columns[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+		except (TypeError, ValueError):
+			columns[name] = np.array(['' if v is None else v for v in values], dtype=np.unicode_)
+
+	return columns
+
+
+class DatasetStore(object):
+	'''
+	Datasets by content hash, all of them in directory (by default in the
+	temporary directory) and the maps of max_datasets of them kept open.
+	'''
+	def __init__(self, directory=None, max_datasets=16):
+		self.directory = directory or os.path.join(tempfile.gettempdir(), 'hbv_datasets')
+		self.max_datasets = max_datasets
+		self._memory = OrderedDict()
+		self._lock = threading.Lock()
+
+	def put(self, text):
+		'''
+		Store the dataset of the JSON text of its rows and return its id
+		'''
+		data_id = hashlib.sha1(text.encode('utf-8')).hexdigest()
+		if data_id in self._memory or storage.exists(self._path(data_id)):
+			return data_id
+
+		return self.put_columns(data_id, to_columns(json.loads(text)))
+
+	def put_columns(self, data_id, columns):
+		'''
+		Store the dataset of columns, parsed elsewhere (see ingest), under
+		data_id and return it, KeyError if data_id is not a valid id
+		'''
+		self._path(data_id)
+		self._keep(data_id, columns)
+		self._save(data_id, columns)
+
+		return data_id
+
+	def columns(self, data_id):
+		'''
+		Columns of the dataset data_id, read-only memory maps once the dataset
+		is saved, KeyError if it is unknown
+		'''
+		with self._lock:
+			if data_id in self._memory:
+				self._memory[data_id] = self._memory.pop(data_id)
+				return self._memory[data_id]
+
+		columns = storage.open_columns(self._path(data_id))
+		self._keep(data_id, columns)
+
+		return columns
+
+	def _path(self, data_id):
+		# Ids are hexadecimal digests, never paths
+		if not data_id or not all(c in '0123456789abcdef' for c in data_id):
+			raise KeyError(data_id)
+		return os.path.join(self.directory, data_id)
+
+	def _keep(self, data_id, columns):
+		with self._lock:
+			self._memory.pop(data_id, None)
+			self._memory[data_id] = columns
+			while len(self._memory) > self.max_datasets:
+				self._memory.popitem(last=False)
+
+	def _save(self, data_id, columns):
+		'''
+		Write the dataset to disk and keep its memory maps instead of the
+		parsed columns. Readers never see a partial store, see storage.
+		'''
+		path = self._path(data_id)
+		if not storage.exists(path):
+			storage.save_columns(path, columns)
+		self._keep(data_id, storage.open_columns(path))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Cache of simulation results.
+
+Results are float64 arrays by name, stored under the hash of everything the
+simulation depends on (see HBV96._simulation_key). Least recently used results
+are dropped once the cache holds more than max_bytes. With a directory, the
+results stored with persist=True (whole simulations, not the evaluations of
+a calibration) are also written there as .npz files, so that other processes
+and restarted servers find them.
+'''
+from __future__ import division, print_function
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SimulationCache(object):
+    '''
+    LRU cache of simulation results, thread-safe.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+    Maximum memory held by the cached arrays
+    directory : str, optional
+    Directory of the on-disk tier, none if unspecified
+    '''
+    def __init__(self, max_bytes=256*2**20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, disk_hits=0, misses=0, saved_seconds=0.0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Arrays {name: np.ndarray} stored under key, None if unknown. Cached
+        arrays are shared, callers must copy the ones they modify.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+                self._stats['saved_seconds'] += entry[1]
+                return entry[0]
+
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with np.load(path) as npz:
+            seconds = float(npz['__seconds__'])
+            arrays = dict((name, npz[name]) for name in npz.files if name != '__seconds__')
+        self._keep(key, arrays, seconds)
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._stats['saved_seconds'] += seconds
+
+        return arrays
+
+    def put(self, key, arrays, seconds=0.0, persist=False):
+        '''
+        Store arrays {name: np.ndarray} under key. seconds is the time the
+        simulation took, counted as saved on every hit. With persist, the
+        arrays are also written to the on-disk tier, if any. The arrays are
+        made read-only, callers must not keep using them as buffers.
+        '''
+        self._keep(key, arrays, seconds)
+
+        path = self._path(key)
+        if persist and path is not None and not os.path.exists(path):
+            self._save(path, arrays, seconds)
+
+        return None
+
+    def stats(self):
+        '''
+        Hits in memory and on disk, misses, hit rate, time saved by the hits
+        [s], number of cached results and their memory [bytes]
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['nbytes'] = self.nbytes
+
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits'])/lookups if lookups else 0.0
+
+        return stats
+
+    def clear(self):
+        '''
+        Drop the results in memory and reset the statistics
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self._stats = dict(hits=0, disk_hits=0, misses=0, saved_seconds=0.0)
+
+    def _keep(self, key, arrays, seconds):
+        for a in arrays.values():
+            a.setflags(write=False)
+
+        nbytes = sum(a.nbytes for a in arrays.values())
+        if nbytes > self.max_bytes:
+            return None
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= sum(a.nbytes for a in old[0].values())
+            self._entries[key] = (arrays, seconds)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                arrays, _ = self._entries.popitem(last=False)[1]
+                self.nbytes -= sum(a.nbytes for a in arrays.values())
+
+        return None
+
+    def _path(self, key):
+        # Keys are hexadecimal digests, never paths
+        if self.directory is None or not all(c in '0123456789abcdef' for c in key):
+            return None
+        return os.path.join(self.directory, key + '.npz')
+
+    def _save(self, path, arrays, seconds):
+        '''
+        Write arrays to path, through a temporary file so that readers never
+        see a partial one
+        '''
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, __seconds__=np.float64(seconds), **arrays)
+        os.rename(tmp, path)
+
+        return None
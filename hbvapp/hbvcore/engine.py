@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Columnar engine of the HBV96 model.
+
+Instead of walking a list of per-timestep dictionaries, the columnar engine
+keeps forcings, states and intermediate fluxes in preallocated float64 arrays
+and runs the four HBV96 routines in a single loop with the parameters unpacked
+to local variables once per run. It reproduces the dictionary engine of
+HBV96._step_run step by step.
+
+When Numba is importable, run_steps and route_loop are also compiled to
+machine code (run_steps_jit, route_jit). The compiled kernels need float64 arrays for
+every argument; the pure-Python ones run faster on lists of floats.
+'''
+from __future__ import division, print_function
+import numpy as np
+
+# Numba is optional, the engine falls back to pure Python without it
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Column names handled by the engine
+FORCINGS = ('prec', 'temp', 'tm', 'ep', 'q_rec')
+
+STATES = ('sp', 'wc', 'sm', 'uz', 'lz')
+
+FLUXES = ('rf',
+          'sf',
+          'melt',
+          'refr',
+          'inf',
+          'qdr',
+          'act_inf',
+          'r',
+          'ep_int',
+          'ea',
+          'cf',
+          'q0',
+          'q1',
+          'gw')
+
+
+def allocate(miles):
+    '''
+    Preallocate the state block (5, miles+1), the flux block (14, miles) and
+    the simulated discharge (miles+1,) of a run of miles time steps.
+    '''
+    states = np.zeros((len(STATES), miles+1), dtype=np.float64)
+    fluxes = np.zeros((len(FLUXES), miles), dtype=np.float64)
+    q_sim = np.zeros(miles+1, dtype=np.float64)
+
+    return states, fluxes, q_sim
+
+
+def allocate_rows(miles, names=STATES+FLUXES):
+    '''
+    Same as allocate, with the states and fluxes as tuples of rows, of which
+    only the series in names (and gw and qdr, which the routing needs) are
+    stored. The other rows are write-only views of stride 0 on a single value:
+    they hold no memory and always read back the last value written, e.g.
+    the states at the last time step run.
+    '''
+    def row(name, n):
+        if name in names or name in ('gw', 'qdr'):
+            return np.zeros(n, dtype=np.float64)
+        return np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.float64), shape=(n,), strides=(0,))
+
+    states = tuple(row(name, miles+1) for name in STATES)
+    fluxes = tuple(row(name, miles) for name in FLUXES)
+    q_sim = np.zeros(miles+1, dtype=np.float64)
+
+    return states, fluxes, q_sim
+
+
+def run_steps(prec, temp, tm, ep, par, kill_snow, states, fluxes, q_sim, start, stop):
+    '''
+    ==========
+    Run steps
+    ==========
+
+    Precipitation, snow, soil and response routines of the HBV96 model for
+    the time steps start to stop-1. Step t reads the states at column t and
+    writes the states at column t+1, the intermediate values at column t and
+    the (not yet routed) discharge at q_sim[t+1].
+
+    Parameters
+    ----------
+    prec, temp, tm, ep : array_like [miles+1]
+    Forcings, either float64 arrays or lists of floats
+    par : array_like [20]
+    Parameter vector in the order of HydroModel._ind
+    kill_snow : bool
+    If True, precipitation and snow routines are skipped
+    states : np.ndarray [5, miles+1]
+    State block in the order of STATES, column start holds the initial
+    states; or a tuple of rows, see allocate_rows
+    fluxes : np.ndarray [14, miles]
+    Intermediate values in the order of FLUXES, or a tuple of rows
+    q_sim : np.ndarray [miles+1]
+    Simulated discharge, q_sim[0] holds the initial flow rate
+    start, stop : int
+    Range of time steps to run
+    '''
+    rfcf = par[0]
+    sfcf = par[1]
+    ltt = par[2]
+    utt = par[3]
+    ttm = par[4]
+    cfmax = par[5]
+    cwh = par[6]
+    cfr = par[7]
+    fc = par[8]
+    e_corr = par[9]
+    etf = par[10]
+    lp = par[11]
+    beta = par[12]
+    k = par[13]
+    k1 = par[14]
+    alpha = par[15]
+    c_flux = par[16]
+    perc = par[17]
+    tfac = par[18]
+    area = par[19]
+
+    _sp = states[0]
+    _wc = states[1]
+    _sm = states[2]
+    _uz = states[3]
+    _lz = states[4]
+
+    _rf = fluxes[0]
+    _sf = fluxes[1]
+    _melt = fluxes[2]
+    _refr = fluxes[3]
+    _inf = fluxes[4]
+    _qdr = fluxes[5]
+    _act_inf = fluxes[6]
+    _r = fluxes[7]
+    _ep_int = fluxes[8]
+    _ea = fluxes[9]
+    _cf = fluxes[10]
+    _q0 = fluxes[11]
+    _q1 = fluxes[12]
+    _gw = fluxes[13]
+
+    sp = float(_sp[start])
+    wc = float(_wc[start])
+    sm = float(_sm[start])
+    uz = float(_uz[start])
+    lz = float(_lz[start])
+
+    for t in xrange(start, stop):
+        t_t = temp[t]
+        p_t = prec[t]
+
+        # Precipitation and snow
+        if kill_snow:
+            rf = p_t
+            sf = 0.0
+            sp = 0.0
+            wc = 0.0
+            inf = rf
+
+        else:
+            if t_t <= ltt:
+                rf = 0.0
+                sf = p_t*sfcf
+
+            elif t_t >= utt:
+                rf = p_t*rfcf
+                sf = 0.0
+
+            else:
+                rf = (t_t-ltt)/(utt-ltt) * p_t * rfcf
+                sf = (1.0-(t_t-ltt)/(utt-ltt)) * p_t * sfcf
+
+            if t_t > ttm:
+                if cfmax*(t_t-ttm) < sp+sf:
+                    melt = cfmax*(t_t-ttm)
+                else:
+                    melt = sp+sf
+
+                sp = sp + sf - melt
+                wc = wc + melt + rf
+                _melt[t] = melt
+
+            else:
+                if cfr*cfmax*(ttm-t_t) < wc:
+                    refr = cfr*cfmax*(ttm - t_t)
+                else:
+                    refr = wc + rf
+
+                sp = sp + sf + refr
+                wc = wc - refr + rf
+                _refr[t] = refr
+
+            if wc > cwh*sp:
+                inf = wc-cwh*sp
+                wc = cwh*sp
+            else:
+                inf = 0.0
+
+        # Soil
+        qdr = max(sm + inf - fc, 0.0)
+        act_inf = max(inf - qdr, 0.0)
+        r = ((sm/fc)** beta) * act_inf
+        ep_int = (1.0 + etf*(t_t - tm[t]))*e_corr*ep[t]
+        ea = max(ep_int, (sm/(lp*fc))*ep_int)
+
+        cf = c_flux*((fc - sm)/fc)
+        sm = max(sm + act_inf - r + cf - ea, 0.0)
+        uz = uz + r - cf
+
+        # Response
+        lz = max(lz + min(tfac*perc, uz), 0.0)
+        uz = max(uz - tfac*perc, 0.0)
+
+        q0 = k*uz**(1.0 + alpha)
+        q1 = k1*lz
+
+        uz = max(uz - q0, 0.0)
+        lz = max(lz - q1, 0.0)
+
+        gw = q0 + q1
+
+        _sp[t+1] = sp
+        _wc[t+1] = wc
+        _sm[t+1] = sm
+        _uz[t+1] = uz
+        _lz[t+1] = lz
+
+        _rf[t] = rf
+        _sf[t] = sf
+        _inf[t] = inf
+        _qdr[t] = qdr
+        _act_inf[t] = act_inf
+        _r[t] = r
+        _ep_int[t] = ep_int
+        _ea[t] = ea
+        _cf[t] = cf
+        _q0[t] = q0
+        _q1[t] = q1
+        _gw[t] = gw
+
+        q_sim[t+1] = area*(gw + qdr)/(3.6*tfac)
+
+    return None
+
+
+# Routing weights memoized per MAXBAS value
+_MAXBAS_WEIGHTS = dict()
+
+
+def maxbas_weights(MAXBAS):
+    '''
+    Triangular weighting function of the routing routine for a given MAXBAS.
+    The weights are computed once per MAXBAS and returned as a read-only array.
+    '''
+    if MAXBAS in _MAXBAS_WEIGHTS:
+        return _MAXBAS_WEIGHTS[MAXBAS]
+
+    h = [0.0]
+    c = list()
+
+    for i in xrange(1, MAXBAS+1):
+        if (i < MAXBAS/2.0):
+            h.append( 4.0*i/MAXBAS**2.0 )
+            c.append( (h[i]+h[i-1])/2.0 )
+
+        elif (i >= 1+MAXBAS/2.0):
+            h.append( h[MAXBAS-i] )
+            c.append( (h[i]+h[i-1])/2.0 )
+
+        elif (i == MAXBAS/2.0):
+            h.append( 1.0/i )
+            c.append( (h[i]+h[i-1])/2.0 )
+
+        else:
+            h.append( h[MAXBAS-i] )
+            c.append( h[i]/2.0+1.0/MAXBAS )
+
+    c = np.array(c, dtype=np.float64)
+    c.setflags(write=False)
+    _MAXBAS_WEIGHTS[MAXBAS] = c
+
+    return c
+
+
+def route(gw, qdr, q_sim, c, area, tfac, start=0, stop=None):
+    '''
+    ========
+    Routing
+    ========
+
+    Apply the MAXBAS weights c to the groundwater flow gw in place and update
+    q_sim, for the time steps max(start, MAXBAS) to stop-1 (by default, the
+    end of gw). Works on series [miles] or on ensembles [miles, N] along the
+    first axis.
+
+    As in the original routing loop, the sum for step t runs over the values
+    of gw already routed at the previous steps,
+
+        gw[t] = c[0]*gw[t] + c[1]*gw[t-1] + ... + c[MAXBAS-1]*gw[t-MAXBAS+1]
+
+    so the weights are applied as a recursive filter (scipy.signal.lfilter)
+    whose initial conditions are the MAXBAS-1 previous values, unrouted for
+    t = MAXBAS.
+    '''
+    # scipy.signal is slow to import and only needed by the pure-Python engines
+    from scipy.signal import lfilter
+
+    MAXBAS = len(c)
+    start = max(start, MAXBAS)
+    stop = gw.shape[0] if stop is None else stop
+
+    if stop <= start:
+        return None
+
+    # Past outputs gw[start-1], ..., gw[start-MAXBAS+1] as initial conditions
+    # of the transposed direct form II, see scipy.signal.lfiltic
+    past = gw[start-1:start-MAXBAS:-1]
+    zi = np.zeros((MAXBAS-1,) + gw.shape[1:], dtype=np.float64)
+    for m in xrange(MAXBAS-1):
+        zi[m] = np.tensordot(c[m+1:], past[:MAXBAS-m-1], axes=1)
+
+    a = np.concatenate(([1.0], -c[1:]))
+    gw[start:stop] = lfilter(c[:1], a, gw[start:stop], axis=0, zi=zi)[0]
+    q_sim[start:stop] = area*(gw[start:stop] + qdr[start:stop])/(3.6*tfac)
+
+    return None
+
+
+def first_divergence(q_sim, start, stop, tol):
+    '''
+    First time step between start and stop-1 at which q_sim exceeds tol, -1
+    if there is none. For ensembles [miles+1, N], one index per member.
+    NaN values never exceed tol.
+    '''
+    with np.errstate(invalid='ignore'):
+        over = q_sim[start:stop] > tol
+    if not over.shape[0]:
+        over = np.zeros((1,) + over.shape[1:], dtype=bool)
+    t = np.where(over.any(axis=0), start + over.argmax(axis=0), -1)
+
+    return t if t.ndim else int(t)
+
+
+def route_loop(gw, qdr, q_sim, c, area, tfac, tol, start, stop):
+    '''
+    Step-by-step version of route for the time steps max(start, MAXBAS) to
+    stop-1, compiled by Numba as route_jit.
+
+    Returns
+    -------
+    t : int
+    First time step at which q_sim exceeds tol, -1 if the run converged
+    '''
+    MAXBAS = len(c)
+
+    for t in xrange(max(start, MAXBAS), stop):
+        _gw_routing = 0.0
+        for k in xrange(MAXBAS):
+            _gw_routing += gw[t-k] * c[k]
+
+        gw[t] = _gw_routing
+        q_sim[t] = area*(_gw_routing + qdr[t])/(3.6*tfac)
+
+        if q_sim[t] > tol:
+            return t
+
+    return -1
+
+
+def run_steps_batch(prec, temp, tm, ep, par, kill_snow, st, gw, qdr, q_sim, start):
+    '''
+    ===============
+    Run steps batch
+    ===============
+
+    Vectorised counterpart of run_steps for N parameter sets sharing the same
+    forcing, for the len(gw) time steps from start. The time loop runs over
+    vectors of members, states are carried as arrays [N] and only what the
+    routing needs is stored.
+
+    Parameters
+    ----------
+    prec, temp, tm, ep : array_like [miles+1]
+    Forcings
+    par : np.ndarray [20, N]
+    One parameter vector per column, rows in the order of HydroModel._ind
+    kill_snow : bool
+    If True, precipitation and snow routines are skipped
+    st : np.ndarray [5, N]
+    States at start in the order of STATES, updated in place to the states
+    at the end of the run
+    gw, qdr : np.ndarray [n, N]
+    Groundwater flow and direct runoff of the time steps start to start+n-1
+    q_sim : np.ndarray [n+1, N]
+    Simulated discharge from time step start, q_sim[0] holds the discharge at
+    start
+    start : int
+    First time step
+    '''
+    (rfcf, sfcf, ltt, utt, ttm, cfmax, cwh, cfr, fc, e_corr, etf, lp, beta,
+     k, k1, alpha, c_flux, perc, tfac, area) = par
+
+    N = par.shape[1]
+    sp, wc, sm, uz, lz = st
+
+    for i in xrange(gw.shape[0]):
+        t = start + i
+        t_t = temp[t]
+        p_t = prec[t]
+
+        # Precipitation and snow
+        if kill_snow:
+            rf = np.full(N, p_t)
+            sp = np.zeros(N)
+            wc = np.zeros(N)
+            inf = rf
+
+        else:
+            frac = (t_t-ltt)/(utt-ltt)
+            cold = t_t <= ltt
+            warm = t_t >= utt
+            rf = np.where(cold, 0.0, np.where(warm, p_t*rfcf, frac * p_t * rfcf))
+            sf = np.where(cold, p_t*sfcf, np.where(warm, 0.0, (1.0-frac) * p_t * sfcf))
+
+            melt = np.minimum(cfmax*(t_t-ttm), sp+sf)
+            refr = cfr*cfmax*(ttm - t_t)
+            refr = np.where(refr < wc, refr, wc + rf)
+
+            thaw = t_t > ttm
+            sp, wc = (np.where(thaw, sp + sf - melt, sp + sf + refr),
+                      np.where(thaw, wc + melt + rf, wc - refr + rf))
+
+            excess = wc > cwh*sp
+            inf = np.where(excess, wc-cwh*sp, 0.0)
+            wc = np.where(excess, cwh*sp, wc)
+
+        # Soil
+        _qdr = np.maximum(sm + inf - fc, 0.0)
+        act_inf = np.maximum(inf - _qdr, 0.0)
+        r = ((sm/fc)** beta) * act_inf
+        ep_int = (1.0 + etf*(t_t - tm[t]))*e_corr*ep[t]
+        ea = np.maximum(ep_int, (sm/(lp*fc))*ep_int)
+
+        cf = c_flux*((fc - sm)/fc)
+        sm = np.maximum(sm + act_inf - r + cf - ea, 0.0)
+        uz = uz + r - cf
+
+        # Response
+        lz = np.maximum(lz + np.minimum(tfac*perc, uz), 0.0)
+        uz = np.maximum(uz - tfac*perc, 0.0)
+
+        q0 = k*uz**(1.0 + alpha)
+        q1 = k1*lz
+
+        uz = np.maximum(uz - q0, 0.0)
+        lz = np.maximum(lz - q1, 0.0)
+
+        gw[i] = q0 + q1
+        qdr[i] = _qdr
+
+        q_sim[i+1] = area*(gw[i] + _qdr)/(3.6*tfac)
+
+    st[0], st[1], st[2], st[3], st[4] = sp, wc, sm, uz, lz
+
+    return None
+
+
+# Compiled kernels, None if Numba is not available
+HAS_NUMBA = numba is not None
+
+if HAS_NUMBA:
+    # Without the GIL, so that runs in concurrent threads execute in parallel
+    run_steps_jit = numba.njit(cache=True, nogil=True)(run_steps)
+    route_jit = numba.njit(cache=True, nogil=True)(route_loop)
+else:
+    run_steps_jit = None
+    route_jit = None
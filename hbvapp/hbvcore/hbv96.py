@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function
+import hashlib
+import time
 import numpy as np
-import scipy.optimize as opt
-import pandas as pd
-from StringIO import StringIO
-from pandas import DataFrame
+from collections import OrderedDict
+from itertools import izip
+from .engine import FORCINGS, STATES, FLUXES, HAS_NUMBA, allocate, allocate_rows, maxbas_weights
+from .engine import run_steps, run_steps_jit, run_steps_batch, route, route_jit, first_divergence
+from . import metrics, storage
+from .optimizers import OPTIMIZERS
+from .sampling import SAMPLERS, check_random_state
 
 class HydroModel(object):
     """docstring for HBV96"""
@@ -96,6 +101,12 @@ class HydroModel(object):
     # HBV96 model initializer
     def __init__(self):
 
+        # Instance copies of the initial states and boundaries, so that
+        # changing them never affects other models
+        self.DEF_ST = dict(self.DEF_ST)
+        self.P_LB = list(self.P_LB)
+        self.P_UB = list(self.P_UB)
+
         # A dictionary for model parameters
         self.par = dict()
         
@@ -105,11 +116,63 @@ class HydroModel(object):
         # A np.array-like df for both input and out put data
         self.data = list()
 
+        # Forcing columns used when self.data is empty, e.g. memory-mapped
+        # from a store, see storage and open_store
+        self.forcings = None
+
+        # Id of self.data in the dataset store of the application, if any
+        self.data_id = None
+
         # A np.array-like df for intermediate values
         self.int_tab = list()
 
+        # Objective values of the current calibration, one per model evaluation
+        self._trace = list()
+
+        # Objective values of the current calibration by parameter set, see _cal_fun
+        self._evaluated = dict()
+
+        # Progress of the current calibration, see _report
+        self.progress = dict()
+
+        # Set to stop the current calibration with CalibrationCancelled
+        self.cancel_requested = False
+
+        # Result of the last sensitivity analysis, see sensitivity
+        self.sensitivity_result = None
+
+        # Result of the last GLUE run, see glue
+        self.glue_result = None
+
+        # Float64 columns of forcings, states and q_sim for the columnar engine
+        self.columns = dict()
+
+        # Float64 columns of intermediate values for the columnar engine
+        self.inters = dict()
+
+        # Snapshots of the model states by time step, see checkpoint
+        self.checkpoints = dict()
+
+        # Snapshot at the last time step of self.data, see advance
+        self._live = None
+
+        # Series and step recorded by the last run, see _recording
+        self._recorded = (STATES + FLUXES, 1)
+
+        # States and routing buffer of the last run at its last time step and
+        # at the time steps of self.config['checkpoints'], see checkpoint
+        self._snapshots = dict()
+
+        # Shared cache of simulation results, see cache.SimulationCache
+        self.cache = None
+
+        # Digest of the forcing columns, see _simulation_key
+        self._forcing_digest = None
+
     def summary(self):
-        df = pd.DataFrame(self.data)
+        import pandas as pd
+
+        df = pd.DataFrame(self._data if self.forcings is None else dict(self.forcings))
         head = df.head(6).to_string()
         describe = df.describe().to_string()
 
@@ -181,6 +244,58 @@ class HBV96(HydroModel):
     '''
     """"""
 
+    @property
+    def data(self):
+        '''
+        Rows of data, one dict per time step. The results of a run of the
+        columnar engine stay in self.columns until the rows are read, they are
+        written in them then (see _export_columns); the rows of the forcings
+        of a store (see open_store) are only built then as well.
+        '''
+        if not self._data and self.forcings is not None:
+            names = list(self.forcings)
+            self._data = [dict(izip(names, values)) for values in
+                          izip(*[np.asarray(self.forcings[n]).tolist() for n in names])]
+        if not self._exported:
+            self._export_columns()
+        return self._data
+
+    @data.setter
+    def data(self, rows):
+        # New rows are the forcings of the next run, see _load_columns
+        self._data = rows
+        self.forcings = None
+        self._loaded = False
+        self._exported = True
+
+    @property
+    def int_tab(self):
+        '''
+        Rows of intermediate values, one dict per time step, see data
+        '''
+        if not self._exported:
+            self._export_columns()
+        return self._int_tab
+
+    @int_tab.setter
+    def int_tab(self, rows):
+        self._int_tab = rows
+
+    @property
+    def recorded(self):
+        '''
+        Series recorded by the last run of the columnar engine and the number
+        of time steps between two of their values, see _recording
+        '''
+        return self._recorded
+
+    def held_rows(self):
+        '''
+        Rows of self.data and self.int_tab as they are held, without writing
+        the results of the last run in them or building the rows of a store
+        '''
+        return self._data, self._int_tab
+
     def _precipitation(self, intab, outab, int_tab):
         '''
         ==============
@@ -449,48 +564,106 @@ class HBV96(HydroModel):
         if (MAXBAS == 1):
             return None
 
-        h = [0.0]
-        c = list()
+        miles = len(self.int_tab)
+        gw = np.array([d.get('gw') for d in self.int_tab], dtype=np.float64)
+        qdr = np.array([d.get('qdr') for d in self.int_tab], dtype=np.float64)
+        q_sim = np.empty(miles+1, dtype=np.float64)
 
-        for i in xrange(1, MAXBAS+1):
-            if (i < MAXBAS/2.0):
-                h.append( 4.0*i/MAXBAS**2.0 )
-                c.append( (h[i]+h[i-1])/2.0 )
+        route(gw, qdr, q_sim, maxbas_weights(MAXBAS), self.par['area'], self.par.get('tfac'))
 
-            elif (i >= 1+MAXBAS/2.0):
-                h.append( h[MAXBAS-i] )
-                c.append( (h[i]+h[i-1])/2.0 )
+        for t, _gw, _q in izip(xrange(MAXBAS, miles), gw[MAXBAS:].tolist(), q_sim[MAXBAS:miles].tolist()):
+            self.int_tab[t]['gw'] = _gw
+            self.data[t]['q_sim'] = _q
 
-            elif (i == MAXBAS/2.0):
-                h.append( 1.0/i )
-                c.append( (h[i]+h[i-1])/2.0 )
+        self._check_divergence(q_sim, MAXBAS)
 
-            else:
-                h.append( h[MAXBAS-i] )
-                c.append( h[i]/2.0+1.0/MAXBAS )
+        return None
 
-        for t in xrange(MAXBAS, self.config['miles']):
-            _gw_routing = 0.0
-            for k in xrange(MAXBAS):
-                _gw_routing += self.int_tab[t-k].get('gw') * c[k]
+    def _check_divergence(self, q_sim, MAXBAS):
+        '''
+        Raise DivergentError at the first routed time step where q_sim > 1e4
+        '''
+        t = first_divergence(q_sim, MAXBAS, q_sim.shape[0]-1, 1e4)
 
-            self.int_tab[t]['gw'] = _gw_routing
+        if t >= 0:
+            message = {'t': t, 'tol': 1e4, 'value': q_sim[t]}
+            print('At loop {0}, q_sim = {1} > {2}. Result in divergence !!! '.format(t, message.get('value'), message.get('tol')))
+            raise DivergentError(message)
 
-            self.data[t]['q_sim'] = self.par['area']*(_gw_routing + self.int_tab[t].get('qdr'))/(3.6*self.par.get('tfac'))
+        return None
 
-            if self.data[t]['q_sim'] > 1e4:
-                try:
-                    message = {'t': t, 'tol': 1e4, 'value': 1}
-                    raise DivergentError(message)
-                except DivergentError as e:
-                    print('At loop {0}, q_sim = {1} > {2}. Result in divergence !!! '.format(e.message.get('t'), e.message.get('value'), e.message.get('tol')))
-                    raise
-            else:
-                pass
+    def n_rows(self):
+        '''
+        Number of rows of data, in self.forcings if set or else in self.data
+        '''
+        if self.forcings is None:
+            return len(self._data)
+
+        return len(next(iter(self.forcings.values())))
+
+    def open_store(self, store):
+        '''
+        ==========
+        Open store
+        ==========
+
+        Use the forcing columns of a store (see storage) as data,
+        memory-mapped read-only instead of loaded as rows in self.data: the
+        engine reads them in place and processes opening the same store share
+        them. Their results stay in self.columns and self.inters; the rows of
+        self.data are only built when read, e.g. by the dictionary engine.
+        Set self.config['output_dir'] to write the results in a store as well.
+
+        Parameters
+        ----------
+        store : str or dict
+        Directory of the store, or its columns {name: np.ndarray} already
+        opened, see storage.open_columns
+        '''
+        self.data = list()
+        if isinstance(store, dict):
+            self.forcings = store
+        else:
+            self.forcings = storage.open_columns(store)
+        self.int_tab = list()
+        self.data_id = None
 
         return None
 
-    def _step_run(self):
+    def _recording(self):
+        '''
+        Series recorded by the runs of the columnar engine and the number of
+        time steps between two recorded values, from self.config['record']:
+
+        'all' (default) : states and intermediate values
+        'states' : states only
+        'none' : nothing but q_sim
+        list : the states and intermediate values it names
+
+        and self.config['record_every'] (default 1): only time steps 0, N, 2N...
+        are kept. q_sim is always recorded at every time step, and evaluations
+        of a calibration record nothing else whatever the policy.
+        '''
+        record = self.config.get('record', 'all')
+        if record == 'all':
+            names = STATES + FLUXES
+        elif record == 'states':
+            names = STATES
+        elif record == 'none':
+            names = ()
+        else:
+            unknown = [name for name in record if name not in STATES + FLUXES]
+            if unknown:
+                raise ValueError('Unknown series to record: {0}'.format(', '.join(unknown)))
+            names = tuple(name for name in STATES + FLUXES if name in record)
+
+        every = int(self.config.get('record_every', 1))
+        if every < 1:
+            raise ValueError('record_every must be a positive number of time steps')
+
+        return names, every
+
+    def _step_run(self, stop=None, directory=None, record=None):
         '''
         ==================
         Run model function
@@ -498,9 +671,31 @@ class HBV96(HydroModel):
 
         Function to execute the demanded routines. So basically, step-run is able
         to execute the whole set as well as a part of the 5 HBV routines.
+
+        self.config['engine'] selects between the columnar engine, compiled
+        ('numba') or not ('array'), and the original list-of-dicts engine
+        ('dict'), see _engine. If stop is given, only the time steps before
+        stop are run. The columnar engine can also start from a checkpoint
+        instead of time step 0, see checkpoint and _initial_conditions, and
+        write its outputs in the store directory, see storage.allocate. It
+        records the series of record (names, every), by default the ones of
+        _recording; the dictionary engine records everything.
         '''
+        if stop is None:
+            stop = self.config['miles']
+
+        if self._engine() != 'dict':
+            self._step_run_columns(stop, directory, record)
+            return None
+
+        if not self.data:
+            raise ValueError('The dictionary engine needs the rows of self.data')
+
+        # Raises if a warm start is requested
+        self._initial_conditions()
+
         intermedia = list()
-        for t in xrange(self.config['miles']):
+        for t in xrange(stop):
             # Consider sub-hashtable i as input and (i+1) as output table
             intab = self.data[t]
             outab = self.data[t+1]
@@ -519,6 +714,682 @@ class HBV96(HydroModel):
 
         self._routing()
 
+    def _simulation_key(self, stop):
+        '''
+        Hash of everything a run of the columnar engine up to stop depends on:
+        the forcings (not q_rec), the parameters with tfac, area and mbas,
+        the initial conditions (self.DEF_ST and self.DEF_q0, or the checkpoint
+        of a warm start), kill_snow and what the run records
+        '''
+        if self._forcing_digest is None:
+            sha1 = hashlib.sha1()
+            for name in FORCINGS:
+                if name != 'q_rec':
+                    sha1.update(np.ascontiguousarray(self.columns[name]).view(np.uint8))
+            self._forcing_digest = sha1.hexdigest()
+
+        start, st, q0, tail = self._initial_conditions()
+        key = (self._forcing_digest, stop, self._recording(),
+               tuple(sorted(set(int(t) for t in self.config.get('checkpoints', [])))),
+               tuple(float(self.par[name]) for name in self._ind), float(self.par['mbas']),
+               start, tuple(float(v) for v in st), float(q0), tuple(float(v) for v in tail),
+               bool(self.config['kill_snow']))
+
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _run_cached(self, stop=None):
+        '''
+        _step_run(stop) through self.cache, if any: the recorded states, q_sim
+        and intermediate values of a run already cached are restored instead
+        of simulated again. The dictionary engine is never cached, nor are runs
+        with self.config['cache'] set to False.
+        '''
+        if stop is None:
+            stop = self.config['miles']
+
+        if self.config.get('output_dir'):
+            # Outputs written out of core are not copied in the cache
+            self._step_run(stop, self.config['output_dir'])
+            return None
+
+        if self.cache is None or self._engine() == 'dict' or not self.config.get('cache', True):
+            self._step_run(stop)
+            return None
+
+        key = self._simulation_key(stop)
+        arrays = self.cache.get(key)
+        if arrays is not None:
+            for name in STATES + ('q_sim',):
+                self.columns.pop(name, None)
+                if name in arrays:
+                    self.columns[name] = arrays[name].copy()
+            self.inters = dict((name, arrays['inter_' + name].copy()) for name in FLUXES
+                               if 'inter_' + name in arrays)
+            gw = np.split(arrays['snap_gw'], np.cumsum(arrays['snap_gw_len']).astype(int)[:-1])
+            self._snapshots = dict((t, {'states': dict(zip(STATES, st)), 'gw': g.tolist()})
+                                   for t, st, g in izip(arrays['snap_t'].astype(int).tolist(),
+                                                        arrays['snap_states'].tolist(), gw))
+            self._recorded = self._recording()
+            return None
+
+        t0 = time.time()
+        self._step_run(stop)
+
+        arrays = dict((name, self.columns[name].copy()) for name in STATES + ('q_sim',)
+                      if name in self.columns)
+        arrays.update(('inter_' + name, a.copy()) for name, a in self.inters.items())
+        steps = sorted(self._snapshots)
+        arrays['snap_t'] = np.array(steps, dtype=np.float64)
+        arrays['snap_states'] = np.array([[self._snapshots[t]['states'][name] for name in STATES]
+                                         for t in steps])
+        arrays['snap_gw'] = np.array(sum((self._snapshots[t]['gw'] for t in steps), []), dtype=np.float64)
+        arrays['snap_gw_len'] = np.array([len(self._snapshots[t]['gw']) for t in steps], dtype=np.float64)
+        self.cache.put(key, arrays, time.time() - t0, persist=True)
+
+        return None
+
+    def _engine(self):
+        '''
+        Name of the engine to run: 'dict', 'array' or 'numba'. With 'auto'
+        (default), the compiled engine is used when Numba is importable and
+        the pure-Python columnar engine otherwise.
+        '''
+        engine = self.config.get('engine', 'auto')
+        if engine == 'auto' or engine == 'numba':
+            engine = 'numba' if HAS_NUMBA else 'array'
+
+        return engine
+
+    def _load_columns(self):
+        '''
+        Float64 forcing columns of the columnar engine, taken from
+        self.forcings if set, memory-mapped float64 forcings as they are
+        without a copy, or else built from the rows of self.data. They are
+        built once for the data of the model: rows changed in place are only
+        seen once self.data is set again. The outputs of the previous run are
+        dropped.
+        '''
+        if self._loaded:
+            self.columns = dict((name, self.columns[name]) for name in FORCINGS)
+            self._exported = True
+            return None
+
+        self.columns = dict()
+        if self.forcings is not None:
+            n = self.n_rows()
+            for name in FORCINGS:
+                if name in self.forcings:
+                    self.columns[name] = np.asarray(self.forcings[name], dtype=np.float64)
+                else:
+                    self.columns[name] = np.full(n, np.nan)
+        else:
+            for name in FORCINGS:
+                self.columns[name] = np.array([d.get(name, np.nan) for d in self._data],
+                                              dtype=np.float64)
+
+        self._forcing_digest = None
+        self._loaded = True
+        self._exported = True
+
+        return None
+
+    def _step_run_columns(self, stop, directory=None, record=None):
+        '''
+        ===================
+        Run columnar engine
+        ===================
+
+        Same as the dictionary engine of _step_run, but states and intermediate
+        values are written in preallocated float64 arrays: self.columns holds
+        forcings, states and q_sim [stop+1] and self.inters holds the
+        intermediate values [stop]. With a directory, the outputs are
+        memory-mapped in that store instead of held in memory.
+
+        Only the series of record (names, every), by default the ones of
+        _recording, are allocated and kept, at time steps 0, every, 2*every...
+        Runs writing in a store record everything. Whatever is recorded, the
+        states and routing buffer are kept at the last time step and, unless
+        record is given, at the time steps of self.config['checkpoints']: the
+        run is split there and the states read between two segments.
+        '''
+        names, every = self._recording() if record is None else record
+        if directory is None:
+            states, fluxes, q_sim = allocate_rows(stop, names)
+        else:
+            states, fluxes, q_sim = storage.allocate(directory, stop)
+            states, fluxes = tuple(states), tuple(fluxes)
+            names, every = STATES + FLUXES, 1
+        start, st, q0, tail = self._initial_conditions()
+        if start:
+            # Time steps before the checkpoint are not simulated
+            for row in states + fluxes:
+                row[:start] = np.nan
+            q_sim[:start] = np.nan
+            fluxes[FLUXES.index('gw')][start-len(tail):start] = tail
+        for row, value in zip(states, st):
+            row[start] = value
+        q_sim[start] = q0
+
+        par = [float(self.par[key]) for key in self._ind]
+        forcings = [self.columns[name] for name in FORCINGS[:4]]
+        if self._engine() == 'numba':
+            kernel, par = run_steps_jit, np.array(par)
+        else:
+            # Python floats are much faster to index than np.float64 items
+            kernel, forcings = run_steps, [f[:stop].tolist() for f in forcings]
+
+        marks = list()
+        if record is None:
+            marks = sorted(set(int(t) for t in self.config.get('checkpoints', []) if start <= int(t) < stop))
+
+        # Unrecorded states read back their value at the end of each segment
+        snapshots = dict()
+        for begin, end in zip([start] + marks, marks + [stop]):
+            kernel(*forcings, par=par, kill_snow=bool(self.config['kill_snow']),
+                   states=states, fluxes=fluxes, q_sim=q_sim, start=begin, stop=end)
+            snapshots[end] = dict((key, float(row[end])) for key, row in zip(STATES, states))
+
+        self.columns['q_sim'] = q_sim
+        self.inters = dict(zip(FLUXES, fluxes))
+        self._route_columns(start)
+
+        # Routing only looks back, the routed buffers are final
+        MAXBAS = int(self.par['mbas'])
+        gw = self.inters['gw']
+        self._snapshots = dict((t, {'states': st, 'gw': gw[max(t-MAXBAS+1, 0):t].tolist()})
+                               for t, st in snapshots.items())
+
+        def keep(row):
+            return row if every == 1 else row[::every].copy()
+
+        for key, row in zip(STATES, states):
+            self.columns.pop(key, None)
+            if key in names:
+                self.columns[key] = keep(row)
+        self.inters = dict((key, keep(row)) for key, row in zip(FLUXES, fluxes) if key in names)
+        self._recorded = (names, every)
+
+    def _route_columns(self, start=0):
+        '''
+        Routing routine of the columnar engine from time step start, see
+        _routing
+        '''
+        MAXBAS = int(self.par['mbas'])
+
+        if (MAXBAS == 1):
+            return None
+
+        c = maxbas_weights(MAXBAS)
+        if self._engine() == 'numba':
+            route_jit(self.inters['gw'], self.inters['qdr'], self.columns['q_sim'],
+                      c, float(self.par['area']), float(self.par['tfac']), 1e4,
+                      start, len(self.inters['gw']))
+        else:
+            route(self.inters['gw'], self.inters['qdr'], self.columns['q_sim'],
+                  c, self.par['area'], self.par['tfac'], start=start)
+
+        self._check_divergence(self.columns['q_sim'], MAXBAS)
+
+        return None
+
+    def _initial_conditions(self):
+        '''
+        First time step of a run, with the states [5] and the discharge at this
+        time step and the groundwater flow of the previous time steps that the
+        routing needs: self.DEF_ST and self.DEF_q0 at time step 0, or the
+        checkpoint self.checkpoints[self.config['warm_start']] if set.
+        '''
+        if self.config.get('warm_start') is None:
+            return 0, [self.DEF_ST[key] for key in STATES], self.DEF_q0, []
+
+        if self._engine() == 'dict':
+            raise ValueError('Warm start is only available with the columnar engine')
+
+        t = int(self.config['warm_start'])
+        if t not in self.checkpoints:
+            raise ValueError('No checkpoint at time step {0}'.format(t))
+        if t > self.config['miles']:
+            raise ValueError('Checkpoint at time step {0} is beyond the data'.format(t))
+
+        checkpoint = self.checkpoints[t]
+        n = min(t, int(self.par['mbas'])-1)
+        if len(checkpoint['gw']) < n:
+            raise ValueError('Checkpoint at time step {0} holds too few routing values for mbas = {1}'.format(t, self.par['mbas']))
+
+        return (t, [checkpoint['states'][key] for key in STATES], checkpoint['q_sim'],
+                checkpoint['gw'][len(checkpoint['gw'])-n:])
+
+    def checkpoint(self, t):
+        '''
+        ==========
+        Checkpoint
+        ==========
+
+        Snapshot of the last simulation at time step t, from which later runs
+        can start instead of time step 0 (see self.config['warm_start']). The
+        states of a checkpoint are taken as initial states whatever the
+        parameters of the run, as self.DEF_ST are.
+
+        Parameters
+        ----------
+        t : int
+        Time step, between the first simulated time step and self.config['miles']
+
+        Returns
+        -------
+        checkpoint : dict
+        Time step 't', states 'states' (sp, wc, sm, uz, lz) and discharge
+        'q_sim' at time step t, groundwater flow of the mbas-1 previous time
+        steps 'gw' (the routing buffer) and the parameters of the run 'par'
+        '''
+        if self._engine() == 'dict':
+            raise ValueError('Checkpoints are only available with the columnar engine')
+
+        q_sim = self.columns.get('q_sim')
+        if q_sim is None or not 0 <= t < len(q_sim) or np.isnan(q_sim[t]):
+            raise ValueError('Time step {0} was not simulated'.format(t))
+
+        MAXBAS = int(self.par['mbas'])
+
+        if t in self._snapshots:
+            states, gw = self._snapshots[t]['states'], self._snapshots[t]['gw']
+        else:
+            names, every = self._recorded
+            if every != 1 or not all(key in names for key in STATES + ('gw',)):
+                raise ValueError('Time step {0} was not recorded, see _recording'.format(t))
+            states = dict((key, float(self.columns[key][t])) for key in STATES)
+            gw = self.inters['gw'][max(t-MAXBAS+1, 0):t].tolist()
+
+        return {'t': t,
+                'states': states,
+                'q_sim': float(q_sim[t]),
+                'gw': gw,
+                'par': dict(self.par)}
+
+    def _record_checkpoints(self):
+        '''
+        Store a checkpoint of the last simulation in self.checkpoints at every
+        time step of self.config['checkpoints'], with the columnar engine.
+        Time steps before the first simulated one keep their checkpoint.
+        '''
+        if self._engine() == 'dict':
+            return None
+
+        start = self._initial_conditions()[0]
+        for t in self.config.get('checkpoints', []):
+            if int(t) >= start:
+                self.checkpoints[int(t)] = self.checkpoint(int(t))
+
+        return None
+
+    def advance(self, rows):
+        '''
+        =======
+        Advance
+        =======
+
+        Append new time steps to the last simulation without running its
+        history again: the run resumes from the states and routing buffer at
+        the end of self.data, so the cost only depends on the number of new
+        rows. The results are the ones of a whole simulation of the extended
+        data with the same parameters.
+
+        As in _step_run, the step from row t to row t+1 is driven by the
+        forcing of row t, so the forcing of the last row is only used by the
+        next call.
+
+        Parameters
+        ----------
+        rows : list of dict
+        New rows of data, with 'prec', 'temp', 'tm', 'ep' and optionally
+        'time' and 'q_rec'
+
+        Returns
+        -------
+        rows : list of dict
+        The new rows completed with the simulated states and q_sim
+        int_tab : list of dict
+        Intermediate values of the new time steps
+        '''
+        if self._live is None:
+            raise ValueError('Advance needs a previous simulation with the columnar engine')
+        if not self.data:
+            raise ValueError('Advance needs the rows of self.data')
+
+        k = len(rows)
+        if not k:
+            return list(), list()
+
+        T0 = self._live['t']
+        MAXBAS = int(self.par['mbas'])
+        tail = self._live['gw'][len(self._live['gw'])-min(T0, MAXBAS-1):]
+
+        # Local window: index o is time step T0, with the routing buffer before it
+        o = MAXBAS
+        states, fluxes, q_sim = allocate(o+k)
+        gw, qdr = fluxes[FLUXES.index('gw')], fluxes[FLUXES.index('qdr')]
+        states[:, o] = [self._live['states'][key] for key in STATES]
+        q_sim[o] = self._live['q_sim']
+        gw[o-len(tail):o] = tail
+
+        forcings = np.zeros((4, o+k+1), dtype=np.float64)
+        forcings[:, o:o+k] = [[d.get(name, np.nan) for d in [self.data[T0]] + list(rows[:-1])]
+                              for name in FORCINGS[:4]]
+
+        par = [float(self.par[key]) for key in self._ind]
+        kill_snow = bool(self.config['kill_snow'])
+        c = maxbas_weights(MAXBAS)
+        start = o + max(MAXBAS-T0, 0)
+
+        if self._engine() == 'numba':
+            run_steps_jit(*forcings, par=np.array(par), kill_snow=kill_snow, states=states,
+                          fluxes=fluxes, q_sim=q_sim, start=o, stop=o+k)
+            if (MAXBAS != 1):
+                route_jit(gw, qdr, q_sim, c, par[19], par[18], 1e4, start, o+k)
+        else:
+            run_steps(*forcings.tolist(), par=par, kill_snow=kill_snow, states=states,
+                      fluxes=fluxes, q_sim=q_sim, start=o, stop=o+k)
+            if (MAXBAS != 1):
+                route(gw, qdr, q_sim, c, par[19], par[18], start=start)
+
+        if (MAXBAS != 1):
+            t = first_divergence(q_sim, start, o+k, 1e4)
+            if t >= 0:
+                raise DivergentError({'t': T0+t-o, 'tol': 1e4, 'value': q_sim[t]})
+
+        # Commit the new rows only once the run succeeded
+        rows = [dict(d) for d in rows]
+        names = STATES + ('q_sim',)
+        for d, values in izip(rows, izip(*[a[o+1:].tolist() for a in list(states) + [q_sim]])):
+            d.update(izip(names, values))
+
+        if kill_snow:
+            names = tuple(n for n in FLUXES if n not in ('melt', 'refr'))
+        else:
+            names = FLUXES
+        int_tab = [dict(izip(names, values)) for values in
+                   izip(*[fluxes[FLUXES.index(n), o:].tolist() for n in names])]
+
+        # Routing also updates the discharge of the former last row
+        self.data[T0]['q_sim'] = float(q_sim[o])
+        self.data.extend(rows)
+        self.data_id = None
+        # The rows are now the forcings of the next run
+        self.forcings = None
+        self._loaded = False
+        self.int_tab.extend(int_tab)
+        self.config['miles'] = T0 + k
+
+        self._live = {'t': T0 + k,
+                      'states': dict(izip(STATES, states[:, o+k].tolist())),
+                      'q_sim': float(q_sim[o+k]),
+                      'gw': (list(tail) + gw[o:].tolist())[-(MAXBAS-1):] if MAXBAS > 1 else [],
+                      'par': dict(self.par)}
+
+        return rows, int_tab
+
+    def _export_columns(self):
+        '''
+        Write the results of the last run of the columnar engine into the rows
+        of self.data and self.int_tab, in the list-of-dicts layout of the
+        dictionary engine, as far as they are recorded (see _recording). Only
+        done when either is read after a run, see data.
+
+        Both keep one row per time step: with self.config['record_every'] N,
+        the recorded values are in the rows of time steps 0, N, 2N... and the
+        other rows hold none of them. int_tab is empty when no intermediate
+        value is recorded.
+        '''
+        self._exported = True
+        rows = self.data
+        if not rows or 'q_sim' not in self.columns:
+            return None
+
+        recorded, every = self._recorded
+        names = tuple(n for n in STATES if n in recorded)
+        if len(names) < len(STATES) or every != 1:
+            # Rows keep no states of a former run
+            for d in rows:
+                for n in STATES:
+                    d.pop(n, None)
+
+        for d, q in izip(rows, self.columns['q_sim'].tolist()):
+            d['q_sim'] = q
+        for d, values in izip(rows[::every], izip(*[self.columns[n].tolist() for n in names])):
+            d.update(izip(names, values))
+
+        # One row of intermediate values per recorded time step
+        names = tuple(n for n in FLUXES if n in recorded)
+        if self.config['kill_snow']:
+            names = tuple(n for n in names if n not in ('melt', 'refr'))
+        int_tab = [dict(izip(names, values)) for values in
+                   izip(*[self.inters[n].tolist() for n in names])]
+        if names and every != 1:
+            recorded_rows, int_tab = int_tab, [dict() for _ in xrange(len(rows)-1)]
+            for d, values in izip(int_tab[::every], recorded_rows):
+                d.update(values)
+
+        # As in _snow, a time step either melts or refreezes, never both
+        if 'melt' in names or 'refr' in names:
+            temp = self.columns['temp'][:len(int_tab)]
+            for d, melting in izip(int_tab, (temp > self.par['ttm']).tolist()):
+                d.pop('refr' if melting else 'melt', None)
+
+        self._int_tab = int_tab
+
+        return None
+
+    def simulate_batch(self, par_matrix, chunk_size=None):
+        '''
+        ==============
+        Simulate batch
+        ==============
+
+        Run N parameter sets against the forcing in self.data in one vectorised
+        pass. tfac, area and mbas are taken from self.par, initial states from
+        self.DEF_ST or from the checkpoint self.config['warm_start'], as for a
+        single simulation.
+
+        Parameters
+        ----------
+        par_matrix : array_like [N, 18]
+        One parameter set per row, columns in the order of self._ind[:18]
+        chunk_size : int, optional
+        Number of members advanced together, to bound the working memory
+        (3 float64 arrays of [miles, chunk_size]). If unspecified, all N.
+
+        Returns
+        -------
+        q_sim : np.ndarray [N, miles+1]
+        Routed simulated discharge of each member. Members that diverge
+        (q_sim > 1e4, see _routing) are filled with np.nan.
+        '''
+        self._init_simu()
+
+        return self._simulate_batch(par_matrix, chunk_size)[0]
+
+    def _simulate_batch(self, par_matrix, chunk_size=None, stop=None, threshold=None):
+        '''
+        simulate_batch on the columns already loaded by _init_simu, over the
+        first stop time steps (by default, all of them).
+
+        With threshold [N], the members are run segment by segment and those
+        whose RMSE on the calibration window already exceeds their threshold
+        are abandoned, see _segments and _partial_rmse.
+
+        Returns
+        -------
+        q_sim : np.ndarray [N, stop+1]
+        Routed simulated discharge, np.nan for diverging members
+        bound : np.ndarray [N]
+        Lower bound of the RMSE of the abandoned members, np.nan for the
+        members run to the end
+        '''
+        par_matrix = np.atleast_2d(np.asarray(par_matrix, dtype=np.float64))
+        N = par_matrix.shape[0]
+        stop = stop or self.config['miles']
+        tfac, area = float(self.par['tfac']), float(self.par['area'])
+
+        # Time-major, so that every step writes one contiguous row
+        start, _, q0, _ = self._initial_conditions()
+        q_sim = np.empty((stop+1, N), dtype=np.float64)
+        q_sim[:start] = np.nan
+        q_sim[start] = q0
+        bound = np.full(N, np.nan)
+
+        chunk_size = chunk_size or N
+        segments = self._segments(stop, threshold is not None)
+
+        for i in xrange(0, N, chunk_size):
+            j = min(i+chunk_size, N)
+            par = np.empty((20, j-i), dtype=np.float64)
+            par[:18] = par_matrix[i:j].T
+            par[18] = tfac
+            par[19] = area
+
+            if self._engine() == 'numba':
+                run_chunk = self._run_chunk_compiled
+            else:
+                run_chunk = self._run_chunk_vectorised
+
+            bound[i:j] = run_chunk(par, q_sim[:, i:j], segments,
+                                   None if threshold is None else threshold[i:j])
+
+        return q_sim.T, bound
+
+    def _segments(self, stop, abort):
+        '''
+        Time segments [(start, stop), ...] of a batch run from its first time
+        step (see _initial_conditions). Without abort, a single segment.
+        Otherwise the calibration window is cut into
+        self.config.get('abort_segments', 10) segments, after each of which the
+        members can be abandoned.
+        '''
+        start = self._initial_conditions()[0]
+        if not abort:
+            return [(start, stop)]
+
+        begin = min(self._window['begin'], stop)
+        cuts = np.linspace(begin, stop, self.config.get('abort_segments', 10)+1).astype(int)
+        cuts = np.unique(np.concatenate(([start], cuts)))
+
+        return zip(cuts[:-1], cuts[1:])
+
+    def _partial_rmse(self, q_sim, stop):
+        '''
+        Lower bound of the RMSE on the calibration window of the members
+        q_sim [stop+1, N] whose discharge is only final up to stop-1: the
+        squared errors of the remaining steps can only add up.
+        '''
+        w = self._window
+        end = min(stop, w['end'])
+        err = np.square(w['q_rec_all'][:max(end-w['begin'], 0), None] - q_sim[w['begin']:end])
+
+        return np.sqrt(np.nansum(err, axis=0)/w['n'])
+
+    def _run_chunk_vectorised(self, par, q_sim, segments, threshold):
+        '''
+        Run the members par [20, n] of a batch together with run_steps_batch,
+        writing their discharge into q_sim [stop+1, n]. Returns their bound,
+        see _simulate_batch.
+        '''
+        n = par.shape[1]
+        stop = q_sim.shape[0]-1
+        kill_snow = bool(self.config['kill_snow'])
+        tfac, area = par[18, 0], par[19, 0]
+        forcings = [self.columns[name] for name in FORCINGS[:4]]
+        MAXBAS = int(self.par['mbas'])
+        c = maxbas_weights(MAXBAS)
+
+        start, st, _, tail = self._initial_conditions()
+        st = np.repeat(np.array(st, dtype=np.float64)[:, None], n, axis=1)
+        gw = np.empty((stop, n), dtype=np.float64)
+        qdr = np.empty((stop, n), dtype=np.float64)
+        gw[start-len(tail):start] = np.reshape(tail, (-1, 1))
+        bound = np.full(n, np.nan)
+        alive = np.arange(n)
+
+        for start, end in segments:
+            if not alive.size:
+                break
+
+            # Basic slicing keeps views as long as no member was dropped
+            copy = alive.size < n
+            sel = alive if copy else slice(None)
+
+            _st, _gw, _qdr, _q = st[:, sel], gw[start:end, sel], qdr[start:end, sel], q_sim[start:end+1, sel]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                run_steps_batch(*forcings, par=par[:, sel], kill_snow=kill_snow, st=_st,
+                                gw=_gw, qdr=_qdr, q_sim=_q, start=start)
+            if copy:
+                st[:, sel], gw[start:end, sel], qdr[start:end, sel], q_sim[start:end+1, sel] = _st, _gw, _qdr, _q
+
+            if (MAXBAS != 1):
+                # Routing needs the MAXBAS previous steps
+                h = max(start-MAXBAS, 0)
+                _gw, _qdr, _q = gw[h:end, sel], qdr[h:end, sel], q_sim[h:end+1, sel]
+                route(_gw, _qdr, _q, c, area, tfac, start=start-h)
+                if copy:
+                    gw[h:end, sel], q_sim[h:end+1, sel] = _gw, _q
+
+                diverged = first_divergence(_q, max(start, MAXBAS)-h, end-h, 1e4) >= 0
+                q_sim[:, alive[diverged]] = np.nan
+                alive = alive[~diverged]
+
+            if threshold is not None and end < stop:
+                _bound = self._partial_rmse(q_sim[:, alive], end)
+                worse = _bound > threshold[alive]
+                bound[alive[worse]] = _bound[worse]
+                q_sim[end+1:, alive[worse]] = np.nan
+                alive = alive[~worse]
+
+        return bound
+
+    def _run_chunk_compiled(self, par, q_sim, segments, threshold):
+        '''
+        Same as _run_chunk_vectorised, but the members run one after the other
+        through the compiled kernels
+        '''
+        n = par.shape[1]
+        stop = q_sim.shape[0]-1
+        kill_snow = bool(self.config['kill_snow'])
+        tfac, area = par[18, 0], par[19, 0]
+        forcings = [self.columns[name] for name in FORCINGS[:4]]
+        MAXBAS = int(self.par['mbas'])
+        c = maxbas_weights(MAXBAS)
+
+        states, fluxes, q = allocate_rows(stop, ())
+        gw, qdr = fluxes[FLUXES.index('gw')], fluxes[FLUXES.index('qdr')]
+        bound = np.full(n, np.nan)
+        start, st, q0, tail = self._initial_conditions()
+
+        for m in xrange(n):
+            for row, value in zip(states, st):
+                row[start] = value
+            q[:start] = np.nan
+            q[start] = q0
+            gw[start-len(tail):start] = tail
+            _par = par[:, m].copy()
+
+            for start, end in segments:
+                run_steps_jit(*forcings, par=_par, kill_snow=kill_snow, states=states,
+                              fluxes=fluxes, q_sim=q, start=start, stop=end)
+
+                if (MAXBAS != 1) and route_jit(gw, qdr, q, c, area, tfac, 1e4, start, end) >= 0:
+                    q[:] = np.nan
+                    break
+
+                if threshold is not None and end < stop:
+                    _bound = self._partial_rmse(q[:, None], end)[0]
+                    if _bound > threshold[m]:
+                        bound[m] = _bound
+                        q[end+1:] = np.nan
+                        break
+
+            q_sim[:, m] = q
+
+        return bound
+
     def _nse(self, q_rec, q_sim):
         '''
         ===
@@ -540,13 +1411,7 @@ class HBV96(HydroModel):
         f : float
         NSE value
         '''
-        m = np.nanmean(q_rec)
-        a = np.square(np.subtract(q_rec, q_sim))
-        b = np.square(np.subtract(q_rec, m))
-        if a.any < 0.0:
-            return(np.nan)
-        f = 1.0 - (np.nansum(a)/np.nansum(b))
-        return f
+        return metrics.scores(q_rec, q_sim)['NSE']
 
 
     def _rmse(self, q_rec, q_sim):
@@ -570,11 +1435,7 @@ class HBV96(HydroModel):
         f : float
         RMSE value
         '''
-        erro = np.square(np.subtract(q_rec,q_sim))
-        if erro.any < 0:
-            return(np.nan)
-        f = np.sqrt(np.nanmean(erro))
-        return f
+        return metrics.scores(q_rec, q_sim)['RMSE']
 
     def _kge(self, q_rec, q_sim):
         '''
@@ -583,6 +1444,7 @@ class HBV96(HydroModel):
         ====
 
         Kling-Gupta Efficiency. Non-dimensional perfomance estimator for hydrological models.
+        As for the NSE and the RMSE, time steps where either discharge is NaN are skipped.
 
         Parameters
         ----------
@@ -602,12 +1464,34 @@ class HBV96(HydroModel):
         f : float
         KGE value
         '''
-        r = np.corrcoef(q_rec, q_sim)[0][1]
-        alpha = np.std(q_sim, axis=0)/np.std(q_rec, axis=0)
-        beta = np.nanmean(q_sim)/np.nanmean(q_rec)
-        f = 1 - np.sqrt((r-1.0)**2.0 + (alpha-1.0)**2.0 + (beta-1.0)**2.0)
-        return f
+        return metrics.scores(q_rec, q_sim)['KGE']
+
+    def scorecard(self):
+        '''
+        =========
+        Scorecard
+        =========
 
+        All the metrics of metrics.SCORES for the last run, from the end of the
+        warm-up (or from the warm start) to the last time step, computed in one
+        pass, see metrics.scores.
+
+        Returns
+        -------
+        scores : OrderedDict
+        {name: float}, NaN where the metric is undefined (e.g. no record)
+        '''
+        if 'q_sim' in self.columns and len(self.columns['q_sim']) == self.n_rows():
+            q_rec, q_sim = self.columns['q_rec'], self.columns['q_sim']
+        else:
+            q_rec = np.array([d.get('q_rec', np.nan) for d in self.data], dtype=np.float64)
+            q_sim = np.array([d.get('q_sim', np.nan) for d in self.data], dtype=np.float64)
+
+        begin = int(self.config.get('warm_up') or 0)
+        if self.config.get('warm_start') is not None:
+            begin = int(self.config['warm_start'])
+
+        return metrics.scores(q_rec[begin:], q_sim[begin:])
 
     def calibrate(self):
         '''
@@ -674,53 +1558,601 @@ class HBV96(HydroModel):
         performance : float
         Optimal value of the objective function
         '''
-        self._init_simu()
-        self.generate_par_to_calibrate()
-        
-        def _cal_fun_minimize(par_to_optimize):
-            self.par.update(dict(zip(self.config['par_to_calibrate'], par_to_optimize))) # Update the parameter dictionary
-            _q_sim, _q_rec = self._simulate_for_calibration()
+        self.progress = {'nfev': 0, 'iterations': 0, 'best': None}
+        self._evaluated = dict()
+
+        # A cancellation requested before the start stops the calibration at its
+        # first evaluation, and only this one
+        try:
+            self._init_simu()
+            self._prepare_window()
+            self.generate_par_to_calibrate()
+
+            # Model optimisation
+            if self.config.get('optimizer', 'L-BFGS-B') in OPTIMIZERS:
+                self._calibrate_global()
+            elif self.config.get('n_starts', 1) > 1:
+                self._calibrate_multistart()
+            else:
+                self.cal_result = self._minimize_from(self.x_0)
+                self._performance = self.cal_result['fun']
+        finally:
+            self.cancel_requested = False
 
-            # Index for period-selected calibration
-            _begin = self.config['warm_up']+self.config['calibrate_from'].get('index')
-            _end = self.config['calibrate_to'].get('index')+1
-            
-            perf = self.obj_fun(_q_rec[_begin:_end], _q_sim[_begin:_end])
+        # Calibration runs may stop at the end of the window, run the whole series
+        self._run_cached()
 
-            if self.config['verbose']:
-                print('{0}: {1}'.format(self.config['fun_name'], perf))
-            
-            return perf
-        
-        def _cal_fun_maximize(par_to_optimize):
-            self.par.update(dict(zip(self.config['par_to_calibrate'], par_to_optimize))) # Update the parameter dictionary
+        if self._engine() != 'dict':
+            self._exported = False
+            self._record_checkpoints()
+            self._live = self.checkpoint(self.config['miles'])
+
+        return None
+
+    def _prepare_window(self):
+        '''
+        Precompute the recorded discharge of the calibration window, from
+        warm_up+calibrate_from to calibrate_to, without its missing values,
+        and the statistics the objective functions need.
+
+        Routing only looks back in time, so the discharge of the window is
+        final once the last step of the window is run: unless
+        self.config['early_stop'] is False, calibration runs stop there. Runs
+        starting from a checkpoint (self.config['warm_start']) need no warm-up,
+        the window then begins at the checkpoint at the earliest.
+        '''
+        _begin = self.config['warm_up']+self.config['calibrate_from'].get('index')
+        if self.config.get('warm_start') is not None:
+            _begin = max(self.config['calibrate_from'].get('index'), int(self.config['warm_start']))
+        _end = self.config['calibrate_to'].get('index')+1
+
+        q_rec_all = self.columns['q_rec'][_begin:_end]
+        mask = ~np.isnan(q_rec_all)
+        q_rec = q_rec_all[mask]
+
+        if self.config.get('early_stop', True):
+            stop = min(_end, self.config['miles'])
+        else:
+            stop = self.config['miles']
+
+        self._window = {'begin': _begin,
+                        'end': _end,
+                        'stop': stop,
+                        'q_rec_all': q_rec_all,
+                        'n': max(q_rec.size, 1),
+                        'mask': None if mask.all() else mask,
+                        'q_rec': q_rec,
+                        'mean': q_rec.mean(),
+                        'std': q_rec.std(),
+                        'ss': np.square(q_rec - q_rec.mean()).sum()}
+
+        return None
+
+    def _window_perf(self, q_sim):
+        '''
+        Value of self.config['obj_fun'] on the calibration window, for one
+        simulated series [miles+1] or for a batch of them [N, miles+1]. The
+        window of recorded discharge and its statistics come from
+        _prepare_window. Series with NaN values in the window (e.g. diverging
+        members) are scored by metrics.scores, which skips the time steps
+        where either discharge is NaN, as _rmse, _nse and _kge do.
+        '''
+        w = self._window
+        q_sim = q_sim[..., w['begin']:w['end']]
+        if w['mask'] is not None:
+            q_sim = q_sim[..., w['mask']]
+
+        name = self.config['obj_fun'] if self.config['obj_fun'] in ('NSE', 'KGE') else 'RMSE'
+
+        # Series without NaN use the precomputed statistics of q_rec
+        nan = np.isnan(q_sim).any(axis=-1)
+        if q_sim.ndim == 1 and nan:
+            return metrics.scores(w['q_rec'], q_sim)[name]
+
+        err = np.square(w['q_rec'] - q_sim)
+
+        if name == 'NSE':
+            perf = 1.0 - err.sum(axis=-1)/w['ss']
+
+        elif name == 'KGE':
+            mean = q_sim.mean(axis=-1)
+            std = q_sim.std(axis=-1)
+            cov = ((w['q_rec'] - w['mean'])*(q_sim - mean[..., None])).mean(axis=-1)
+            r = cov/(w['std']*std)
+            alpha = std/w['std']
+            beta = mean/w['mean']
+            perf = 1 - np.sqrt((r-1.0)**2.0 + (alpha-1.0)**2.0 + (beta-1.0)**2.0)
+
+        else:
+            perf = np.sqrt(err.mean(axis=-1))
+
+        if q_sim.ndim > 1 and nan.any():
+            perf[nan] = metrics.scores(w['q_rec'], q_sim[nan])[name]
+
+        return perf
+
+    def _cal_fun(self, par_to_optimize):
+        '''
+        Objective function of the calibration, negated when the objective is
+        to be maximised. Every value is also appended to self._trace. Values
+        are memoized by parameter set for the duration of the calibration.
+        '''
+        self.par.update(dict(zip(self.config['par_to_calibrate'], par_to_optimize))) # Update the parameter dictionary
+
+        # Points already evaluated in this calibration are not simulated again
+        key = np.asarray(par_to_optimize, dtype=np.float64).tobytes()
+        hit = key in self._evaluated
+        if hit:
+            perf = self._evaluated[key]
+        else:
             _q_sim, _q_rec = self._simulate_for_calibration()
-            
-            # Index for period-selected calibration
-            _begin = self.config['warm_up']+self.config['calibrate_from'].get('index')
-            _end = self.config['calibrate_to'].get('index')+1
-            
-            perf = self.obj_fun(_q_rec[_begin:_end], _q_sim[_begin:_end])
+
+            perf = self._window_perf(np.asarray(_q_sim, dtype=np.float64))
 
             if self.config['verbose']:
                 print('{0}: {1}'.format(self.config['fun_name'], perf))
-            
-            return -perf
 
-        # Model optimisation
-        if self.config['minimise']:
-            par_cal = opt.minimize(_cal_fun_minimize, self.x_0, method='L-BFGS-B',
-                                    bounds=self.x_b, tol=self.config['tol'])
+            if not self.config['minimise']:
+                perf = -perf
+            self._evaluated[key] = perf
+
+        self._trace.append(perf)
+        self._report(1, perf, hits=int(hit))
+
+        return perf
+
+    def _cal_fun_batch(self, population, threshold=None):
+        '''
+        Objective function of the calibration for a whole population
+        [P, n_par] of the parameters to calibrate, run in one batched
+        simulation. Negated when the objective is to be maximised; diverging
+        members score np.inf.
+
+        If self.config['abort_worse'] is set and the objective is to minimise
+        RMSE, the members whose partial RMSE already exceeds their threshold
+        [P] are abandoned and score that partial RMSE (still above their
+        threshold).
+        '''
+        par_matrix = np.tile([self.par[key] for key in self._ind[:18]], (len(population), 1))
+        par_matrix[:, [self._ind.index(key) for key in self.config['par_to_calibrate']]] = population
+
+        if not (self.config.get('abort_worse') and self.config['minimise'] and self.config['obj_fun'] == 'RMSE'):
+            threshold = None
+
+        q_sim, bound = self._simulate_batch(par_matrix, stop=self._window['stop'], threshold=threshold)
+        with np.errstate(invalid='ignore'):
+            perf = self._window_perf(q_sim)
+
+        if not self.config['minimise']:
+            perf = -perf
+        perf[np.isnan(perf)] = np.inf
+
+        abandoned = ~np.isnan(bound)
+        perf[abandoned] = bound[abandoned]
+
+        self._report(len(perf), perf.min())
+
+        return perf
+
+    def _report(self, nfev, best, hits=0):
+        '''
+        Record nfev more model evaluations, the best of them scoring best and
+        hits of them memoized, in self.progress, and stop the calibration if
+        self.cancel_requested is set. self.progress holds the number of
+        evaluations 'nfev', of optimizer iterations 'iterations', the best
+        objective value so far 'best' (negated if maximised) and the number of
+        memoized evaluations 'cache_hits'. It is left empty in the workers of
+        a multi-start calibration, which report nothing.
+        '''
+        if self.cancel_requested:
+            raise CalibrationCancelled('Calibration cancelled after {0} evaluations'.format(self.progress.get('nfev')))
+
+        if not self.progress:
+            return None
+
+        self.progress['nfev'] += nfev
+        if hits:
+            self.progress['cache_hits'] = self.progress.get('cache_hits', 0) + hits
+        if np.isfinite(best) and (self.progress['best'] is None or best < self.progress['best']):
+            self.progress['best'] = float(best)
+
+        return None
+
+    def _iteration(self, *args):
+        '''
+        Optimizer callback counting iterations in self.progress
+        '''
+        if self.progress:
+            self.progress['iterations'] += 1
+
+    def _calibrate_global(self):
+        '''
+        ==================
+        Global calibration
+        ==================
+
+        Calibrate with the population-based optimizer self.config['optimizer']
+        ('SCE-UA', 'DDS' or 'DE', see optimizers), evaluating every generation
+        in one batched simulation.
+
+        Configurations
+        --------------
+        max_evals : int, optional
+        Budget of model evaluations, 2000 if unspecified
+        seed : int, optional
+        Seed of the random generator
+        n_complexes : int, optional
+        Number of complexes of SCE-UA
+        batch_size : int, optional
+        Number of candidates per iteration of DDS
+        pop_size : int, optional
+        Population size of DE
+
+        self.config['tol'] is the convergence tolerance of SCE-UA and DE, and
+        the initial guess is the starting point of DDS when
+        self.config['init_guess'] is set.
+        '''
+        name = self.config['optimizer']
+        lb, ub = zip(*self.x_b)
+        options = {'max_evals': self.config.get('max_evals', 2000),
+                   'random_state': self.config.get('seed'),
+                   'callback': self._iteration}
+
+        if name == 'DDS':
+            if self.config['init_guess']:
+                options['x_0'] = self.x_0
+            option = 'batch_size'
         else:
-            par_cal = opt.minimize(_cal_fun_maximize, self.x_0, method='L-BFGS-B',
-                                    bounds=self.x_b, tol=self.config['tol'])
-        
-        self._performance = par_cal.fun
+            options['tol'] = self.config['tol']
+            option = 'n_complexes' if name == 'SCE-UA' else 'pop_size'
+
+        if self.config.get(option):
+            options[option] = self.config[option]
+
+        self.cal_result = OPTIMIZERS[name](self._cal_fun_batch, lb, ub, **options)
+        self._performance = self.cal_result['fun']
+
+        self.par.update(dict(zip(self.config['par_to_calibrate'], self.cal_result['x'])))
 
         return None
 
+    def _minimize_from(self, x_0):
+        '''
+        One L-BFGS-B run of the calibration from the initial guess x_0.
+
+        Returns
+        -------
+        start : dict
+        Initial guess 'x_0', optimum 'x', objective value 'fun' (negated if
+        maximised, as self._performance), number of model evaluations 'nfev'
+        and the objective value of every evaluation 'trace'
+        '''
+        import scipy.optimize as opt
+
+        self._trace = list()
+        par_cal = opt.minimize(self._cal_fun, x_0, method='L-BFGS-B',
+                                bounds=self.x_b, tol=self.config['tol'],
+                                callback=self._iteration)
+
+        return {'x_0': list(x_0),
+                'x': par_cal.x.tolist(),
+                'fun': float(par_cal.fun),
+                'nfev': int(par_cal.nfev),
+                'trace': self._trace}
+
+    def _calibrate_multistart(self):
+        '''
+        =======================
+        Multi-start calibration
+        =======================
+
+        Run self.config['n_starts'] L-BFGS-B optimisations concurrently in a
+        process pool, from initial guesses sampled inside the calibration
+        boundaries, and keep the best one. The user's initial guess is the
+        first start when self.config['init_guess'] is set.
+
+        The pool forks the process, which may deadlock when other threads
+        hold locks (a calibration submitted to a JobQueue), so the starts
+        are run one after the other in this process when called off the
+        main thread, or with a single job.
+
+        Configurations
+        --------------
+        n_starts : int
+        Number of starts
+        n_jobs : int, optional
+        Number of worker processes. If unspecified, one per start, up to the
+        number of CPUs.
+        start_sampling : str, optional
+        'lhs' (Latin hypercube, default) or 'random'
+        seed : int, optional
+        Seed of the sampling of the initial guesses
+
+        Results
+        -------
+        self.starts : list of dict
+        Result of every start, see _minimize_from
+        self.best_start : int
+        Index of the best start in self.starts; its parameters are written
+        in self.par and simulated once more
+        '''
+        import multiprocessing
+        import threading
+
+        n_starts = self.config['n_starts']
+        lb, ub = zip(*self.x_b)
+        sampler = SAMPLERS[self.config.get('start_sampling', 'lhs')]
+        starts = sampler(n_starts, lb, ub, random_state=self.config.get('seed'))
+        if self.config['init_guess']:
+            starts[0] = self.x_0
+
+        n_jobs = self.config.get('n_jobs') or min(n_starts, multiprocessing.cpu_count())
+        self.starts = list()
+        if n_jobs == 1 or not isinstance(threading.current_thread(), threading._MainThread):
+            # Every evaluation is reported, and checks the cancellation
+            for x_0 in starts:
+                self.starts.append(self._minimize_from(x_0))
+        else:
+            pool = multiprocessing.Pool(n_jobs, _init_worker, (self,))
+            try:
+                # Progress is reported once per finished start, the cancellation
+                # is checked while waiting for them
+                results = pool.imap(_minimize_in_worker, list(starts))
+                while len(self.starts) < n_starts:
+                    try:
+                        start = results.next(timeout=0.1)
+                    except multiprocessing.TimeoutError:
+                        self._report(0, np.inf)
+                        continue
+                    self.starts.append(start)
+                    self._report(start['nfev'], start['fun'])
+                    self._iteration()
+            except CalibrationCancelled:
+                pool.terminate()
+                raise
+            finally:
+                pool.close()
+                pool.join()
+
+        self.best_start = int(np.argmin([start['fun'] for start in self.starts]))
+        self.cal_result = self.starts[self.best_start]
+        self._performance = self.cal_result['fun']
+
+        self.par.update(dict(zip(self.config['par_to_calibrate'], self.cal_result['x'])))
+
+        return None
+
+    def sensitivity(self, method='sobol', n=256, objectives=('RMSE', 'NSE', 'KGE'),
+                    seed=None, chunk_size=256, **options):
+        '''
+        ===========
+        Sensitivity
+        ===========
+
+        Global sensitivity of the objective functions on the calibration window
+        to the 18 parameters inside the calibration boundaries (P_LB, P_UB),
+        the snow parameters excepted when self.config['kill_snow'] is set. The
+        other parameters and the initial states are those of a simulation. All
+        the sample points are run in batched simulations, see simulate_batch.
+
+        Parameters
+        ----------
+        method : str, optional
+        'sobol' (Saltelli sample, n*(d+2) runs) or 'morris' (n trajectories,
+        n*(d+1) runs), see sensitivity.METHODS
+        n : int, optional
+        Number of base points or of trajectories
+        objectives : tuple, optional
+        Metrics of metrics.SCORES to analyse
+        seed : int, optional
+        Seed of the sample
+        chunk_size : int, optional
+        Number of members run together, see simulate_batch
+        options : optional
+        Passed to the sampling function: sampler for 'sobol', levels for
+        'morris'
+
+        Returns
+        -------
+        result : dict
+        'method', 'par' (names of the d parameters), 'nfev' (number of runs)
+        and 'indices' {objective: {index: np.ndarray [d]}}: S1 and ST for
+        'sobol', mu, mu_star and sigma for 'morris'. Diverging runs are left
+        out of the indices.
+        '''
+        from .sensitivity import METHODS
+        sample, analyse = METHODS[method]
+
+        self._init_simu()
+        self._prepare_window()
+
+        first = 8 if self.config['kill_snow'] else 0
+        names = self._ind[first:18]
+        lb, ub = self.P_LB[first:18], self.P_UB[first:18]
+
+        points = sample(n, lb, ub, random_state=seed, **options)
+        par_matrix = np.tile([self.par[key] for key in self._ind[:18]], (len(points), 1))
+        par_matrix[:, first:18] = points
+
+        # Scores of every chunk, so that a single chunk of discharge is held at a time
+        w = self._window
+        f = dict((name, np.empty(len(points))) for name in objectives)
+        for i in xrange(0, len(points), chunk_size):
+            q_sim = self._simulate_batch(par_matrix[i:i+chunk_size], stop=w['stop'])[0]
+            q_sim = q_sim[:, w['begin']:w['end']]
+            if w['mask'] is not None:
+                q_sim = q_sim[:, w['mask']]
+            card = metrics.scores(w['q_rec'], q_sim)
+            for name in objectives:
+                f[name][i:i+chunk_size] = card[name]
+
+        if method == 'sobol':
+            indices = dict((name, analyse(f[name], len(names))) for name in objectives)
+        else:
+            indices = dict((name, analyse(f[name], points, lb, ub)) for name in objectives)
+
+        self.sensitivity_result = {'method': method,
+                                   'par': list(names),
+                                   'nfev': len(points),
+                                   'indices': indices}
+
+        return self.sensitivity_result
+
+    def select_parameters(self, result=None, objective=None, threshold=0.05):
+        '''
+        =================
+        Select parameters
+        =================
+
+        Restrict the calibration to the influential parameters of a
+        sensitivity analysis: those whose total index ST (sobol), or mu_star
+        relative to the largest one (morris), reaches threshold. Sets
+        self.config['par_to_calibrate'] and clears
+        self.config['calibrate_all_par'].
+
+        Parameters
+        ----------
+        result : dict, optional
+        Result of sensitivity, by default the last one
+        objective : str, optional
+        Objective whose indices rank the parameters, by default
+        self.config['obj_fun']
+        threshold : float, optional
+        Minimal importance of a selected parameter
+
+        Returns
+        -------
+        par_to_calibrate : list
+        Selected parameters, in the order of self._ind
+        '''
+        result = result or self.sensitivity_result
+        indices = result['indices'][objective or self.config['obj_fun']]
+
+        if result['method'] == 'sobol':
+            importance = indices['ST']
+        else:
+            importance = indices['mu_star']/np.nanmax(indices['mu_star'])
+
+        self.config['par_to_calibrate'] = [key for key, value in zip(result['par'], importance)
+                                           if value >= threshold]
+        self.config['calibrate_all_par'] = False
+
+        return self.config['par_to_calibrate']
+
+    def glue(self, n=10000, objective='NSE', threshold=0.5, quantiles=(0.05, 0.5, 0.95),
+             seed=None, chunk_size=256, sampler='random'):
+        '''
+        ====
+        GLUE
+        ====
+
+        Generalised likelihood uncertainty estimation: a Monte Carlo run of n
+        parameter sets drawn inside the calibration boundaries (P_LB, P_UB),
+        the snow parameters excepted when self.config['kill_snow'] is set, and
+        bands of the simulated discharge of the behavioural sets. A set is
+        behavioural when its objective on the calibration window is better
+        than threshold, its likelihood is by how much.
+
+        Sets are drawn and run chunk by chunk in batched simulations (see
+        simulate_batch) and their discharges streamed into uncertainty.Bands,
+        so that memory does not grow with n.
+
+        Parameters
+        ----------
+        n : int, optional
+        Number of parameter sets
+        objective : str, optional
+        'NSE', 'KGE', 'log-NSE' or 'RMSE', see metrics.scores
+        threshold : float, optional
+        Behavioural threshold of the objective, a maximum for 'RMSE' and a
+        minimum for the others
+        quantiles : tuple, optional
+        Probabilities of the quantile bands
+        seed : int, optional
+        Seed of the sample
+        chunk_size : int, optional
+        Number of sets drawn and run together
+        sampler : str, optional
+        Sampler of each chunk, see sampling.SAMPLERS
+
+        Returns
+        -------
+        result : dict
+        'bands' {p or 'mean' or 'std': np.ndarray [miles+1]}, quantiles of
+        the behavioural discharges and their mean and standard deviation
+        weighted by likelihood, np.nan before the first simulated time step
+        (see _initial_conditions); 'nfev' (n), 'n_behavioural' and 'best'
+        (parameters of the most likely set, None without any)
+
+        The quantile bands are not weighted: every behavioural set counts the
+        same in them, whatever its likelihood. Only 'mean' and 'std' are
+        weighted.
+        '''
+        from .uncertainty import Bands
+
+        if objective not in ('NSE', 'KGE', 'log-NSE', 'RMSE'):
+            raise ValueError('Unknown GLUE objective {0}'.format(objective))
+
+        self._init_simu()
+        self._prepare_window()
+
+        first = 8 if self.config['kill_snow'] else 0
+        lb, ub = self.P_LB[first:18], self.P_UB[first:18]
+        rs = check_random_state(seed)
+
+        w = self._window
+        start = self._initial_conditions()[0]
+        bands = Bands(self.config['miles']+1-start, quantiles, compiled=self._engine() == 'numba')
+        best, best_likelihood = None, 0.0
+
+        for i in xrange(0, n, chunk_size):
+            points = SAMPLERS[sampler](min(chunk_size, n-i), lb, ub, rs)
+            par_matrix = np.tile([self.par[key] for key in self._ind[:18]], (len(points), 1))
+            par_matrix[:, first:18] = points
+
+            q_sim = self._simulate_batch(par_matrix)[0]
+            q_win = q_sim[:, w['begin']:w['end']]
+            if w['mask'] is not None:
+                q_win = q_win[:, w['mask']]
+            score = metrics.scores(w['q_rec'], q_win)[objective]
+
+            # Diverging sets score NaN, never behavioural
+            likelihood = threshold - score if objective == 'RMSE' else score - threshold
+            behavioural = np.flatnonzero(np.nan_to_num(likelihood) > 0)
+            bands.update(q_sim[behavioural, start:], likelihood[behavioural])
+
+            if behavioural.size and likelihood[behavioural].max() > best_likelihood:
+                j = behavioural[likelihood[behavioural].argmax()]
+                best, best_likelihood = dict(zip(self._ind[:18], par_matrix[j].tolist())), likelihood[j]
+
+        result = OrderedDict()
+        for name, band in bands.result().items():
+            result[name] = np.concatenate((np.full(start, np.nan), band))
+
+        self.glue_result = {'bands': result,
+                            'nfev': n,
+                            'n_behavioural': bands.count,
+                            'best': best}
+
+        return self.glue_result
+
+    def __getstate__(self):
+        # Bound methods cannot be pickled; obj_fun is set again by _init_simu
+        state = self.__dict__.copy()
+        state.pop('obj_fun', None)
+        # The cache is shared by the models of a process
+        state['cache'] = None
+        # Workers report no progress of their own
+        state['progress'] = dict()
+        return state
+
     def _simulate_for_calibration(self):
-        self._step_run()
+        # Objective functions only need q_sim
+        self._step_run(self._window['stop'], record=((), 1))
+
+        if self._engine() != 'dict':
+            return self.columns['q_sim'], self.columns['q_rec']
+
         _q_sim = map(lambda d: d.get('q_sim', np.nan), self.data)
         _q_rec = map(lambda d: d.get('q_rec', np.nan), self.data)
         
@@ -728,14 +2160,24 @@ class HBV96(HydroModel):
 
     def _simulate_without_calibration(self):
         self._init_simu()
-        self._step_run()
+        self._run_cached()
+
+        if self._engine() != 'dict':
+            # Rows are written on demand, see data
+            self._exported = False
+            self._record_checkpoints()
+            self._live = self.checkpoint(self.config['miles'])
         
         return None
 
     def _init_simu(self):
-        self.config['miles'] = (len(self.data)-1)
-        self.data[0].update(self.DEF_ST)
-        self.data[0].update({'q_sim': self.DEF_q0})
+        self.config['miles'] = (self.n_rows()-1)
+        self._load_columns()
+        # The dictionary engine starts from the first row, built if needed
+        rows = self.data if self._engine() == 'dict' else self._data
+        if rows:
+            rows[0].update(self.DEF_ST)
+            rows[0].update({'q_sim': self.DEF_q0})
         if self.config['obj_fun'] == 'RMSE':
             self.obj_fun = self._rmse
         elif self.config['obj_fun'] == 'NSE':
@@ -747,7 +2189,25 @@ class HBV96(HydroModel):
         
         return None
 
+# Worker side of the multi-start calibration
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+    _worker_model._init_simu()
+
+def _minimize_in_worker(x_0):
+    return _worker_model._minimize_from(x_0)
+
 # Exceptions
+class CalibrationCancelled(Exception):
+    """ CalibrationCancelled """
+    '''
+    Error raised inside a calibration when self.cancel_requested is set
+    '''
+    pass
+
 class DivergentError(Exception):
     """ DivergentError """
     '''
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Goodness-of-fit metrics of the simulated discharges, in NumPy only.
+'''
+from __future__ import division, print_function
+from collections import OrderedDict
+
+import numpy as np
+
+# Metrics of scores, in the order of the scorecard
+SCORES = ('RMSE', 'NSE', 'KGE', 'log-NSE', 'PBIAS', 'peak_error', 'peak_timing')
+
+
+def scores(q_rec, q_sim, eps=None):
+    '''
+    =========
+    Scorecard
+    =========
+
+    All the metrics of SCORES computed together, from one masked residual
+    array and the deviations of both series from their means. Time steps where
+    either discharge is NaN are skipped by every metric.
+
+    Parameters
+    ----------
+    q_rec : array_like [n]
+    Measured discharge [m3/s]
+    q_sim : array_like [n] or [N, n]
+    Simulated discharge [m3/s], one series or a batch of them
+    eps : float, optional
+    Offset of the discharges in the logarithms of log-NSE, by default 1% of
+    the mean measured discharge so that zero flows stay finite
+
+    Returns
+    -------
+    scores : OrderedDict
+    {name: float or np.ndarray [N]} with
+    RMSE : root mean squared error [m3/s]
+    NSE : Nash-Sutcliffe efficiency [-]
+    KGE : Kling-Gupta efficiency [-]
+    log-NSE : NSE of the logarithms, weighting low flows [-]
+    PBIAS : percent bias, positive when the simulation overestimates [%]
+    peak_error : relative error of the highest simulated discharge [-]
+    peak_timing : time steps from the recorded peak to the simulated one
+    '''
+    q_rec = np.asarray(q_rec, dtype=np.float64)
+    q_sim = np.asarray(q_sim, dtype=np.float64)
+
+    valid = np.isfinite(q_rec) & np.isfinite(q_sim)
+    if valid.shape[-1] == 0:
+        nan = np.full(valid.shape[:-1], np.nan)
+        return OrderedDict((name, float(nan) if nan.ndim == 0 else nan) for name in SCORES)
+    n = valid.sum(axis=-1)
+    obs = np.where(valid, q_rec, 0.0)
+    sim = np.where(valid, q_sim, 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sum_obs = obs.sum(axis=-1)
+        mean_obs, mean_sim = sum_obs/n, sim.sum(axis=-1)/n
+
+        # Masked residuals and deviations, zero where skipped
+        res = sim - obs
+        dev_obs = np.where(valid, q_rec - mean_obs[..., None], 0.0)
+        dev_sim = np.where(valid, q_sim - mean_sim[..., None], 0.0)
+
+        sse = np.square(res).sum(axis=-1)
+        ss_obs = np.square(dev_obs).sum(axis=-1)
+        ss_sim = np.square(dev_sim).sum(axis=-1)
+
+        r = (dev_obs*dev_sim).sum(axis=-1)/np.sqrt(ss_obs*ss_sim)
+        alpha = np.sqrt(ss_sim/ss_obs)
+        beta = mean_sim/mean_obs
+
+        if eps is None:
+            eps = 0.01*mean_obs
+        eps = np.asarray(eps, dtype=np.float64)[..., None]
+        log_obs = np.where(valid, np.log(obs + eps), 0.0)
+        log_sim = np.where(valid, np.log(sim + eps), 0.0)
+        log_dev = np.where(valid, log_obs - log_obs.sum(axis=-1)[..., None]/n[..., None], 0.0)
+        log_nse = 1.0 - np.square(log_sim - log_obs).sum(axis=-1)/np.square(log_dev).sum(axis=-1)
+
+        peak_obs = np.where(valid, q_rec, -np.inf)
+        peak_sim = np.where(valid, q_sim, -np.inf)
+        t_obs, t_sim = peak_obs.argmax(axis=-1), peak_sim.argmax(axis=-1)
+
+        card = OrderedDict([
+            ('RMSE', np.sqrt(sse/n)),
+            ('NSE', 1.0 - sse/ss_obs),
+            ('KGE', 1.0 - np.sqrt((r-1.0)**2.0 + (alpha-1.0)**2.0 + (beta-1.0)**2.0)),
+            ('log-NSE', log_nse),
+            ('PBIAS', 100.0*res.sum(axis=-1)/sum_obs),
+            ('peak_error', (peak_sim.max(axis=-1) - peak_obs.max(axis=-1))/peak_obs.max(axis=-1)),
+            ('peak_timing', (t_sim - t_obs).astype(np.float64)),
+            ])
+
+    # No valid time step: no score
+    for name in card:
+        card[name] = np.where(n > 0, card[name], np.nan)
+        if card[name].ndim == 0:
+            card[name] = float(card[name])
+
+    return card
+
+
+def roc_curve(y_true, y_score, drop_intermediate=True):
+    '''
+    =========
+    ROC curve
+    =========
+
+    Receiver operating characteristic of the binary series y_true ranked by
+    y_score, as sklearn.metrics.roc_curve computes it: one point per distinct
+    score, from the highest to the lowest, and a first point (0, 0).
+
+    Parameters
+    ----------
+    y_true : array_like
+    Binary labels, 1 for the positive class
+    y_score : array_like
+    Scores of the positive class, higher is more likely positive
+    drop_intermediate : bool, optional
+    Drop the points lying on a straight segment of the curve
+
+    Returns
+    -------
+    fpr : np.ndarray
+    False positive rates, nan if y_true has no negative
+    tpr : np.ndarray
+    True positive rates, nan if y_true has no positive
+    thresholds : np.ndarray
+    Decreasing scores at which the rates are taken, the first one is
+    max(y_score) + 1
+    '''
+    y_true = np.ravel(y_true) == 1
+    y_score = np.ravel(y_score).astype(np.float64)
+
+    # Scores in decreasing order, the last index of each distinct score
+    order = np.argsort(y_score, kind='mergesort')[::-1]
+    y_score, y_true = y_score[order], y_true[order]
+    last = np.r_[np.flatnonzero(np.diff(y_score)), y_true.size - 1]
+
+    tps = np.cumsum(y_true)[last].astype(np.float64)
+    fps = 1 + last - tps
+    thresholds = y_score[last]
+
+    if drop_intermediate and fps.size > 2:
+        keep = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        fps, tps, thresholds = fps[keep], tps[keep], thresholds[keep]
+
+    fps, tps = np.r_[0, fps], np.r_[0, tps]
+    thresholds = np.r_[thresholds[0] + 1, thresholds]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fpr = fps/fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+        tpr = tps/tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+
+    return fpr, tpr, thresholds
+
+
+def auc(x, y):
+    '''
+    Area under the curve y(x) by the trapezoidal rule, x monotonic
+    (increasing or decreasing)
+    '''
+    x, y = np.ravel(x).astype(np.float64), np.ravel(y).astype(np.float64)
+    if x.size < 2:
+        raise ValueError('At least 2 points are needed to compute an area under the curve')
+
+    dx = np.diff(x)
+    direction = 1
+    if np.any(dx < 0):
+        if np.all(dx <= 0):
+            direction = -1
+        else:
+            raise ValueError('x is neither increasing nor decreasing')
+
+    return direction*np.trapz(y, x)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Population-based global optimizers for the calibration of HBV96.
+
+Every optimizer minimises fun inside the box [lb, ub] and calls fun on a whole
+population at once: fun takes an array [P, n_par] of parameter sets and
+returns an array [P] of objective values, so that a generation costs a single
+batched simulation (see HBV96.simulate_batch).
+
+When only the comparison of a candidate with a known value matters, this value
+is passed to fun as a second argument threshold [P]; fun may then stop
+evaluating a candidate as soon as it is certain to exceed its threshold and
+return any value above it.
+
+Every optimizer returns a dictionary with the optimum 'x', its objective value
+'fun', the number of evaluations 'nfev' and the best objective value after
+each generation 'trace'.
+'''
+from __future__ import division, print_function
+import numpy as np
+
+from .sampling import check_random_state, latin_hypercube, uniform
+
+
+def _reflect(x, lb, ub):
+    '''
+    Reflect the points of x outside [lb, ub] on the violated boundary, points
+    still outside after reflection are clipped
+    '''
+    x = np.where(x < lb, 2*lb - x, x)
+    x = np.where(x > ub, 2*ub - x, x)
+
+    return np.clip(x, lb, ub)
+
+
+def _converged(f, tol):
+    '''
+    True when the spread of the objective values of a population is below tol,
+    relative to the best value
+    '''
+    f = f[np.isfinite(f)]
+
+    return f.size > 1 and f.max() - f.min() <= tol*(np.abs(f.min()) + tol)
+
+
+def differential_evolution(fun, lb, ub, max_evals=2000, pop_size=None, F=0.8, CR=0.9,
+                           tol=None, random_state=None, callback=None):
+    '''
+    ======================
+    Differential evolution
+    ======================
+
+    DE/rand/1/bin of Storn & Price (1997). Each generation builds one trial
+    vector per member and evaluates the trial population in one call.
+
+    Parameters
+    ----------
+    fun : function
+    Objective function of a population [P, n_par] -> [P]
+    lb, ub : array_like [n_par]
+    Boundaries
+    max_evals : int, optional
+    Budget of objective function evaluations
+    pop_size : int, optional
+    Population size. If unspecified, 5 times the number of parameters.
+    F : float, optional
+    Differential weight
+    CR : float, optional
+    Crossover probability
+    tol : float, optional
+    Stop when the relative spread of the population is below tol
+    random_state : int or np.random.RandomState, optional
+    callback : function, optional
+    Called after every generation as callback(nfev, best objective value)
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+    d = lb.size
+    NP = max(4, pop_size or 5*d)
+
+    pop = latin_hypercube(NP, lb, ub, rs)
+    f = fun(pop)
+    nfev = NP
+    trace = [f.min()]
+
+    while nfev + NP <= max_evals:
+        # Three distinct donors per member, all different from the member
+        r = np.array([rs.choice(NP-1, 3, replace=False) for _ in xrange(NP)])
+        r += r >= np.arange(NP)[:, None]
+        mutant = pop[r[:, 0]] + F*(pop[r[:, 1]] - pop[r[:, 2]])
+
+        cross = rs.uniform(size=(NP, d)) < CR
+        cross[np.arange(NP), rs.randint(d, size=NP)] = True
+        trial = _reflect(np.where(cross, mutant, pop), lb, ub)
+
+        f_trial = fun(trial, f)
+        nfev += NP
+
+        better = f_trial <= f
+        pop[better] = trial[better]
+        f[better] = f_trial[better]
+
+        trace.append(f.min())
+        if callback is not None:
+            callback(nfev, f.min())
+
+        if tol is not None and _converged(f, tol):
+            break
+
+    best = np.argmin(f)
+
+    return {'x': pop[best].tolist(), 'fun': float(f[best]), 'nfev': nfev, 'trace': trace}
+
+
+def dds(fun, lb, ub, max_evals=2000, batch_size=None, r=0.2, x_0=None,
+        random_state=None, callback=None):
+    '''
+    ==============================
+    Dynamically dimensioned search
+    ==============================
+
+    DDS of Tolson & Shoemaker (2007). The search perturbs the current best
+    solution in a randomly chosen subset of dimensions whose expected size
+    shrinks as the budget is spent. Here each iteration draws batch_size
+    candidates around the best solution and evaluates them in one call.
+
+    Parameters
+    ----------
+    fun : function
+    Objective function of a population [P, n_par] -> [P]
+    lb, ub : array_like [n_par]
+    Boundaries
+    max_evals : int, optional
+    Budget of objective function evaluations
+    batch_size : int, optional
+    Number of candidates per iteration. If unspecified, the number of
+    parameters.
+    r : float, optional
+    Perturbation size, as a fraction of the parameter ranges
+    x_0 : array_like [n_par], optional
+    Initial solution. If unspecified, sampled uniformly.
+    random_state : int or np.random.RandomState, optional
+    callback : function, optional
+    Called after every iteration as callback(nfev, best objective value)
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+    d = lb.size
+    batch = batch_size or d
+
+    if x_0 is None:
+        x_best = uniform(1, lb, ub, rs)[0]
+    else:
+        x_best = np.asarray(x_0, dtype=np.float64)
+    f_best = fun(x_best[None, :])[0]
+    nfev = 1
+    trace = [f_best]
+
+    n_iter = max(1, (max_evals - 1)//batch)
+
+    for i in xrange(1, n_iter+1):
+        # Probability of perturbing each dimension
+        p = 1.0 - np.log(i)/np.log(n_iter) if n_iter > 1 else 1.0
+
+        perturb = rs.uniform(size=(batch, d)) < p
+        none = ~perturb.any(axis=1)
+        perturb[none, rs.randint(d, size=none.sum())] = True
+
+        step = r*(ub - lb)*rs.standard_normal((batch, d))
+        candidates = _reflect(x_best + perturb*step, lb, ub)
+
+        f = fun(candidates, np.full(batch, f_best))
+        nfev += batch
+
+        j = np.argmin(f)
+        if f[j] <= f_best:
+            x_best, f_best = candidates[j], f[j]
+
+        trace.append(f_best)
+        if callback is not None:
+            callback(nfev, f_best)
+
+    return {'x': x_best.tolist(), 'fun': float(f_best), 'nfev': nfev, 'trace': trace}
+
+
+def sce_ua(fun, lb, ub, max_evals=2000, n_complexes=None, tol=None,
+           random_state=None, callback=None):
+    '''
+    ======
+    SCE-UA
+    ======
+
+    Shuffled Complex Evolution of Duan et al. (1992). The population is
+    partitioned into complexes of 2n+1 points which evolve independently by
+    competitive complex evolution (CCE) before being shuffled. The complexes
+    evolve in lockstep, so every CCE step evaluates one candidate per
+    complex in a single call.
+
+    Parameters
+    ----------
+    fun : function
+    Objective function of a population [P, n_par] -> [P]
+    lb, ub : array_like [n_par]
+    Boundaries
+    max_evals : int, optional
+    Budget of objective function evaluations
+    n_complexes : int, optional
+    Number of complexes. If unspecified, 4.
+    tol : float, optional
+    Stop when the relative spread of the population is below tol
+    random_state : int or np.random.RandomState, optional
+    callback : function, optional
+    Called after every shuffle as callback(nfev, best objective value)
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+    d = lb.size
+    p = n_complexes or 4
+    m = 2*d + 1     # points per complex
+    q = d + 1       # points per sub-complex
+    beta = m        # CCE steps per shuffle
+
+    pop = latin_hypercube(p*m, lb, ub, rs)
+    f = fun(pop)
+    nfev = p*m
+    trace = [f.min()]
+
+    # Triangular probability of selecting the i-th best point of a complex
+    w = 2.0*(m - np.arange(m))/(m*(m + 1))
+    rows = np.arange(p)
+
+    while nfev + p <= max_evals:
+        # Partition the sorted population, complex k holds points k, k+p, ...
+        order = np.argsort(f)
+        cx = pop[order].reshape(m, p, d).transpose(1, 0, 2).copy()
+        cf = f[order].reshape(m, p).T.copy()
+
+        for _ in xrange(beta):
+            if nfev + p > max_evals:
+                break
+
+            sel = np.sort([rs.choice(m, q, replace=False, p=w) for _ in rows], axis=1)
+            worst = sel[:, -1]
+            x_w = cx[rows, worst]
+            f_w = cf[rows, worst]
+            centroid = cx[rows[:, None], sel[:, :-1]].mean(axis=1)
+
+            # Random points are drawn in the smallest box containing the complex
+            low, high = cx.min(axis=1), cx.max(axis=1)
+
+            # Reflection, or a random point if it leaves the feasible space
+            x_new = 2*centroid - x_w
+            outside = ((x_new < lb) | (x_new > ub)).any(axis=1)
+            x_new[outside] = low[outside] + rs.uniform(size=(outside.sum(), d))*(high - low)[outside]
+            f_new = fun(x_new, f_w)
+            nfev += p
+
+            # Complexes left without budget keep their worst point
+            kept = np.zeros(p, dtype=bool)
+
+            # Contraction of the complexes where the reflection failed
+            fail = f_new >= f_w
+            kept |= fail & (np.cumsum(fail) > max_evals - nfev)
+            fail &= ~kept
+            if fail.any():
+                x_new[fail] = (centroid[fail] + x_w[fail])/2.0
+                f_new[fail] = fun(x_new[fail], f_w[fail])
+                nfev += fail.sum()
+
+            # Random point where the contraction failed as well
+            fail = (f_new >= f_w) & ~kept
+            kept |= fail & (np.cumsum(fail) > max_evals - nfev)
+            fail &= ~kept
+            if fail.any():
+                x_new[fail] = low[fail] + rs.uniform(size=(fail.sum(), d))*(high - low)[fail]
+                f_new[fail] = fun(x_new[fail])
+                nfev += fail.sum()
+
+            x_new[kept], f_new[kept] = x_w[kept], f_w[kept]
+            cx[rows, worst] = x_new
+            cf[rows, worst] = f_new
+
+            order = np.argsort(cf, axis=1)
+            cx = cx[rows[:, None], order]
+            cf = cf[rows[:, None], order]
+
+        # Shuffle the complexes
+        pop = cx.reshape(p*m, d)
+        f = cf.reshape(p*m)
+
+        trace.append(f.min())
+        if callback is not None:
+            callback(nfev, f.min())
+
+        if tol is not None and _converged(f, tol):
+            break
+
+    best = np.argmin(f)
+
+    return {'x': pop[best].tolist(), 'fun': float(f[best]), 'nfev': int(nfev), 'trace': trace}
+
+
+OPTIMIZERS = {'SCE-UA': sce_ua,
+              'DDS': dds,
+              'DE': differential_evolution}
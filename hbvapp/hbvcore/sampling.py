@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Sampling of the bounded HBV96 parameter space.
+'''
+from __future__ import division, print_function
+import numpy as np
+
+
+def check_random_state(random_state):
+    '''
+    np.random.RandomState from a seed, or random_state itself if it is one
+    '''
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+
+    return np.random.RandomState(random_state)
+
+
+def uniform(n, lb, ub, random_state=None):
+    '''
+    n independent uniform draws inside [lb, ub].
+
+    Returns
+    -------
+    sample : np.ndarray [n, len(lb)]
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+
+    return lb + rs.uniform(size=(n, lb.size))*(ub - lb)
+
+
+def latin_hypercube(n, lb, ub, random_state=None):
+    '''
+    Latin hypercube sample of n points inside [lb, ub]: every parameter range
+    is cut in n strata of equal width and each stratum holds exactly one point.
+
+    Returns
+    -------
+    sample : np.ndarray [n, len(lb)]
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+
+    u = (rs.uniform(size=(n, lb.size)) + np.arange(n)[:, None])/n
+    for j in xrange(lb.size):
+        u[:, j] = u[rs.permutation(n), j]
+
+    return lb + u*(ub - lb)
+
+
+SAMPLERS = {'random': uniform,
+            'lhs': latin_hypercube}
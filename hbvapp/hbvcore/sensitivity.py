@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Global sensitivity analysis of a model over a bounded parameter space.
+
+Two methods, each split in a sampling function and an analysis function of
+the model outputs at the sample points, so that the model runs in between are
+free to be batched:
+
+sobol : Saltelli sampling and first-order and total Sobol indices, with the
+estimators of Saltelli et al. (2010) for the first order and of Jansen
+(1999) for the total effects
+morris : One-at-a-time trajectories and the statistics of the elementary
+effects of Morris (1991), with mu* of Campolongo et al. (2007)
+'''
+from __future__ import division, print_function
+import numpy as np
+
+from .sampling import SAMPLERS, check_random_state
+
+
+def saltelli(n, lb, ub, random_state=None, sampler='lhs'):
+    '''
+    ========
+    Saltelli
+    ========
+
+    Sample of the Sobol analysis: two independent base samples A and B of n
+    points inside [lb, ub], and for every parameter i the matrix AB_i, equal
+    to A but with column i taken from B.
+
+    Parameters
+    ----------
+    n : int
+    Number of base points, the model is evaluated n*(d+2) times
+    lb, ub : array_like [d]
+    Bounds of the parameters
+    random_state : int or np.random.RandomState, optional
+    Seed of the sample
+    sampler : str, optional
+    Sampler of the base samples, see sampling.SAMPLERS
+
+    Returns
+    -------
+    sample : np.ndarray [n*(d+2), d]
+    A, B, AB_1, ..., AB_d stacked, see sobol_indices
+    '''
+    rs = check_random_state(random_state)
+    lb = np.asarray(lb, dtype=np.float64)
+    d = lb.size
+
+    A = SAMPLERS[sampler](n, lb, ub, rs)
+    B = SAMPLERS[sampler](n, lb, ub, rs)
+
+    sample = np.empty(((d+2)*n, d), dtype=np.float64)
+    sample[:n] = A
+    sample[n:2*n] = B
+    for i in xrange(d):
+        AB = sample[(i+2)*n:(i+3)*n]
+        AB[:] = A
+        AB[:, i] = B[:, i]
+
+    return sample
+
+
+def sobol_indices(f, d, n_boot=0, random_state=None):
+    '''
+    =============
+    Sobol indices
+    =============
+
+    First-order and total Sobol indices from the model outputs f at the points
+    of saltelli. Base points where any output is NaN (e.g. diverging runs) are
+    left out.
+
+    Parameters
+    ----------
+    f : array_like [n*(d+2)]
+    Model outputs, in the order of the sample
+    d : int
+    Number of parameters
+    n_boot : int, optional
+    Number of bootstrap resamples of the base points for the confidence
+    intervals, none if 0
+    random_state : int or np.random.RandomState, optional
+    Seed of the bootstrap
+
+    Returns
+    -------
+    indices : dict
+    'S1' and 'ST' [d], with n_boot also 'S1_conf' and 'ST_conf' [d], half
+    widths of their 95% confidence intervals
+    '''
+    f = np.asarray(f, dtype=np.float64).reshape(d+2, -1)
+    f = f[:, ~np.isnan(f).any(axis=0)]
+
+    def estimate(f):
+        f_A, f_B, f_AB = f[0], f[1], f[2:]
+        var = np.concatenate((f_A, f_B)).var()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            S1 = (f_B*(f_AB - f_A)).mean(axis=1)/var
+            ST = 0.5*np.square(f_A - f_AB).mean(axis=1)/var
+        return S1, ST
+
+    S1, ST = estimate(f)
+    indices = {'S1': S1, 'ST': ST}
+
+    if n_boot:
+        rs = check_random_state(random_state)
+        n = f.shape[1]
+        boot = [estimate(f[:, rs.randint(0, n, n)]) for _ in xrange(n_boot)]
+        indices['S1_conf'] = 1.96*np.std([b[0] for b in boot], axis=0)
+        indices['ST_conf'] = 1.96*np.std([b[1] for b in boot], axis=0)
+
+    return indices
+
+
+def morris(r, lb, ub, levels=4, random_state=None):
+    '''
+    ======
+    Morris
+    ======
+
+    r random one-at-a-time trajectories on a grid of levels values per
+    parameter inside [lb, ub]: each trajectory starts from a grid point and
+    moves every parameter once, in random order, by delta = levels/(2*(levels-1))
+    of its range.
+
+    Returns
+    -------
+    sample : np.ndarray [r*(d+1), d]
+    The d+1 points of each trajectory, one trajectory after the other
+    '''
+    rs = check_random_state(random_state)
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+    d = lb.size
+    delta = levels/(2.0*(levels-1))
+
+    # Starting points on the levels that leave room for a step up
+    grid = np.arange(levels//2)/(levels-1.0)
+
+    sample = np.empty((r, d+1, d), dtype=np.float64)
+    for k in xrange(r):
+        x = grid[rs.randint(0, grid.size, d)]
+        # Each step moves one parameter up or down, whichever stays inside
+        sample[k, 0] = x
+        for j, i in enumerate(rs.permutation(d)):
+            x = x.copy()
+            x[i] = x[i] + delta if x[i] + delta <= 1.0 else x[i] - delta
+            sample[k, j+1] = x
+
+    return lb + sample.reshape(r*(d+1), d)*(ub - lb)
+
+
+def morris_indices(f, sample, lb, ub):
+    '''
+    ==============
+    Morris indices
+    ==============
+
+    Statistics of the elementary effects from the model outputs f at the points
+    of morris. Effects are taken per unit of the parameter range, so that
+    parameters of different scales compare. Trajectories with NaN outputs are
+    left out.
+
+    Returns
+    -------
+    indices : dict
+    'mu' (mean effect), 'mu_star' (mean absolute effect) and 'sigma'
+    (standard deviation of the effects) [d]
+    '''
+    lb, ub = np.asarray(lb, dtype=np.float64), np.asarray(ub, dtype=np.float64)
+    d = lb.size
+    f = np.asarray(f, dtype=np.float64).reshape(-1, d+1)
+    x = (np.asarray(sample, dtype=np.float64).reshape(-1, d+1, d) - lb)/(ub - lb)
+
+    keep = ~np.isnan(f).any(axis=1)
+    f, x = f[keep], x[keep]
+
+    # Parameter moved at each step and the effect of that move
+    dx = np.diff(x, axis=1)
+    moved = np.abs(dx).argmax(axis=2)
+    effects = np.empty((f.shape[0], d), dtype=np.float64)
+    rows = np.arange(f.shape[0])[:, None]
+    effects[rows, moved] = np.diff(f, axis=1)/dx[rows, np.arange(d), moved]
+
+    return {'mu': effects.mean(axis=0),
+            'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1) if effects.shape[0] > 1 else np.full(d, np.nan)}
+
+
+METHODS = {'sobol': (saltelli, sobol_indices),
+           'morris': (morris, morris_indices)}
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Memory-mapped columnar storage of forcings and simulation outputs.
+
+A store is a directory holding one .npy file per column and an index.json
+listing the columns in order. The index is written last, so that a store
+without one is incomplete and never read. Columns are opened as read-only
+memory maps: the operating system pages them in on demand and shares the
+pages between the processes reading the same store, none of them holds a copy
+in its heap.
+
+The outputs of a run are three blocks, laid out as the ones of
+engine.allocate: states.npy [5, miles+1], fluxes.npy [14, miles] and
+q_sim.npy [miles+1]. Every row of a block is one contiguous series.
+'''
+from __future__ import division, print_function
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from .engine import STATES, FLUXES
+
+INDEX = 'index.json'
+
+
+def save_columns(directory, columns):
+    '''
+    Write the columns {name: array} as the store directory, replacing the
+    columns of the same names
+    '''
+    _makedirs(directory)
+
+    for name, a in columns.items():
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(a))
+        os.rename(tmp, _path(directory, name))
+
+    names = list(columns)
+    if exists(directory):
+        with open(os.path.join(directory, INDEX)) as f:
+            names = [n for n in json.load(f) if n not in columns] + names
+    _write_index(directory, names)
+
+    return None
+
+
+def open_columns(directory, names=None, mode='r'):
+    '''
+    Columns {name: np.memmap} of the store directory, only those in names if
+    given. KeyError if the store or a column does not exist.
+
+    Parameters
+    ----------
+    directory : str
+    Store
+    names : list, optional
+    Columns to open, all of them if unspecified
+    mode : str, optional
+    Memory map mode: 'r' (read-only, shared), 'r+' (written back to the
+    file) or 'c' (copy on write, private)
+    '''
+    if not exists(directory):
+        raise KeyError(directory)
+
+    with open(os.path.join(directory, INDEX)) as f:
+        index = json.load(f)
+
+    columns = OrderedDict()
+    for name in (index if names is None else names):
+        if name not in index:
+            raise KeyError(name)
+        columns[name] = np.load(_path(directory, name), mmap_mode=mode)
+
+    return columns
+
+
+def exists(directory):
+    '''
+    Whether directory holds a complete store
+    '''
+    return os.path.exists(os.path.join(directory, INDEX))
+
+
+def allocate(directory, miles):
+    '''
+    Same as engine.allocate, with the three blocks memory-mapped in the store
+    directory (columns 'states', 'fluxes' and 'q_sim') instead of held in
+    memory. The blocks are zeroed, the index is written at once so that the
+    store can be opened while the run writes into it.
+    '''
+    _makedirs(directory)
+
+    blocks = list()
+    for name, shape in (('states', (len(STATES), miles+1)),
+                        ('fluxes', (len(FLUXES), miles)),
+                        ('q_sim', (miles+1,))):
+        # New files replace the blocks of a previous run, whose maps stay valid
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npy')
+        os.close(fd)
+        blocks.append(np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64, shape=shape))
+        os.rename(tmp, _path(directory, name))
+
+    names = ['states', 'fluxes', 'q_sim']
+    if exists(directory):
+        with open(os.path.join(directory, INDEX)) as f:
+            names = [n for n in json.load(f) if n not in names] + names
+    _write_index(directory, names)
+
+    return tuple(blocks)
+
+
+def _path(directory, name):
+    # Column names are plain names, never paths
+    if not name or os.sep in name or name.startswith('.'):
+        raise KeyError(name)
+    return os.path.join(directory, name + '.npy')
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def _write_index(directory, names):
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(names, f)
+    os.rename(tmp, os.path.join(directory, INDEX))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Streaming uncertainty bands of simulated series.
+
+Bands aggregates any number of simulated series of the same length, one
+member at a time, in memory independent of the number of members: for every
+time step, P-square sketches (Jain and Chlamtac, 1985) of a few quantiles and
+the weighted mean and variance of the members. Each sketch tracks 5 markers,
+the minimum, the quantile and the maximum and two in between, whose heights are
+adjusted by piecewise-parabolic interpolation as the members come.
+
+p2_update advances the sketches of all the time steps by NumPy operations on
+whole series; when Numba is installed, the same update runs member by member
+and step by step in p2_loop, compiled as p2_update_jit.
+'''
+from __future__ import division, print_function
+from collections import OrderedDict
+
+import numpy as np
+
+from .engine import HAS_NUMBA
+
+if HAS_NUMBA:
+    import numba
+
+
+def p2_update(q, n, desired, increment, x):
+    '''
+    ========
+    P-square
+    ========
+
+    Add the members x to the P-square sketches, in place.
+
+    Parameters
+    ----------
+    q : np.ndarray [nq, 5, T]
+    Heights of the markers of every quantile and time step
+    n : np.ndarray [nq, 5, T]
+    Positions of the markers, from 1 to the number of members
+    desired : np.ndarray [nq, 5]
+    Desired positions of the markers, the same at every time step
+    increment : np.ndarray [nq, 5]
+    Increment of the desired positions per member
+    x : np.ndarray [m, T]
+    Members, finite
+    '''
+    cells = np.arange(1, 5)[None, :, None]
+
+    for r in xrange(x.shape[0]):
+        x_r = x[r]
+
+        # Cell of x_r between the markers, the extremes follow x_r
+        np.minimum(q[:, 0], x_r, out=q[:, 0])
+        np.maximum(q[:, 4], x_r, out=q[:, 4])
+        k = (x_r >= q[:, 1]).astype(np.intp) + (x_r >= q[:, 2]) + (x_r >= q[:, 3])
+
+        n[:, 1:] += k[:, None, :] < cells
+        desired += increment
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in (1, 2, 3):
+                d = desired[:, i, None] - n[:, i]
+                move = (((d >= 1.0) & (n[:, i+1] - n[:, i] > 1.0)) |
+                        ((d <= -1.0) & (n[:, i-1] - n[:, i] < -1.0)))
+                if not move.any():
+                    continue
+
+                s = np.sign(d)
+                q_p = q[:, i] + s/(n[:, i+1] - n[:, i-1])*(
+                    (n[:, i] - n[:, i-1] + s)*(q[:, i+1] - q[:, i])/(n[:, i+1] - n[:, i]) +
+                    (n[:, i+1] - n[:, i] - s)*(q[:, i] - q[:, i-1])/(n[:, i] - n[:, i-1]))
+
+                # Linear interpolation where the parabola leaves the neighbours
+                up = s > 0
+                q_n = np.where(up, q[:, i+1], q[:, i-1])
+                n_n = np.where(up, n[:, i+1], n[:, i-1])
+                q_l = q[:, i] + s*(q_n - q[:, i])/(n_n - n[:, i])
+
+                q_i = np.where((q[:, i-1] < q_p) & (q_p < q[:, i+1]), q_p, q_l)
+                q[:, i] = np.where(move, q_i, q[:, i])
+                n[:, i] += np.where(move, s, 0.0)
+
+    return None
+
+
+def p2_loop(q, n, desired, increment, x):
+    '''
+    Same as p2_update, one member, quantile and time step at a time, compiled
+    by Numba as p2_update_jit.
+    '''
+    nq, T = q.shape[0], q.shape[2]
+
+    for r in range(x.shape[0]):
+        for j in range(nq):
+            for i in range(5):
+                desired[j, i] += increment[j, i]
+
+            for t in range(T):
+                x_t = x[r, t]
+
+                if x_t < q[j, 0, t]:
+                    q[j, 0, t] = x_t
+                if x_t > q[j, 4, t]:
+                    q[j, 4, t] = x_t
+                k = 0
+                while k < 3 and x_t >= q[j, k+1, t]:
+                    k += 1
+                for i in range(k+1, 5):
+                    n[j, i, t] += 1.0
+
+                for i in range(1, 4):
+                    d = desired[j, i] - n[j, i, t]
+                    if not ((d >= 1.0 and n[j, i+1, t] - n[j, i, t] > 1.0) or
+                            (d <= -1.0 and n[j, i-1, t] - n[j, i, t] < -1.0)):
+                        continue
+
+                    s = 1.0 if d > 0 else -1.0
+                    q_i, n_i = q[j, i, t], n[j, i, t]
+                    q_lo, n_lo = q[j, i-1, t], n[j, i-1, t]
+                    q_hi, n_hi = q[j, i+1, t], n[j, i+1, t]
+
+                    q_p = q_i + s/(n_hi - n_lo)*((n_i - n_lo + s)*(q_hi - q_i)/(n_hi - n_i) +
+                                                 (n_hi - n_i - s)*(q_i - q_lo)/(n_i - n_lo))
+                    if not (q_lo < q_p < q_hi):
+                        if s > 0:
+                            q_p = q_i + (q_hi - q_i)/(n_hi - n_i)
+                        else:
+                            q_p = q_i - (q_lo - q_i)/(n_lo - n_i)
+
+                    q[j, i, t] = q_p
+                    n[j, i, t] = n_i + s
+
+    return None
+
+
+if HAS_NUMBA:
+    p2_update_jit = numba.njit(cache=True, nogil=True)(p2_loop)
+else:
+    p2_update_jit = None
+
+
+class Bands(object):
+    '''
+    Streaming quantiles (unweighted) and weighted statistics of series of T
+    time steps.
+
+    Parameters
+    ----------
+    size : int
+    Number of time steps T of the series
+    quantiles : tuple, optional
+    Probabilities of the quantiles to track
+    compiled : bool, optional
+    Update the sketches with p2_update_jit, if Numba is installed
+
+    Memory is O(T*len(quantiles)): 2 arrays [len(quantiles), 5, T] for the
+    sketches and 2 arrays [T] for the statistics.
+    '''
+    def __init__(self, size, quantiles=(0.05, 0.5, 0.95), compiled=True):
+        self.size = size
+        self.quantiles = tuple(quantiles)
+        self.count = 0
+        self.weight = 0.0
+        self.mean = np.zeros(size)
+        self._m2 = np.zeros(size)
+
+        p = np.asarray(self.quantiles, dtype=np.float64)[:, None]
+        self._first = np.empty((5, size))
+        self._q = np.empty((p.size, 5, size))
+        self._n = np.empty((p.size, 5, size))
+        self._desired = np.hstack((np.ones_like(p), 1 + 2*p, 1 + 4*p, 3 + 2*p, 5*np.ones_like(p)))
+        self._increment = np.hstack((np.zeros_like(p), p/2, p, (1 + p)/2, np.ones_like(p)))
+        self._update = p2_update_jit if compiled and HAS_NUMBA else p2_update
+
+    def update(self, x, weights=None):
+        '''
+        Add the members x [m, T] (or a single one [T]), of likelihood
+        weights [m] (1 if unspecified). Members must be finite. The weights
+        only enter the mean and variance, every member counts once in the
+        quantile sketches.
+        '''
+        x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+        if not x.shape[0]:
+            return None
+        w = np.ones(x.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+
+        # Weighted mean and sum of squares of the members, merged with the previous ones
+        w_b = w.sum()
+        if w_b > 0:
+            mean_b = w.dot(x)/w_b
+            m2_b = w.dot(np.square(x - mean_b))
+            delta = mean_b - self.mean
+            total = self.weight + w_b
+            self.mean += delta*(w_b/total)
+            self._m2 += m2_b + np.square(delta)*(self.weight*w_b/total)
+            self.weight = total
+
+        # The first 5 members set the markers, the others move them
+        head = min(5 - self.count, x.shape[0]) if self.count < 5 else 0
+        if head:
+            self._first[self.count:self.count+head] = x[:head]
+            self.count += head
+            if self.count == 5:
+                self._q[:] = np.sort(self._first, axis=0)
+                self._n[:] = np.arange(1.0, 6.0)[:, None]
+
+        if head < x.shape[0]:
+            self._update(self._q, self._n, self._desired, self._increment,
+                         np.ascontiguousarray(x[head:]))
+            self.count += x.shape[0] - head
+
+        return None
+
+    def result(self):
+        '''
+        Bands of the members added so far
+
+        Returns
+        -------
+        bands : OrderedDict
+        {p: np.ndarray [T]} for every tracked quantile (exact for less than 5
+        members, all NaN without any), then 'mean' and 'std', weighted by
+        the likelihoods of the members
+        '''
+        bands = OrderedDict()
+        for j, p in enumerate(self.quantiles):
+            if self.count >= 5:
+                bands[p] = self._q[j, 2].copy()
+            elif self.count:
+                bands[p] = np.percentile(self._first[:self.count], 100*p, axis=0)
+            else:
+                bands[p] = np.full(self.size, np.nan)
+
+        if self.weight > 0:
+            bands['mean'] = self.mean.copy()
+            bands['std'] = np.sqrt(self._m2/self.weight)
+        else:
+            bands['mean'] = bands['std'] = np.full(self.size, np.nan)
+
+        return bands
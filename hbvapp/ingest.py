@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+Server-side ingestion of the forcing CSV files.
+
+The raw file is read chunk by chunk with the C parser of pandas, honoring the
+separator and header row of the configuration, and each chunk is appended to
+float64 columns. The month of every row and, when the file has no tm column,
+the long-term mean air temperature of each month are derived on the way: the
+monthly sums are accumulated chunk by chunk and mapped onto the rows once the
+last chunk is read. The SHA-1 of the raw bytes is computed while reading and
+serves as the id of the dataset, see datasets.
+
+Forcings must be complete: a file missing a prec, temp or ep value (or a tm
+value, when it has a tm column) is rejected, since every state after the gap
+would be undefined. Missing q_rec values are kept as np.nan, the objective
+functions skip them.
+'''
+from __future__ import unicode_literals
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Forcing columns of the model, and the accepted names of the time column
+NUMERIC = ('prec', 'q_rec', 'temp', 'tm', 'ep')
+TIME = ('time', 'date')
+
+# Forcings without which the model cannot run
+REQUIRED = ('prec', 'temp', 'tm', 'ep')
+
+
+class HashingReader(object):
+	'''
+	File-like wrapper computing the SHA-1 of what is read through it
+	'''
+	def __init__(self, f):
+		self.f = f
+		self.sha1 = hashlib.sha1()
+
+	def read(self, n=-1):
+		chunk = self.f.read(n)
+		self.sha1.update(chunk)
+		return chunk
+
+	def __iter__(self):
+		for line in self.f:
+			self.sha1.update(line)
+			yield line
+
+
+def read_csv(f, separator=',', header=0, chunksize=2**16):
+	'''
+	Parse the CSV file f into columns.
+
+	Parameters
+	----------
+	f : file-like
+	Raw CSV file
+	separator : str, optional
+	Field separator
+	header : int, optional
+	Row of the column names, rows above it are skipped
+	chunksize : int, optional
+	Number of rows parsed at once
+
+	Returns
+	-------
+	columns : OrderedDict
+	'time' (unicode, 'YYYY-MM-DD HH:MM:SS'), 'prec', 'q_rec' (np.nan where
+	missing), 'temp', 'tm', 'ep' (float64) and 'month' (float64)
+	data_id : str
+	SHA-1 of the raw file
+
+	Raises ValueError if the file has no rows, no time column, or misses a
+	forcing column or value, see REQUIRED.
+	'''
+	reader = HashingReader(f)
+	chunks = dict((name, list()) for name in ('time', 'month') + NUMERIC)
+	month_sum, month_n = np.zeros(13), np.zeros(13)
+	has_tm = False
+	present = set()
+
+	for chunk in pd.read_csv(reader, sep=separator, header=header, chunksize=chunksize,
+							 skipinitialspace=True, engine='c' if len(separator) == 1 else 'python'):
+		chunk.columns = [str(c).strip().lower() for c in chunk.columns]
+
+		time = next((c for c in TIME if c in chunk.columns), None)
+		if time is None:
+			raise ValueError('The CSV file has no time column')
+
+		times = pd.to_datetime(chunk[time])
+		month = times.dt.month.values.astype(np.float64)
+		chunks['time'].append(times.dt.strftime('%Y-%m-%d %H:%M:%S').values.astype(np.unicode_))
+		chunks['month'].append(month)
+
+		present.update(chunk.columns)
+		for name in NUMERIC:
+			if name in chunk.columns:
+				values = pd.to_numeric(chunk[name], errors='coerce').values.astype(np.float64)
+			else:
+				values = np.full(len(chunk), np.nan)
+			chunks[name].append(values)
+
+		# Monthly sums of the air temperature for the long-term means
+		has_tm = has_tm or 'tm' in chunk.columns
+		valid = ~np.isnan(chunks['temp'][-1])
+		m = month[valid].astype(int)
+		month_sum += np.bincount(m, weights=chunks['temp'][-1][valid], minlength=13)
+		month_n += np.bincount(m, minlength=13)
+
+	columns = OrderedDict((name, np.concatenate(chunks[name]) if chunks[name] else np.array([]))
+						  for name in ('time',) + NUMERIC + ('month',))
+
+	if not len(columns['time']):
+		raise ValueError('The CSV file has no rows')
+
+	if not has_tm:
+		with np.errstate(invalid='ignore', divide='ignore'):
+			means = month_sum/month_n
+		columns['tm'] = means[columns['month'].astype(int)]
+
+	for name in REQUIRED:
+		if name not in present and (name != 'tm' or has_tm):
+			raise ValueError('The CSV file has no {0} column'.format(name))
+		missing = np.flatnonzero(np.isnan(columns[name]))
+		if missing.size:
+			raise ValueError('The CSV file has no {0} value in row {1}'.format(name, missing[0]+1))
+
+	return columns, reader.sha1.hexdigest()
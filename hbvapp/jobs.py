@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Background calibration jobs.
+
+Calibrations run on a local pool of worker threads (concurrent.futures), each
+on a model of its own, so that the request submitting a job returns at once
+with its id. The progress of a job is read from HBV96.progress while it runs,
+and a running job is cancelled through HBV96.cancel_requested.
+'''
+from __future__ import unicode_literals
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .hbvcore.hbv96 import CalibrationCancelled
+
+
+class Job(object):
+	'''
+	A calibration job: the model it calibrates, the key of its owner and the
+	future of the run
+	'''
+	def __init__(self, model, owner):
+		self.id = uuid.uuid4().hex
+		self.model = model
+		self.owner = owner
+		self.future = None
+		self.submitted = time.time()
+		self.started = None
+		self.finished = None
+
+	def run(self):
+		self.started = time.time()
+		try:
+			self.model.calibrate()
+		finally:
+			self.finished = time.time()
+
+	@property
+	def state(self):
+		'''
+		'queued', 'running', 'done', 'cancelled' or 'failed'
+		'''
+		if self.future.cancelled():
+			return 'cancelled'
+		if not self.future.done():
+			return 'running' if self.started else 'queued'
+
+		error = self.future.exception()
+		if error is None:
+			return 'done'
+		return 'cancelled' if isinstance(error, CalibrationCancelled) else 'failed'
+
+	def status(self):
+		'''
+		JSON-serializable summary of the job and of its progress
+		'''
+		status = {'job_id': self.id,
+				'state': self.state,
+				'submitted': self.submitted,
+				'started': self.started,
+				'finished': self.finished,
+				'progress': dict(self.model.progress),
+				'max_evals': self.model.config.get('max_evals')}
+
+		if status['state'] == 'failed':
+			status['error'] = repr(self.future.exception())
+
+		return status
+
+
+class JobQueue(object):
+	'''
+	Queue of calibration jobs run by max_workers threads. Finished jobs are
+	kept until their result is fetched, at most max_finished of them.
+	'''
+	def __init__(self, max_workers=2, max_finished=64):
+		self.max_finished = max_finished
+		self._executor = ThreadPoolExecutor(max_workers=max_workers)
+		self._jobs = OrderedDict()
+		self._lock = threading.Lock()
+
+	def submit(self, model, owner=None):
+		'''
+		Queue the calibration of model and return the job id
+		'''
+		job = Job(model, owner)
+		with self._lock:
+			self._prune()
+			self._jobs[job.id] = job
+			job.future = self._executor.submit(job.run)
+
+		return job.id
+
+	def get(self, job_id, owner=None):
+		'''
+		Job job_id of owner, KeyError if there is none
+		'''
+		job = self._jobs[job_id]
+		if job.owner != owner:
+			raise KeyError(job_id)
+
+		return job
+
+	def cancel(self, job_id, owner=None):
+		'''
+		Cancel a queued job, or ask a running one to stop at its next model
+		evaluation. Finished jobs are left as they are.
+		'''
+		job = self.get(job_id, owner)
+		if not job.future.cancel() and not job.future.done():
+			job.model.cancel_requested = True
+
+		return job.status()
+
+	def pop(self, job_id, owner=None):
+		'''
+		Remove a finished job from the queue and return it, its model ready
+		for new calibrations
+		'''
+		job = self.get(job_id, owner)
+		if not job.future.done():
+			raise ValueError('Job {0} is not finished'.format(job_id))
+
+		# A cancellation requested as the job finished must not stop the next run
+		job.model.cancel_requested = False
+
+		with self._lock:
+			self._jobs.pop(job_id, None)
+
+		return job
+
+	def _prune(self):
+		'''
+		Drop the oldest finished jobs beyond max_finished. Must be called with
+		self._lock held.
+		'''
+		finished = [key for key, job in self._jobs.items() if job.future.done()]
+		for key in finished[:max(len(finished) - self.max_finished, 0)]:
+			del self._jobs[key]
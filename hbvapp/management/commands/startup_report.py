@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+python manage.py startup_report
+
+Time the imports a worker pays before serving its first requests: the views
+(home page and simulations), then each stack the views only import on demand.
+Times are incremental, a module shared by several stages is charged to the
+first one importing it.
+'''
+from __future__ import unicode_literals
+import importlib
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+# Stages in the order a worker typically meets them
+STAGES = (
+	('views (home page, simulations)', ('hbvapp.views',)),
+	('compiled engine (Numba)', ('numba',)),
+	('pure-Python routing (scipy.signal)', ('scipy.signal',)),
+	('calibration (scipy.optimize)', ('scipy.optimize',)),
+	('CSV upload and binary results (pandas)', ('hbvapp.ingest', 'hbvapp.columnar')),
+	('plots (bokeh)', ('hbvapp.plots',)),
+	)
+
+
+class Command(BaseCommand):
+	help = 'Report the import time of the views and of the stacks they load on demand'
+
+	# System checks import the URLconf, hence the views, before the report
+	requires_system_checks = False
+
+	def handle(self, *args, **options):
+		total = 0.0
+		for name, modules in STAGES:
+			loaded = all(m in sys.modules for m in modules)
+			t0 = time.time()
+			for module in modules:
+				try:
+					importlib.import_module(module)
+				except ImportError:
+					pass
+			dt = time.time() - t0
+			total += dt
+
+			note = ' (already imported)' if loaded else ''
+			self.stdout.write('{0:<45}{1:8.3f} s{2}'.format(name, dt, note))
+
+		self.stdout.write('{0:<45}{1:8.3f} s'.format('total', total))
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+'''
+Bokeh plots of the simulation results, imported by the views on demand.
+'''
+from __future__ import unicode_literals
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from bokeh.embed import components
+from bokeh.models import LinearAxis, Legend, BoxZoomTool, HoverTool, PanTool, RedoTool, ResetTool, SaveTool, UndoTool, WheelZoomTool
+from bokeh.models.ranges import Range1d
+from bokeh.palettes import magma, plasma, viridis
+from bokeh.plotting import figure, ColumnDataSource
+
+from .hbvcore.metrics import roc_curve, auc
+
+# Number of run ids whose plots and quantiles are cached
+MAX_RUNS = getattr(settings, 'HBV_MAX_MODELS', 32)
+
+# Serializes the accesses to plot_cache and synthesized, shared by the
+# threads of the requests and of the calibration jobs
+_lock = threading.Lock()
+
+'''
+  ---------- Bokeh plots ------------
+'''
+def plot_simu_q(source):
+
+	hover = HoverTool(
+		names=['q_rec',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Simulated', '@q_sim{0.000 a}' ),
+	        ( 'Recorded', '@q_rec{0.000 a}' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='vline',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, 
+		responsive=True, x_axis_type='datetime')
+	p.title.text = "Simulation Flow Rate"
+
+	for series, name, color in zip(['q_rec', 'q_sim'], ['Measured Discharge', 'Simulated Discharge'], ['#404387', '#79D151']):
+		p.line('date', series, source=source, color=color, alpha=0.8, legend=name, name=series)
+
+	p.legend.location = "top_center"
+	p.legend.orientation = "horizontal"
+	p.legend.click_policy='hide'
+	
+	return p
+
+def plot_simu_p(source):
+
+	hover = HoverTool(
+		names=['sp',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Snow Pack', '@sp{0.000 a}' ),
+	        ( 'Precipitation', '@prec{0.000 a}' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='vline',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, responsive=True, x_axis_type='datetime')
+	p.title.text = "Precipitation Records and Simulated Snow Pack"
+
+	p.vbar(x='date', top='prec', bottom=0, width=1, source=source, color='#404387', 
+		alpha=0.8, legend='Precipitation   ', name='Precipitation')
+	p.line('date', 'sp', source=source, color='#79D151', 
+		alpha=0.8, line_width=2, legend='Snow Pack', name='sp')
+
+	p.legend.location = "top_center"
+	p.legend.orientation = "horizontal"
+	p.legend.click_policy= "hide"
+
+	return p
+
+def plot_simu_t(source):
+
+	hover = HoverTool(
+		names=['Temperature',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Measured Air Temperature', '@t{0.000 a}[°C]' ),
+	        ( 'Long-term Average', '@tm{0.000 a}[°C]' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='vline',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, responsive=True, x_axis_type='datetime')
+	p.title.text = "Air Temperature"
+
+	for series, name, color, alpha in zip(['t', 'tm'], ['Temperature', 'LTA'], ['#DD4968','#440154'], [0.9, 0.7]):
+		p.line('date', series, source=source, color=color, alpha=alpha, legend=name, name=name)
+
+	p.legend.location = "top_center"
+	p.legend.orientation = "horizontal"
+	p.legend.click_policy='hide'
+
+
+	return p
+
+def plot_simu_etp(source):
+
+	hover = HoverTool(
+		names=['sm',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Evaporation', '@ep{0.000 a}' ),
+	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
+	        ( 'Discharge', '@q_rec{0.000 a}' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='vline',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, 
+		responsive=True, x_axis_type='datetime')
+	p.title.text = "Evaporation and Soil Moisture"
+
+	for series, name, color in zip(['sm', 'ep', 'q_rec'], ['Soil Moisture', 'Measured Evaporation', 'Measured Discharge'], ['#79D151', '#DD4968', '#404387']):
+		p.line('date', series, source=source, color=color, alpha=0.8, legend=name, name=series)
+
+	p.legend.location = "top_center"
+	p.legend.orientation = "horizontal"
+	p.legend.click_policy='hide'
+	
+	return p
+
+def plot_simu_gw():
+	# To be implemented...
+		pass	
+
+def plot_simu_st(source):
+
+	hover = HoverTool(
+		names=['sm',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Snow Pack', '@sp{0.000 a}' ),
+	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
+	        ( 'Water Content', '@wc{0.000 a}' ),
+	        ( 'Upper Zone', '@uz{0.000 a}' ),
+	        ( 'Lower Zone', '@lz{0.000 a}' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='mouse',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, 
+		responsive=True, x_axis_type='datetime')
+	p.title.text = "Simulated States"
+
+	renderers = []
+	lines = ['sm', 'sp', 'wc', 'uz', 'lz']
+	names =  ['Soil Moisture', 'Snow Pack', 'Water Content', 'Upper Zone', 'Lower Zone']
+	colors = plasma(5)
+
+	for series, color in zip(lines, colors):
+		renderers.append([p.line('date', series, source=source, color=color, alpha=0.8, name=series)])
+
+	legend = Legend(
+		items=zip(names, renderers),
+		location="center",
+		orientation="horizontal",
+		click_policy="hide",
+		glyph_width = 40,
+		padding=10,
+		spacing=20,
+		border_line_width=1,
+		border_line_color='navy',
+		margin=20,
+		label_standoff=6
+		)
+	p.add_layout(legend, 'below')
+	
+	return p
+
+def plot_simu_st_without_snow(source):
+
+	hover = HoverTool(
+		names=['sm',],
+	    tooltips=[
+	        ( 'date', '@date{%F}' ),
+	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
+	        ( 'Upper Zone', '@uz{0.000 a}' ),
+	        ( 'Lower Zone', '@lz{0.000 a}' ), # use @{ } for field names with spaces
+	    ],
+	    formatters={
+	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
+	    },
+
+	    # display a tooltip whenever the cursor is vertically in line with a glyph
+	    mode='mouse',
+	)
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(),hover, SaveTool()]
+
+	p = figure(plot_width=800, plot_height=450, tools=tools, 
+		responsive=True, x_axis_type='datetime')
+	p.title.text = "Simulated States"
+
+	renderers = []
+	lines = ['sm', 'uz', 'lz']
+	names =  ['Soil Moisture', 'Upper Zone', 'Lower Zone']
+	colors = plasma(3)
+
+	for series, color in zip(lines, colors):
+		renderers.append([p.line('date', series, source=source, color=color, alpha=0.8, name=series)])
+
+	legend = Legend(
+		items=zip(names, renderers),
+		location="center",
+		orientation="horizontal",
+		click_policy="hide",
+		glyph_width = 40,
+		padding=10,
+		spacing=20,
+		border_line_width=1,
+		border_line_color='navy',
+		margin=20,
+		label_standoff=6
+		)
+	p.add_layout(legend, 'below')
+	
+	return p
+
+def plot_simu_perf(source):
+	from bokeh.layouts import gridplot
+
+	qq_plot = plot_qqplot(source)
+	roc_plot = plot_roc(source)
+	diff_plot = plot_diff(source)
+	grid = gridplot(children=[[diff_plot], [qq_plot, roc_plot]],
+		sizing_mode="scale_width")
+	return grid
+
+# Maximum number of points per glyph sent to the browser
+MAX_POINTS = 2000
+
+def lttb(x, y, n_out):
+	'''
+	Largest-Triangle-Three-Buckets downsampling of the series (x, y) to n_out
+	points, keeping its visual shape: the first and last points are kept and,
+	in each of the n_out-2 buckets in between, the point forming the largest
+	triangle with the point kept in the previous bucket and the mean of the
+	next bucket. NaN points are dropped first.
+	'''
+	valid = ~(np.isnan(x) | np.isnan(y))
+	x, y = x[valid], y[valid]
+	n = len(x)
+	if n <= n_out or n_out < 3:
+		return x, y
+
+	edges = np.linspace(1, n-1, n_out-1).astype(int)
+	kept = np.empty(n_out, dtype=int)
+	kept[0], kept[-1] = 0, n-1
+
+	for i in xrange(n_out-2):
+		lo, hi = edges[i], edges[i+1]
+		if i+2 < len(edges):
+			nxt = slice(hi, edges[i+2])
+			x_c, y_c = x[nxt].mean(), y[nxt].mean()
+		else:
+			x_c, y_c = x[-1], y[-1]
+		a = kept[i]
+		area = np.abs((x[a]-x_c)*(y[lo:hi]-y[a]) - (x[a]-x[lo:hi])*(y_c-y[a]))
+		kept[i+1] = lo + np.argmax(area)
+
+	return x[kept], y[kept]
+
+def plot_qqplot(source):
+	_range = len(source.data['qt_sim'])-1
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(), SaveTool()]
+
+	p = figure(plot_width=320, plot_height=320, tools=tools,
+			toolbar_location='above')
+	p.title.text = "Q-Q Plot"
+	p.xaxis.axis_label = "Simulated Discharge Quantile [-]"
+	p.yaxis.axis_label = "Recorded Discharge Quantile [-]"
+
+	# Quantiles are monotonous, evenly spaced ones are enough
+	ind = np.unique(np.linspace(0, _range, min(_range+1, MAX_POINTS)).astype(int))
+	qts = p.circle(x=np.asarray(source.data['qt_sim'])[ind], y=np.asarray(source.data['qt_rec'])[ind],
+		color='#404387', alpha=0.8, name='quantile', size=2)
+
+	straightline = p.line(x=[0, 1], y= [0, 1], color='red',
+		alpha=0.8, name='y=x', line_width=3)
+
+	legend = Legend(
+		items=[
+			('Q-norm', [qts]),
+			('y = x', [straightline]),
+			],
+		location=(170,0),
+		orientation="horizontal",
+		click_policy="hide",
+		glyph_width = 40,
+		padding=10,
+		spacing=20,
+		border_line_width=1,
+		border_line_color='navy',
+		margin=20,
+		label_standoff=6
+		)
+	p.add_layout(legend, 'below')
+	
+	return p
+
+def plot_roc(source):
+	'''
+	ROC curve of the binary hits qt_bin ranked by qt_sim, see hbvcore.metrics
+	'''
+	from bokeh.models import Label
+
+    # Compute ROC curve and area the curve
+	fpr, tpr, thresholds = roc_curve(source.data['qt_bin'], source.data['qt_sim'])
+	roc_auc = auc(fpr, tpr)
+
+	# The area is computed on the whole curve, the line is downsampled
+	fpr, tpr = lttb(fpr, tpr, MAX_POINTS)
+
+    # Ploting
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(), SaveTool()]
+
+	p = figure(plot_width=320, plot_height=320, tools=tools,
+			toolbar_location='above')
+	p.title.text = "ROC Curve"
+	p.xaxis.axis_label = "FPR (False Positive Rate) [-]"
+	p.yaxis.axis_label = "TPR (True Positive Rate) [-]"
+
+	roc = p.line(x=fpr, y=tpr, color='#404387', 
+		alpha=0.8, name='roc', line_width=2)
+
+	straightline = p.line(x=[0, 1], y= [0, 1], color='red',
+		alpha=0.8, name='y=x', line_width=3)
+
+	legend = Legend(
+		items=[
+			('ROC', [roc]),
+			('y = x', [straightline]),
+			],
+		location=(180, 0),
+		orientation="horizontal",
+		click_policy="hide",
+		glyph_width = 40,
+		padding=10,
+		spacing=20,
+		border_line_width=1,
+		border_line_color='navy',
+		margin=20,
+		label_standoff=6
+		)
+
+	_auc = Label(x=0.7, y=0.25, text_font_size='1.1em',
+		text_font_style='bold', text='AUC = {0:.3f}'.format(roc_auc))
+
+	p.add_layout(legend, 'below')
+	p.add_layout(_auc)
+	
+	return p
+
+def plot_diff(source):
+	import time
+
+	_range = len(source.data['diff'])-1
+	begin = source.data['time'][0]
+	end = source.data['time'][_range]
+	x_for_lines = [begin, end]
+	x_range = [time.mktime(begin.timetuple())*1000, 
+		time.mktime(end.timetuple())*1000]
+	tools = [PanTool(), WheelZoomTool(dimensions="width"),
+		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
+		ResetTool(), SaveTool()]
+
+	p = figure(plot_width=480, plot_height=200, tools=tools,
+			toolbar_location='above', x_axis_type="datetime",
+			x_range=x_range)
+	p.title.text = "Model Error"
+	p.xaxis.axis_label = "Time [-]"
+	p.yaxis.axis_label = "Qsim - Qobs [m³/s]"
+
+	# Long series are downsampled, see lttb
+	x, y = lttb(pd.to_datetime(source.data['time']).values.astype('datetime64[ms]').astype(np.float64),
+		np.asarray(source.data['diff'], dtype=np.float64), MAX_POINTS)
+	diff = p.circle(x=x, y=y, color='#404387', 
+		alpha=0.8, name='difference', size=2)
+
+	u = np.nanmean(source.data['diff'])
+	d = np.std(source.data['diff'])
+	u_3d = p.line(x= x_for_lines, y= [u+3*d, u+3*d], color='orangered',
+		alpha=1, name="u+3σ", line_width=2, line_dash="dotted")
+	_u_3d = p.line(x= x_for_lines, y= [u-3*d, u-3*d], color='orangered',
+		alpha=1, name="u+3σ", line_width=2, line_dash="dotted")
+	mean = p.line(x= x_for_lines, y= [u, u], color='orangered',
+		alpha=1, name='u', line_width=3)
+
+	legend = Legend(
+		items=[
+			("Qsim - Qobs [m³/s]", [diff]),
+			("mean", [mean]),
+			("u±3σ", [u_3d, _u_3d]),
+			],
+		location="top_center",
+		orientation="horizontal",
+		click_policy="hide",
+		glyph_width = 40,
+		padding=10,
+		spacing=20,
+		border_line_width=1,
+		border_line_color='navy',
+		margin=20,
+		label_standoff=6
+		)
+	p.add_layout(legend)
+	
+	return p
+
+# Plots of the performance pane by kind
+PLOTS = dict(
+	perf=plot_simu_perf,	# Grid of the three plots below
+	qq=plot_qqplot,
+	roc=plot_roc,
+	diff=plot_diff,
+	)
+
+# Script and div of the last plots of each run id, by (run id, kind)
+plot_cache = OrderedDict()
+
+def plot_simulation(simulation_result, key=None, kinds=('perf',)):
+	'''
+	Script and div of the plots of kinds (see PLOTS) for the results of a run,
+	its series {'time', 'q_sim', 'q_rec'}, as plots['script'][kind] and
+	plots['div'][kind]. The plots of the same run id are reused as long as
+	the discharges are unchanged.
+	'''
+	q_sim = np.asarray(simulation_result['q_sim'], dtype=np.float64)
+	q_rec = np.asarray(simulation_result['q_rec'], dtype=np.float64)
+	digest = digest_of(q_sim, q_rec)
+
+	source = None
+	plots = dict(script=dict(), div=dict())
+	for kind in kinds:
+		with _lock:
+			cached = plot_cache.pop((key, kind), None)
+		if cached is None or cached[0]!=digest:
+			if source is None:
+				source = synthesize_data(simulation_result, key)
+			cached = (digest,) + components(PLOTS[kind](source))
+
+		if key is not None:
+			with _lock:
+				plot_cache[(key, kind)] = cached
+				while len(plot_cache) > len(PLOTS)*MAX_RUNS:
+					plot_cache.popitem(last=False)
+
+		plots['script'][kind], plots['div'][kind] = cached[1:]
+
+	return plots
+
+def plot_all(source):
+	return None
+
+# Quantiles of the last results of each run id, see synthesize_data
+synthesized = OrderedDict()
+
+def synthesize_data(simulation_result, key=None):
+	data = pd.DataFrame(simulation_result)
+	q_sim = data['q_sim'].values.astype(np.float64)
+	q_rec = data['q_rec'].values.astype(np.float64)
+
+	''' ---------- Calculate Quantile ---------- '''
+	# Results of the same run id are reused as long as the discharges are unchanged
+	digest = digest_of(q_sim, q_rec)
+	with _lock:
+		cached = synthesized.pop(key, None)
+		if cached is not None and cached[0]==digest:
+			synthesized[key] = cached
+		else:
+			cached = None
+	if cached is not None:
+		quantiles = cached[1]
+	else:
+		quantiles = quantiles_of(q_sim, q_rec)
+		if key is not None:
+			with _lock:
+				synthesized.pop(key, None)
+				synthesized[key] = (digest, quantiles)
+				while len(synthesized) > MAX_RUNS:
+					synthesized.popitem(last=False)
+	''' ---------- Calculate Quantile END ---------- '''
+
+	''' ----- Convert all np.nan values into "NaN" for Javascript -----'''
+
+	source = ColumnDataSource(data=dict(
+		time=pd.to_datetime(data['time']),	# Date
+		# q_rec=data['q_rec'],				# Measured discharge
+		# q_sim=data['q_sim'],				# Simulated discharge
+		diff=(data['q_sim']-data['q_rec']), # Bias of the model, difference between simulated and measured discharge
+		# prec=data['prec'],					# Precipitation
+		# sp=data['sp'],						# Simulated snow pack
+		# diff_temp=data['temp']-data['tm'],	# Difference 
+		# t=data['temp'],						# Air temperature
+		# tm=data['tm'],						# Long-term averaged air temperature
+		# sm=data['sm'],						# Soil moisture
+		# ep=data['ep'],						# Recorded evaporation
+		# wc=data['wc'],						# Water content
+		# uz=data['uz'],						# Upper zone value
+		# lz=data['lz'],						# Lower zone value
+		**quantiles							# qt_rec, qt_sim and qt_bin, see quantiles_of
+	))
+	return source
+
+def digest_of(q_sim, q_rec):
+	'''
+	Digest identifying the results of a run by their discharges
+	'''
+	return hashlib.sha1(q_sim.tobytes() + q_rec.tobytes()).hexdigest()
+
+def quantiles_of(q_sim, q_rec):
+	'''
+	Quantiles of the sorted simulated discharges in the recorded ones (qt_rec)
+	and in the simulated ones (qt_sim), by binary search in the sorted records,
+	and the binary series of the ROC curve (qt_bin): 1 where the simulated
+	discharge is within 10% of the recorded one. NaN records or simulations
+	count as misses, zero records are only hit by zero simulations.
+	'''
+	n = len(q_sim)
+	asc_qsim = np.sort(q_sim)
+
+	# Share of records lower than or equal to each value, NaN never is
+	qt_rec = np.searchsorted(np.sort(q_rec), asc_qsim, side='right')/float(max(n, 1))
+	qt_rec[np.isnan(asc_qsim)] = 0.0
+	qt_sim = np.arange(1, n+1)/float(max(n, 1))
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		error = np.abs(q_rec-q_sim)
+		qt_bin = np.where(q_rec!=0, error/np.abs(q_rec)<0.1, error==0).astype(int)
+
+	return dict(
+		qt_rec=qt_rec,						# Quantiles for simulated values in recorded values
+		qt_sim=qt_sim,						# Quantiles for simulated values in simulated values
+		qt_bin=qt_bin,						# Binary array for roc curve
+	)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+Registry of the HBV96 models of the application, one per session or run id.
+
+Every model lives in its own entry with its own lock, so that requests of
+different users run in parallel worker threads while requests of the same user
+are serialized. Least recently used models are evicted when the registry holds
+more than max_models models or more than max_bytes of data.
+
+The registry is local to a process: when the application is served by several
+worker processes, requests of a session must be routed to the same process
+(sticky sessions), otherwise each process builds its own model.
+'''
+from __future__ import unicode_literals
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def model_nbytes(model):
+	'''
+	Approximate memory footprint of a model in bytes: its float64 columns and
+	its lists of per-time-step dictionaries. Memory-mapped columns are not
+	counted, they are paged from their store.
+	'''
+	nbytes = 0
+	for columns in (model.columns, model.inters):
+		nbytes += sum(a.nbytes for a in columns.values()
+			if isinstance(a, np.ndarray) and not isinstance(a, np.memmap))
+
+	for rows in model.held_rows():
+		if rows:
+			# Every row holds the same keys, each value a boxed float
+			nbytes += len(rows)*(sys.getsizeof(rows[0]) + 24*len(rows[0]))
+
+	return nbytes
+
+
+class _Entry(object):
+	'''
+	A model, the lock serializing its requests and its last measured size
+	'''
+	def __init__(self, model):
+		self.model = model
+		self.lock = threading.Lock()
+		self.nbytes = 0
+		self.users = 0
+
+
+class ModelRegistry(object):
+	'''
+	LRU registry of models keyed by session or run id.
+
+	Parameters
+	----------
+	factory : function
+	Builds a new model for an unknown key
+	max_models : int, optional
+	Maximum number of models kept
+	max_bytes : int, optional
+	Maximum memory held by the models, see model_nbytes
+	'''
+	def __init__(self, factory, max_models=32, max_bytes=512*2**20):
+		self.factory = factory
+		self.max_models = max_models
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	@property
+	def nbytes(self):
+		return sum(entry.nbytes for entry in self._entries.values())
+
+	@contextmanager
+	def session(self, key):
+		'''
+		Hold the model of key for the duration of a request, creating it if
+		needed. Models are measured and the limits enforced on release.
+		'''
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				entry = _Entry(self.factory())
+			self._entries[key] = entry
+			entry.users += 1
+
+		try:
+			with entry.lock:
+				yield entry.model
+				entry.nbytes = model_nbytes(entry.model)
+		finally:
+			with self._lock:
+				entry.users -= 1
+				self._evict()
+
+	def replace(self, key, model):
+		'''
+		Make model the model of key, e.g. a model calibrated in the background.
+		The model is measured and the limits enforced at once.
+		'''
+		nbytes = model_nbytes(model)
+		with self._lock:
+			entry = self._entries.pop(key, None) or _Entry(model)
+			entry.model = model
+			entry.nbytes = nbytes
+			self._entries[key] = entry
+			self._evict()
+
+	def discard(self, key):
+		'''
+		Drop the model of key, if any
+		'''
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def _evict(self):
+		'''
+		Drop least recently used models not in use until the limits hold.
+		Must be called with self._lock held.
+		'''
+		nbytes = self.nbytes
+		for key in list(self._entries):
+			if len(self._entries) <= self.max_models and nbytes <= self.max_bytes:
+				break
+
+			entry = self._entries[key]
+			if entry.users:
+				continue
+
+			del self._entries[key]
+			nbytes -= entry.nbytes
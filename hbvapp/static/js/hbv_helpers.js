@@ -262,10 +262,87 @@ function deploy_plots (plots) {
   // $("#id_pane_plot_st").html(plots.div.st);
   // $(".jslocator_st").next().replaceWith(plots.script.st);
 
-  $("#id_pane_plot_perf").html(plots.div.perf);
+  $("#id_plot_perf").html(plots.div.perf);
   $(".jslocator_perf").next().replaceWith(plots.script.perf);
 }
 
+function show_scores (scores) {
+  /*
+    Show the scorecard of the last run (RMSE, NSE, KGE, ...) above the
+    performance plots, '-' where a metric is undefined
+  */
+  var head = '', body = '';
+  for (var name in scores) {
+    head += '<th>' + name + '</th>';
+    body += '<td>' + (scores[name] === null ? '-' : scores[name].toFixed(3)) + '</td>';
+  }
+  $("#id_scores").html('<table class="table table-condensed text-center"><tr>' + head +
+                       '</tr><tr>' + body + '</tr></table>');
+}
+
+function request_plots (kinds) {
+  /*
+    Request the Bokeh plots of kinds ('perf', 'qq', 'roc', 'diff') of the last
+    run, built on demand by the server, and deploy them
+  */
+  $.ajax({
+    url: "",
+    type: "POST",
+    async: true,
+    data: {'action': 'plot', 'kinds': JSON.stringify(kinds)},
+    success: function(data){
+      deploy_plots(data.plots);
+    },
+    error: ajax_error
+  });
+}
+
+function request_bands (n, objective, threshold) {
+  /*
+    Request the GLUE uncertainty bands of the simulated discharge over n
+    parameter sets, behavioural above threshold of objective ('NSE', 'KGE',
+    'log-NSE', or below it for 'RMSE'), and show them on the discharge plot
+  */
+  $(".loadercontainer").fadeIn(200);
+  $.ajax({
+    url: "",
+    type: "POST",
+    async: true,
+    data: {'config': JSON.stringify(generate_config_dict()),
+           'par': JSON.stringify(generate_par_dict('simulate')),
+           'data_id': hbv.d.data_id || '',
+           'data': hbv.d.data_id ? '' : JSON.stringify(hbv.d.init_data),
+           'n': n, 'objective': objective, 'threshold': threshold,
+           'action': 'uncertainty'},
+    success: function(data){
+      show_bands(data.bands);
+      $(".loadercontainer").fadeOut(300);
+    },
+    error: ajax_error
+  });
+}
+
+function show_bands (bands) {
+  /*
+    Add the 5-95% band (filled) and the median of the GLUE run to the
+    discharge plot, replacing the bands shown before
+  */
+  var div = hbv.p.div_q,
+      time = hbv.d.data[0].time,
+      band = {type: 'scatter', mode: 'lines', x: time, line: {width: 0},
+              hoverlabel: {font: {size: 12}, namelength: -1}, showlegend: false};
+
+  while (div.data.length > 2) { Plotly.deleteTraces(div, -1); }
+  Plotly.addTraces(div, [
+    $.extend({}, band, {y: bands['0.05'], name: "5%"}),
+    $.extend({}, band, {y: bands['0.95'], name: "95%", fill: 'tonexty',
+                        fillcolor: 'rgba(13,229,92,0.2)', showlegend: true,
+                        legendgroup: 'bands'}),
+    $.extend({}, band, {y: bands['0.5'], name: "Median [m<sup>3</sup>/s]",
+                        line: {width: 1, dash: 'dot', color: '#0b9c41'}}),
+  ]);
+}
+
 function enable_timepickers (success) {
 
   if (success) {
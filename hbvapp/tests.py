@@ -1,6 +1,1127 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import hashlib
+import io
+import json
+import pickle
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
 
-from django.test import TestCase
+import numpy as np
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase
 
-# Create your tests here.
+from .hbvcore import engine, hbv96, metrics, optimizers, sensitivity, storage
+from .hbvcore.engine import FLUXES, HAS_NUMBA, STATES
+from .hbvcore.hbv96 import HBV96
+from .hbvcore.uncertainty import Bands
+from .hbvcore.cache import SimulationCache
+from .datasets import DatasetStore
+from .registry import ModelRegistry, model_nbytes
+from .jobs import JobQueue
+from . import ingest
+from . import columnar, views
+
+try:
+	from sklearn import metrics as sk_metrics
+except ImportError:
+	sk_metrics = None
+
+# Columnar engines, compiled or not
+ENGINES = ('array', 'numba') if HAS_NUMBA else ('array',)
+
+PAR = {'rfcf': 1.0, 'sfcf': 0.9, 'ltt': -0.5, 'utt': 1.0, 'ttm': 0.5, 'cfmax': 0.2, 'cwh': 0.05,
+	'cfr': 0.05, 'fc': 200.0, 'e_corr': 1.0, 'etf': 0.1, 'lp': 0.3, 'beta': 2.0, 'k': 0.005,
+	'k1': 0.0005, 'alpha': 0.3, 'c_flux': 0.02, 'perc': 0.05, 'tfac': 24.0, 'area': 500.0, 'mbas': 4}
+
+CONFIG = {'warm_up': 10, 'obj_fun': 'RMSE', 'tol': 1e-4, 'minimise': True, 'verbose': False,
+	'fun_name': 'RMSE', 'kill_snow': False, 'calibrate_from': {'index': 0},
+	'calibrate_to': {'index': 300}, 'calibrate_all_par': True, 'par_to_calibrate': [],
+	'init_guess': True}
+
+
+def make_data(n, seed=0):
+	'''
+	Rows of n time steps of synthetic forcings, freezing and thawing
+	'''
+	rs = np.random.RandomState(seed)
+	t = np.arange(n)
+	temp = 5 + 10*np.sin(2*np.pi*t/365.0) + 3*rs.randn(n)
+	prec = np.where(rs.rand(n) < 0.2, rs.exponential(3, n), 0.0)
+	ep = 0.1 + 0.05*np.sin(2*np.pi*t/365.0)
+	q_rec = 2 + 3*np.convolve(prec, np.ones(10)/10.0, 'same') + rs.rand(n)
+	return [{'time': '2000-01-01 00:00:00', 'prec': prec[i], 'temp': temp[i], 'tm': 5.0,
+		'ep': ep[i], 'q_rec': q_rec[i]} for i in range(n)]
+
+
+def make_model(n=500, **config):
+	model = HBV96()
+	model.data = make_data(n)
+	model.par.update(PAR)
+	model.config.update(CONFIG)
+	model.config.update(config)
+	return model
+
+
+class EngineTests(SimpleTestCase):
+	'''
+	Columnar engines against the dictionary engine
+	'''
+	def test_same_results(self):
+		for kill_snow in (False, True):
+			reference = make_model(engine='dict', kill_snow=kill_snow)
+			reference._simulate_without_calibration()
+			for engine in ENGINES:
+				model = make_model(engine=engine, kill_snow=kill_snow)
+				model._simulate_without_calibration()
+				for key in STATES + ('q_sim',):
+					np.testing.assert_allclose([d[key] for d in model.data],
+						[d[key] for d in reference.data], rtol=1e-12, atol=1e-12)
+				np.testing.assert_allclose([d['gw'] for d in model.int_tab],
+					[d['gw'] for d in reference.int_tab], rtol=1e-12, atol=1e-12)
+				self.assertEqual([sorted(d) for d in model.int_tab], [sorted(d) for d in reference.int_tab])
+
+	def test_rows_on_demand(self):
+		model = make_model(engine='array')
+		model._simulate_without_calibration()
+		self.assertNotIn('q_sim', model.held_rows()[0][1])
+		self.assertEqual(model.data[1]['q_sim'], model.columns['q_sim'][1])
+
+
+class RecordTests(SimpleTestCase):
+	'''
+	Series recorded by the columnar engines, see HBV96._recording
+	'''
+	def setUp(self):
+		self.references = dict()
+		for engine in ENGINES:
+			self.references[engine] = make_model(engine=engine)
+			self.references[engine]._simulate_without_calibration()
+
+	def simulate(self, engine, **config):
+		model = make_model(engine=engine, **config)
+		model._simulate_without_calibration()
+		self.reference = self.references[engine]
+		np.testing.assert_array_equal(model.columns['q_sim'], self.reference.columns['q_sim'])
+		self.assertEqual(len(model.data), 500)
+		return model
+
+	def test_policies(self):
+		for engine in ENGINES:
+			for record, states, fluxes in (('all', STATES, FLUXES), ('states', STATES, ()), ('none', (), ()),
+					(['sm', 'gw', 'melt'], ('sm',), ('gw', 'melt'))):
+				model = self.simulate(engine, record=record)
+				self.assertEqual(sorted(set(model.columns) & set(STATES)), sorted(states))
+				self.assertEqual(sorted(model.inters), sorted(fluxes))
+				for name in states:
+					np.testing.assert_array_equal(model.columns[name], self.reference.columns[name])
+					self.assertEqual(model.data[7][name], self.reference.data[7][name])
+				for name in fluxes:
+					np.testing.assert_array_equal(model.inters[name], self.reference.inters[name])
+				for name in set(STATES) - set(states):
+					self.assertNotIn(name, model.data[7])
+				self.assertEqual(len(model.int_tab), 499 if fluxes else 0)
+
+	def test_every(self):
+		for engine in ENGINES:
+			model = self.simulate(engine, record_every=3)
+			self.assertEqual(len(model.columns['sm']), 167)
+			self.assertEqual(len(model.inters['gw']), 167)
+			np.testing.assert_array_equal(model.columns['sm'], self.reference.columns['sm'][::3])
+			np.testing.assert_array_equal(model.inters['gw'], self.reference.inters['gw'][::3])
+
+			# Rows of every time step, the recorded values at steps 0, 3, 6...
+			self.assertEqual(len(model.int_tab), 499)
+			self.assertEqual(model.data[6]['sm'], self.reference.data[6]['sm'])
+			self.assertNotIn('sm', model.data[7])
+			self.assertEqual(model.int_tab[6]['gw'], self.reference.int_tab[6]['gw'])
+			self.assertEqual(model.int_tab[7], {})
+
+			# Columns of the length of the data, NaN where not recorded
+			columns = columnar.model_columns(model, ['q_sim', 'sm', 'gw'])
+			self.assertEqual(set(len(a) for a in columns.values()), set([500]))
+			reference = columnar.model_columns(self.reference, ['q_sim', 'sm', 'gw'])
+			for name in ('sm', 'gw'):
+				np.testing.assert_array_equal(columns[name][::3], reference[name][::3])
+				self.assertTrue(np.isnan(columns[name][1::3]).all())
+			self.assertEqual(len(model.inters['gw']), 167)
+
+class BatchTests(SimpleTestCase):
+	'''
+	HBV96.simulate_batch against one simulation per member
+	'''
+	def test_members(self):
+		rs = np.random.RandomState(4)
+		base = np.array([PAR[key] for key in HBV96._ind[:18]])
+		par_matrix = base*rs.uniform(0.8, 1.2, (5, 18))
+
+		for kill_snow in (False, True):
+			expected = list()
+			for row in par_matrix:
+				model = make_model(engine='array', kill_snow=kill_snow)
+				model.par.update(zip(HBV96._ind[:18], row))
+				model._simulate_without_calibration()
+				expected.append(model.columns['q_sim'])
+			self.assertTrue(np.isfinite(expected).all())
+
+			for engine in ENGINES:
+				for chunk_size in (None, 2):
+					model = make_model(engine=engine, kill_snow=kill_snow)
+					q_sim = model.simulate_batch(par_matrix, chunk_size)
+					self.assertEqual(q_sim.shape, (5, 500))
+					np.testing.assert_allclose(q_sim, expected, rtol=1e-10, atol=1e-12)
+
+def routing_reference(gw, qdr, MAXBAS, area, tfac):
+	'''
+	Routed gw and q_sim of the original routing loop of HBV96
+	'''
+	c = engine.maxbas_weights(MAXBAS).tolist()
+	gw, q_sim = list(gw), [np.nan]*len(gw)
+	for t in range(MAXBAS, len(gw)):
+		_gw_routing = 0.0
+		for k in range(MAXBAS):
+			_gw_routing += gw[t-k] * c[k]
+		gw[t] = _gw_routing
+		q_sim[t] = area*(_gw_routing + qdr[t])/(3.6*tfac)
+	return np.array(gw), np.array(q_sim)
+
+
+class RoutingTests(SimpleTestCase):
+	'''
+	engine.route and route_loop against the original routing loop
+	'''
+	MAXBAS = (1, 2, 3, 4, 5, 7)
+
+	def setUp(self):
+		rs = np.random.RandomState(5)
+		self.gw = rs.exponential(1.0, (200, 3))
+		self.qdr = rs.exponential(0.1, (200, 3))
+
+	def test_weights(self):
+		for MAXBAS in self.MAXBAS:
+			c = engine.maxbas_weights(MAXBAS)
+			self.assertEqual(len(c), MAXBAS)
+			self.assertAlmostEqual(c.sum(), 1.0)
+			self.assertIs(engine.maxbas_weights(MAXBAS), c)
+
+	def test_route(self):
+		for MAXBAS in self.MAXBAS:
+			c = engine.maxbas_weights(MAXBAS)
+			expected = [routing_reference(self.gw[:, j], self.qdr[:, j], MAXBAS, 500.0, 24.0) for j in range(3)]
+
+			# Series, and ensembles along the first axis
+			for j in range(3):
+				gw, q_sim = self.gw[:, j].copy(), np.full(200, np.nan)
+				engine.route(gw, self.qdr[:, j], q_sim, c, 500.0, 24.0)
+				np.testing.assert_allclose(gw, expected[j][0], rtol=1e-12)
+				np.testing.assert_allclose(q_sim, expected[j][1], rtol=1e-12)
+
+			gw, q_sim = self.gw.copy(), np.full((200, 3), np.nan)
+			engine.route(gw, self.qdr, q_sim, c, 500.0, 24.0)
+			np.testing.assert_allclose(gw.T, [e[0] for e in expected], rtol=1e-12)
+			np.testing.assert_allclose(q_sim.T, [e[1] for e in expected], rtol=1e-12)
+
+			# Segment by segment
+			gw, q_sim = self.gw[:, 0].copy(), np.full(200, np.nan)
+			for start, stop in ((0, 3), (3, 50), (50, 200)):
+				engine.route(gw, self.qdr[:, 0], q_sim, c, 500.0, 24.0, start, stop)
+			np.testing.assert_allclose(gw, expected[0][0], rtol=1e-12)
+
+	def test_route_loop(self):
+		kernels = (engine.route_loop, engine.route_jit) if HAS_NUMBA else (engine.route_loop,)
+		for MAXBAS in self.MAXBAS:
+			c = engine.maxbas_weights(MAXBAS)
+			expected = routing_reference(self.gw[:, 0], self.qdr[:, 0], MAXBAS, 500.0, 24.0)
+			for kernel in kernels:
+				gw, q_sim = self.gw[:, 0].copy(), np.full(200, np.nan)
+				self.assertEqual(kernel(gw, self.qdr[:, 0], q_sim, c, 500.0, 24.0, np.inf, 0, 200), -1)
+				np.testing.assert_allclose(gw, expected[0], rtol=1e-12)
+				np.testing.assert_allclose(q_sim, expected[1], rtol=1e-12)
+
+				# Stops at the first step above tol
+				t = kernel(self.gw[:, 0].copy(), self.qdr[:, 0], np.full(200, np.nan), c, 500.0, 24.0,
+					np.nanmax(expected[1][:100]) - 1e-9, 0, 200)
+				self.assertEqual(t, np.nanargmax(expected[1][:100]))
+
+	def test_model_routing(self):
+		# Routing of the rows of the dictionary engine
+		for MAXBAS in self.MAXBAS:
+			model = make_model(n=201, engine='dict')
+			model.par['mbas'] = MAXBAS
+			model.int_tab = [{'gw': gw, 'qdr': qdr} for gw, qdr in zip(self.gw[:, 0], self.qdr[:, 0])]
+			model.config['miles'] = 200
+			model._routing()
+
+			gw, q_sim = routing_reference(self.gw[:, 0], self.qdr[:, 0], MAXBAS, 500.0, 24.0)
+			np.testing.assert_allclose([d['gw'] for d in model.int_tab], gw, rtol=1e-12)
+			# With MAXBAS 1, q_sim is left as computed by the time step
+			if MAXBAS > 1:
+				np.testing.assert_allclose([d['q_sim'] for d in model.data[MAXBAS:200]], q_sim[MAXBAS:], rtol=1e-12)
+
+class OptimizerTests(SimpleTestCase):
+	'''
+	Global optimizers on a quadratic, with a fixed budget and seed
+	'''
+	minimum = np.array([0.3, -1.2, 2.0, 0.5])
+
+	def quadratic(self, population, threshold=None):
+		self.assertTrue(((population >= -5) & (population <= 5)).all())
+		self.nfev += len(population)
+		return np.square(population - self.minimum).sum(axis=1)
+
+	def test_quadratic(self):
+		for name, optimizer in sorted(optimizers.OPTIMIZERS.items()):
+			self.nfev = 0
+			result = optimizer(self.quadratic, [-5]*4, [5]*4, max_evals=3000, random_state=0)
+
+			self.assertEqual(result['nfev'], self.nfev, name)
+			self.assertLessEqual(result['nfev'], 3000, name)
+			self.assertLess(result['fun'], 1e-3, name)
+			np.testing.assert_allclose(result['x'], self.minimum, atol=0.05, err_msg=name)
+			self.assertTrue((np.diff(result['trace']) <= 0).all(), name)
+
+			# Same seed, same result
+			again = optimizer(self.quadratic, [-5]*4, [5]*4, max_evals=3000, random_state=0)
+			self.assertEqual(again['x'], result['x'], name)
+			self.assertEqual(again['fun'], result['fun'], name)
+
+	def test_budget(self):
+		# The budget is never exceeded, whatever step it runs out in
+		for name, optimizer in sorted(optimizers.OPTIMIZERS.items()):
+			for max_evals in range(60, 400, 7):
+				self.nfev = 0
+				result = optimizer(self.quadratic, [-5]*4, [5]*4, max_evals=max_evals, random_state=max_evals)
+				self.assertEqual(result['nfev'], self.nfev, name)
+				self.assertLessEqual(result['nfev'], max_evals, name)
+
+class CheckpointTests(SimpleTestCase):
+	'''
+	Warm starts from checkpoints and advance against whole simulations
+	'''
+	def test_warm_start(self):
+		for engine in ENGINES:
+			model = make_model(engine=engine, checkpoints=[2, 150, 400])
+			model._simulate_without_calibration()
+			expected = dict((key, model.columns[key].copy()) for key in STATES + ('q_sim',))
+
+			for t in (2, 150, 400):
+				model.config['warm_start'] = t
+				model._simulate_without_calibration()
+				for key in STATES + ('q_sim',):
+					np.testing.assert_allclose(model.columns[key][t:], expected[key][t:], rtol=1e-12)
+				self.assertTrue(np.isnan(model.columns['q_sim'][:t]).all())
+
+				# Undefined values of the rows before the checkpoint are sent as null
+				rows = views.json_rows(model.data)
+				json.dumps(rows, allow_nan=False)
+				json.dumps(views.json_rows(model.int_tab), allow_nan=False)
+				self.assertIsNone(rows[t-1]['q_sim'])
+				self.assertEqual(rows[t]['q_sim'], expected['q_sim'][t])
+
+	def test_advance(self):
+		data = make_data(400)
+		for engine in ENGINES:
+			for MAXBAS in (1, 4, 7):
+				reference = make_model(engine=engine)
+				reference.data = [dict(row) for row in data]
+				reference.par['mbas'] = MAXBAS
+				reference._simulate_without_calibration()
+
+				model = make_model(engine=engine)
+				model.data = [dict(row) for row in data[:3]]
+				model.par['mbas'] = MAXBAS
+				model._simulate_without_calibration()
+				i = 3
+				for k in (1, 1, 5, 24, 366):
+					rows, inters = model.advance([dict(row) for row in data[i:i+k]])
+					self.assertEqual((len(rows), len(inters)), (k, k))
+					i += k
+
+				self.assertEqual(model.config['miles'], 399)
+				for key in STATES + ('q_sim',):
+					np.testing.assert_allclose([d[key] for d in model.data], [d[key] for d in reference.data], rtol=1e-12)
+				np.testing.assert_allclose([d['gw'] for d in model.int_tab], [d['gw'] for d in reference.int_tab], rtol=1e-12)
+
+class RocTests(SimpleTestCase):
+	'''
+	metrics.roc_curve and metrics.auc against values computed by sklearn 0.20
+	'''
+	# y_true, y_score, drop_intermediate, then sklearn's fpr, tpr, thresholds and AUC
+	CASES = (
+		([0, 0, 1, 1, 0, 0, 0, 1, 1, 1, 0, 1],
+			[0.13, 0.21, 0.05, 0.28, 0.03, 0.46, 0.65, 0.28, 0.68, 0.59, 0.02, 0.56], True,
+			np.array([0, 0, 1, 1, 2, 2, 4, 4, 6])/6.0,
+			np.array([0, 1, 1, 3, 3, 5, 5, 6, 6])/6.0,
+			[1.68, 0.68, 0.65, 0.56, 0.46, 0.28, 0.13, 0.05, 0.02], 13/18.0),
+		([0, 0, 1, 1, 0, 0, 0, 1, 1, 1, 0, 1],
+			[0.13, 0.21, 0.05, 0.28, 0.03, 0.46, 0.65, 0.28, 0.68, 0.59, 0.02, 0.56], False,
+			np.array([0, 0, 1, 1, 1, 2, 2, 3, 4, 4, 5, 6])/6.0,
+			np.array([0, 1, 1, 2, 3, 3, 5, 5, 5, 6, 6, 6])/6.0,
+			[1.68, 0.68, 0.65, 0.59, 0.56, 0.46, 0.28, 0.21, 0.13, 0.05, 0.03, 0.02], 13/18.0),
+		# Tied scores
+		([0, 0, 1, 0, 1, 1, 1, 1, 0, 0, 1, 1],
+			[0.0, 0.25, 0.25, 0.5, 0.5, 0.5, 0.75, 1.0, 1.0, 0.25, 0.75, 0.0], True,
+			np.array([0, 1, 1, 2, 4, 5])/5.0,
+			np.array([0, 1, 3, 5, 6, 7])/7.0,
+			[2.0, 1.0, 0.75, 0.5, 0.25, 0.0], 22/35.0),
+		([0, 0, 1, 0, 1, 1, 1, 1, 0, 0, 1, 1],
+			[0.0, 0.25, 0.25, 0.5, 0.5, 0.5, 0.75, 1.0, 1.0, 0.25, 0.75, 0.0], False,
+			np.array([0, 1, 1, 2, 4, 5])/5.0,
+			np.array([0, 1, 3, 5, 6, 7])/7.0,
+			[2.0, 1.0, 0.75, 0.5, 0.25, 0.0], 22/35.0),
+	)
+
+	def test_reference_values(self):
+		for y_true, y_score, drop_intermediate, fpr, tpr, thresholds, area in self.CASES:
+			actual = metrics.roc_curve(y_true, y_score, drop_intermediate=drop_intermediate)
+			for e, a in zip((fpr, tpr, thresholds), actual):
+				np.testing.assert_allclose(a, e, rtol=1e-12)
+			self.assertAlmostEqual(metrics.auc(actual[0], actual[1]), area, places=12)
+
+	def test_perfect_and_inverse(self):
+		y_true = np.array([0, 0, 1, 1])
+		fpr, tpr, _ = metrics.roc_curve(y_true, [0.1, 0.2, 0.8, 0.9])
+		self.assertEqual(metrics.auc(fpr, tpr), 1.0)
+		fpr, tpr, _ = metrics.roc_curve(y_true, [0.9, 0.8, 0.2, 0.1])
+		self.assertEqual(metrics.auc(fpr, tpr), 0.0)
+
+
+@unittest.skipIf(sk_metrics is None, 'sklearn is not installed')
+class SklearnRocTests(SimpleTestCase):
+	'''
+	metrics.roc_curve and metrics.auc against sklearn, when installed
+	'''
+	def assertSameRoc(self, y_true, y_score, drop_intermediate=True):
+		expected = sk_metrics.roc_curve(y_true, y_score, drop_intermediate=drop_intermediate)
+		actual = metrics.roc_curve(y_true, y_score, drop_intermediate=drop_intermediate)
+		for e, a in zip(expected, actual):
+			np.testing.assert_allclose(a, e)
+
+		self.assertAlmostEqual(metrics.auc(actual[0], actual[1]), sk_metrics.auc(expected[0], expected[1]))
+
+	def test_random_scores(self):
+		rs = np.random.RandomState(0)
+		for n in (2, 10, 1000):
+			y_true = rs.randint(0, 2, n)
+			y_true[:2] = 0, 1
+			y_score = rs.normal(size=n)
+			self.assertSameRoc(y_true, y_score)
+			self.assertSameRoc(y_true, y_score, drop_intermediate=False)
+
+	def test_tied_scores(self):
+		rs = np.random.RandomState(1)
+		y_true = rs.randint(0, 2, 500)
+		y_score = rs.randint(0, 5, 500)/4.0
+		self.assertSameRoc(y_true, y_score)
+		self.assertSameRoc(y_true, y_score, drop_intermediate=False)
+
+	def test_plot_quantiles(self):
+		# Series of the ROC plot: hits of a simulation ranked by quantiles
+		rs = np.random.RandomState(2)
+		q_rec = rs.gamma(2.0, 10.0, 2000)
+		q_sim = q_rec*rs.normal(1.0, 0.1, 2000)
+		y_true = (np.abs(q_rec - q_sim)/q_rec < 0.1).astype(int)
+		y_score = np.arange(1, 2001)/2000.0
+		self.assertSameRoc(y_true, y_score)
+
+
+def quantiles_reference(q_sim, q_rec):
+	'''
+	Quantiles of the original loops of synthesize_data
+	'''
+	def f_q(value, vec):
+		_count = 0
+		for v in vec:
+			if value >= v: _count+=1
+		return _count/float(len(vec))
+
+	with np.errstate(invalid='ignore'):
+		qt_rec = [f_q(q, q_rec) for q in np.sort(q_sim)]
+		qt_sim = [i/float(len(q_sim)) for i in range(1, len(q_sim)+1)]
+		qt_bin = [1 if np.abs(rec-sim)/rec<0.1 else 0 for rec, sim in zip(q_rec, q_sim)]
+	return dict(qt_rec=qt_rec, qt_sim=qt_sim, qt_bin=qt_bin)
+
+
+class PlotTests(SimpleTestCase):
+	def test_quantiles(self):
+		from . import plots
+
+		rs = np.random.RandomState(8)
+		q_rec = np.round(rs.gamma(2.0, 10.0, 1000), 1)
+		q_sim = np.round(q_rec*rs.normal(1.0, 0.15, 1000), 1)
+		q_rec[[3, 50]] = np.nan
+		q_sim[[50, 70]] = np.nan
+		actual = plots.quantiles_of(q_sim, q_rec)
+		for name, expected in quantiles_reference(q_sim, q_rec).items():
+			np.testing.assert_allclose(actual[name], expected, rtol=1e-12, err_msg=name)
+
+	def test_roc_points(self):
+		from bokeh.plotting import ColumnDataSource
+		from . import plots
+
+		rs = np.random.RandomState(7)
+		source = ColumnDataSource(data={'qt_bin': rs.randint(0, 2, 20000),
+			'qt_sim': np.arange(1, 20001)/20000.0})
+		roc = plots.plot_roc(source).select_one({'name': 'roc'})
+		self.assertLessEqual(len(roc.data_source.data['x']), plots.MAX_POINTS)
+
+class AucTests(SimpleTestCase):
+	def test_decreasing_x(self):
+		self.assertEqual(metrics.auc([1, 0], [1, 1]), 1.0)
+
+	def test_non_monotonic_x(self):
+		with self.assertRaises(ValueError):
+			metrics.auc([0, 1, 0.5], [0, 1, 1])
+
+	def test_single_class(self):
+		fpr, tpr, _ = metrics.roc_curve([1, 1, 1], [0.1, 0.5, 0.9])
+		self.assertTrue(np.isnan(fpr).all())
+		np.testing.assert_allclose(tpr, [0, 1.0/3, 1])
+
+
+class ScoresTests(SimpleTestCase):
+	'''
+	metrics.scores against the definitions of the metrics, one at a time
+	'''
+	def setUp(self):
+		rs = np.random.RandomState(0)
+		self.q_rec = rs.gamma(2.0, 10.0, 500)
+		self.q_sim = self.q_rec*rs.normal(1.0, 0.2, 500)
+		self.q_rec[5], self.q_sim[7] = np.nan, np.nan
+
+	def test_definitions(self):
+		valid = ~np.isnan(self.q_rec) & ~np.isnan(self.q_sim)
+		o, s = self.q_rec[valid], self.q_sim[valid]
+		r = np.corrcoef(o, s)[0, 1]
+		lo, ls = np.log(o + 0.01*o.mean()), np.log(s + 0.01*o.mean())
+
+		expected = dict(
+			RMSE=np.sqrt(np.mean((s - o)**2)),
+			NSE=1 - np.sum((s - o)**2)/np.sum((o - o.mean())**2),
+			KGE=1 - np.sqrt((r - 1)**2 + (s.std()/o.std() - 1)**2 + (s.mean()/o.mean() - 1)**2),
+			PBIAS=100*np.sum(s - o)/np.sum(o),
+			peak_error=(s.max() - o.max())/o.max(),
+			)
+		expected['log-NSE'] = 1 - np.sum((ls - lo)**2)/np.sum((lo - lo.mean())**2)
+
+		scores = metrics.scores(self.q_rec, self.q_sim)
+		self.assertEqual(list(scores), list(metrics.SCORES))
+		for name, value in expected.items():
+			self.assertAlmostEqual(scores[name], value)
+
+	def test_batch(self):
+		batch = np.vstack([self.q_sim, 2*self.q_sim, np.full(500, np.nan)])
+		scores = metrics.scores(self.q_rec, batch)
+		for name in metrics.SCORES:
+			self.assertAlmostEqual(scores[name][0], metrics.scores(self.q_rec, self.q_sim)[name])
+			self.assertAlmostEqual(scores[name][1], metrics.scores(self.q_rec, 2*self.q_sim)[name])
+			self.assertTrue(np.isnan(scores[name][2]))
+
+	def test_empty(self):
+		scores = metrics.scores([], [])
+		self.assertTrue(all(np.isnan(value) for value in scores.values()))
+
+
+class WindowPerfTests(SimpleTestCase):
+	'''
+	Objectives of the calibration window against metrics.scores
+	'''
+	def test_missing_values(self):
+		for obj_fun in ('RMSE', 'NSE', 'KGE'):
+			model = make_model(engine='array', obj_fun=obj_fun)
+			model.data[50]['q_rec'] = np.nan
+			model._simulate_without_calibration()
+			model._prepare_window()
+			q_sim = model.columns['q_sim'].copy()
+			q_nan = q_sim.copy()
+			q_nan[[20, 60, 61, 200]] = np.nan
+
+			w = slice(model._window['begin'], model._window['end'])
+			q_rec = model.columns['q_rec'][w]
+			for q in (q_sim, q_nan):
+				expected = metrics.scores(q_rec, q[w])[obj_fun]
+				self.assertAlmostEqual(model._window_perf(q), expected, places=12)
+				self.assertAlmostEqual(model.obj_fun(q_rec, q[w]), expected, places=12)
+
+			# Batches, members with NaN values (or only NaN) scored alone
+			batch = np.array([q_sim, q_nan, np.full(q_sim.size, np.nan)])
+			expected = metrics.scores(q_rec, batch[:, w])[obj_fun]
+			np.testing.assert_allclose(model._window_perf(batch), expected, rtol=1e-12)
+			self.assertTrue(np.isnan(expected[2]))
+
+
+class CalibrationWindowTests(SimpleTestCase):
+	'''
+	Calibrated objective values against the objective functions on full runs
+	'''
+	def test_optimizers(self):
+		for engine in ('dict',) + ENGINES:
+			for name, obj_fun in zip(sorted(optimizers.OPTIMIZERS), ('RMSE', 'NSE', 'KGE')):
+				model = make_model(engine=engine, optimizer=name, obj_fun=obj_fun, fun_name=obj_fun,
+					minimise=obj_fun == 'RMSE', max_evals=200, seed=1)
+				model.calibrate()
+
+				w = slice(model._window['begin'], model._window['end'])
+				q_rec = np.array([d['q_rec'] for d in model.data])[w]
+				q_sim = np.array([d['q_sim'] for d in model.data])[w]
+				expected = model.obj_fun(q_rec, q_sim)
+				self.assertAlmostEqual(model._performance, expected if model.config['minimise'] else -expected,
+					places=10, msg=(engine, name))
+				self.assertEqual([model.par[key] for key in model.config['par_to_calibrate']],
+					list(model.cal_result['x']))
+
+
+class EarlyStopTests(SimpleTestCase):
+	'''
+	Calibrations stopped at the end of the window or abandoning worse runs
+	against full calibration runs
+	'''
+	def setUp(self):
+		# Member time steps run by the batched engines
+		self.steps = 0
+		self.kernels = hbv96.run_steps_batch, hbv96.run_steps_jit
+
+		def run_steps_batch(*args, **kwargs):
+			self.steps += kwargs['gw'].size
+			return self.kernels[0](*args, **kwargs)
+
+		def run_steps_jit(*args, **kwargs):
+			self.steps += kwargs['stop'] - kwargs['start']
+			return self.kernels[1](*args, **kwargs)
+
+		hbv96.run_steps_batch, hbv96.run_steps_jit = run_steps_batch, run_steps_jit
+
+	def tearDown(self):
+		hbv96.run_steps_batch, hbv96.run_steps_jit = self.kernels
+
+	def test_same_optimum(self):
+		for engine in ('dict',) + ENGINES:
+			for name in sorted(optimizers.OPTIMIZERS):
+				results = list()
+				for early_stop, abort_worse in ((False, False), (True, False), (True, True)):
+					model = make_model(engine=engine, optimizer=name, max_evals=200, seed=1,
+						early_stop=early_stop, abort_worse=abort_worse)
+					self.steps = 0
+					model.calibrate()
+					results.append((model.cal_result, self.steps))
+
+				(full, steps), others = results[0], results[1:]
+				for result, fewer in others:
+					self.assertEqual(result['x'], full['x'], (engine, name))
+					self.assertEqual(result['fun'], full['fun'], (engine, name))
+					self.assertEqual(result['nfev'], full['nfev'], (engine, name))
+					self.assertLess(fewer, steps, (engine, name))
+					steps = fewer
+
+class SimulationCacheTests(SimpleTestCase):
+	def test_lru_and_stats(self):
+		cache = SimulationCache(max_bytes=2*800)
+		for key in ('a', 'b'):
+			cache.put(key, {'q_sim': np.zeros(100)}, seconds=1.0)
+		self.assertIsNotNone(cache.get('a'))
+		cache.put('c', {'q_sim': np.zeros(100)})
+
+		# b is the least recently used
+		self.assertIsNone(cache.get('b'))
+		self.assertIsNotNone(cache.get('c'))
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 1, 2))
+		self.assertEqual(stats['saved_seconds'], 1.0)
+
+	def test_read_only(self):
+		cache = SimulationCache()
+		cache.put('a', {'q_sim': np.zeros(3)})
+		with self.assertRaises(ValueError):
+			cache.get('a')['q_sim'][0] = 1.0
+
+
+class StorageTests(SimpleTestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory)
+
+	def test_round_trip(self):
+		columns = {'prec': np.arange(5.0), 'time': np.array(['a', 'b', 'c', 'd', 'e'])}
+		storage.save_columns(self.directory, columns)
+		opened = storage.open_columns(self.directory)
+		self.assertIsInstance(opened['prec'], np.memmap)
+		np.testing.assert_array_equal(opened['prec'], columns['prec'])
+		np.testing.assert_array_equal(opened['time'], columns['time'])
+		with self.assertRaises(ValueError):
+			opened['prec'][0] = 1.0
+
+	def test_allocate(self):
+		states, fluxes, q_sim = storage.allocate(self.directory, 10)
+		q_sim[:] = 1.0
+		self.assertEqual((states.shape, fluxes.shape), ((5, 11), (14, 10)))
+		np.testing.assert_array_equal(storage.open_columns(self.directory)['q_sim'], np.ones(11))
+
+	def test_incomplete_store(self):
+		with self.assertRaises(KeyError):
+			storage.open_columns(self.directory)
+
+
+class SensitivityTests(SimpleTestCase):
+	'''
+	Indices of y = x0 + 2*x1 on [0, 1]^3, whose variance shares are 1/5, 4/5
+	and 0, and whose elementary effects are 1, 2 and 0
+	'''
+	lb, ub = [0, 0, 0], [1, 1, 1]
+
+	def test_sobol(self):
+		sample = sensitivity.saltelli(2000, self.lb, self.ub, random_state=0)
+		self.assertEqual(sample.shape, (5*2000, 3))
+		f = sample[:, 0] + 2*sample[:, 1]
+		f[7] = np.nan
+		indices = sensitivity.sobol_indices(f, 3, n_boot=10, random_state=0)
+		np.testing.assert_allclose(indices['S1'], [0.2, 0.8, 0], atol=0.05)
+		np.testing.assert_allclose(indices['ST'], [0.2, 0.8, 0], atol=0.05)
+		self.assertEqual(indices['ST_conf'].shape, (3,))
+
+	def test_morris(self):
+		sample = sensitivity.morris(10, self.lb, self.ub, random_state=0)
+		self.assertEqual(sample.shape, (10*4, 3))
+		self.assertTrue(((sample >= 0) & (sample <= 1)).all())
+		indices = sensitivity.morris_indices(sample[:, 0] + 2*sample[:, 1], sample, self.lb, self.ub)
+		np.testing.assert_allclose(indices['mu'], [1, 2, 0])
+		np.testing.assert_allclose(indices['mu_star'], [1, 2, 0])
+		np.testing.assert_allclose(indices['sigma'], [0, 0, 0], atol=1e-12)
+
+
+class BandsTests(SimpleTestCase):
+	'''
+	Streaming bands against the statistics of all the members at once
+	'''
+	def setUp(self):
+		rs = np.random.RandomState(0)
+		self.x = rs.gamma(2.0, 10.0, (2000, 50))
+		self.w = rs.uniform(0.1, 1.0, 2000)
+
+	def stream(self, compiled):
+		bands = Bands(50, compiled=compiled)
+		for i in range(0, 2000, 300):
+			bands.update(self.x[i:i+300], self.w[i:i+300])
+		return bands.result()
+
+	def test_streaming(self):
+		result = self.stream(False)
+		for p in (0.05, 0.5, 0.95):
+			np.testing.assert_allclose(result[p], np.percentile(self.x, 100*p, axis=0), rtol=0.1)
+		mean = np.average(self.x, axis=0, weights=self.w)
+		np.testing.assert_allclose(result['mean'], mean)
+		np.testing.assert_allclose(result['std'], np.sqrt(np.average((self.x - mean)**2, axis=0, weights=self.w)))
+
+	@unittest.skipIf(not HAS_NUMBA, 'numba is not installed')
+	def test_compiled(self):
+		compiled, vectorised = self.stream(True), self.stream(False)
+		for name in compiled:
+			np.testing.assert_allclose(compiled[name], vectorised[name])
+
+	def test_few_members(self):
+		bands = Bands(50)
+		self.assertTrue(np.isnan(bands.result()[0.5]).all())
+		bands.update(self.x[:3])
+		np.testing.assert_allclose(bands.result()[0.5], np.median(self.x[:3], axis=0))
+
+
+class StoreModelTests(SimpleTestCase):
+	'''
+	Models running on the memory-mapped columns of a dataset
+	'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory)
+
+	def test_simulate_without_rows(self):
+		store = DatasetStore(self.directory)
+		columns = store.columns(store.put(json.dumps(make_data(300))))
+		reference = make_model(300, engine='array')
+		reference._simulate_without_calibration()
+
+		model = make_model(engine='array')
+		model.open_store(columns)
+		model._simulate_without_calibration()
+		self.assertEqual(model.held_rows(), ([], []))
+		self.assertTrue(np.may_share_memory(model.columns['prec'], columns['prec']))
+		np.testing.assert_array_equal(model.columns['q_sim'], reference.columns['q_sim'])
+
+		# Rows are built when read
+		self.assertEqual(model.data[5]['q_sim'], reference.data[5]['q_sim'])
+
+
+class CalibrationWorkerTests(SimpleTestCase):
+	'''
+	Objective function in a worker of the multi-start calibration
+	'''
+	def test_memoized_points(self):
+		model = make_model(engine='array')
+		model._init_simu()
+		model._prepare_window()
+		model.generate_par_to_calibrate()
+
+		hbv96._init_worker(pickle.loads(pickle.dumps(model, 2)))
+		worker = hbv96._worker_model
+		x = np.array([worker.par[key] for key in worker.config['par_to_calibrate']])
+		perf = [worker._cal_fun(x) for _ in range(3)]
+
+		self.assertEqual(perf[1:], perf[:1]*2)
+		self.assertEqual(worker.progress, {})
+		self.assertEqual(len(worker._evaluated), 1)
+
+
+class MultiStartTests(SimpleTestCase):
+	'''
+	Multi-start calibrations, in a process pool or in a job
+	'''
+	def setUp(self):
+		self.jobs = JobQueue(max_workers=1)
+
+	def tearDown(self):
+		self.jobs._executor.shutdown(wait=True)
+
+	def model(self, **config):
+		options = dict(engine='array', obj_fun='NSE', fun_name='NSE', minimise=False,
+			init_guess=False, n_starts=3, n_jobs=2, seed=0)
+		options.update(config)
+		return make_model(**options)
+
+	def test_maximise(self):
+		pooled = self.model()
+		pooled.calibrate()
+		job = self.jobs.get(self.jobs.submit(self.model()))
+		job.future.result()
+		threaded = job.model
+
+		# Off the main thread the same starts run one after the other
+		for model in (pooled, threaded):
+			self.assertEqual(len(model.starts), 3)
+			self.assertEqual(model.progress['nfev'], sum(start['nfev'] for start in model.starts))
+			best = min(start['fun'] for start in model.starts)
+			self.assertEqual(model._performance, best)
+			self.assertEqual(model.starts[model.best_start]['fun'], best)
+			for key, x in zip(model.config['par_to_calibrate'], model.cal_result['x']):
+				self.assertEqual(model.par[key], x)
+		for a, b in zip(pooled.starts, threaded.starts):
+			self.assertEqual(a['x_0'], b['x_0'])
+			np.testing.assert_allclose(a['x'], b['x'])
+			self.assertAlmostEqual(a['fun'], b['fun'])
+
+		# The objective is maximised, its values negated
+		model = threaded
+		model.config['minimise'] = True
+		model._evaluated = dict()
+		nse = model._cal_fun(np.array(model.cal_result['x']))
+		self.assertAlmostEqual(nse, -model._performance)
+		self.assertEqual(nse, max(-start['fun'] for start in model.starts))
+
+	def test_cancel(self):
+		model = self.model()
+		model.cancel_requested = True
+		with self.assertRaises(hbv96.CalibrationCancelled):
+			model.calibrate()
+		self.assertFalse(model.cancel_requested)
+
+		# A running job stops at its next evaluation, within a start
+		job = self.jobs.get(self.jobs.submit(self.model(n_starts=1000)))
+		while not job.model.progress or not job.model.progress['nfev']:
+			time.sleep(0.01)
+		self.jobs.cancel(job.id)
+		self.assertIsInstance(job.future.exception(), hbv96.CalibrationCancelled)
+		self.assertEqual(job.status()['state'], 'cancelled')
+		self.assertLess(len(job.model.starts), 1000)
+
+class RegistryTests(SimpleTestCase):
+	'''
+	LRU and memory limits of ModelRegistry
+	'''
+	def test_lru(self):
+		registry = ModelRegistry(HBV96, max_models=2)
+		for key in ('a', 'b', 'a', 'c'):
+			with registry.session(key):
+				pass
+		self.assertEqual(sorted(registry._entries), ['a', 'c'])
+
+		# Models in use are never evicted
+		with registry.session('a') as model:
+			with registry.session('d'):
+				pass
+			with registry.session('e'):
+				pass
+			self.assertIn('a', registry)
+		self.assertEqual(sorted(registry._entries), ['a', 'e'])
+		self.assertIs(model, registry._entries['a'].model)
+
+	def test_bytes(self):
+		nbytes = model_nbytes(make_model(200))
+		self.assertGreater(nbytes, 0)
+		registry = ModelRegistry(lambda: make_model(200), max_bytes=int(1.5*nbytes))
+		for key in ('a', 'b'):
+			with registry.session(key):
+				pass
+		self.assertEqual(list(registry._entries), ['b'])
+		self.assertEqual(registry.nbytes, nbytes)
+
+	def test_replace(self):
+		nbytes = model_nbytes(make_model(200))
+		registry = ModelRegistry(HBV96, max_bytes=int(1.5*nbytes))
+		with registry.session('a'):
+			pass
+		registry.replace('b', make_model(200))
+		registry.replace('c', make_model(200))
+		self.assertEqual(list(registry._entries), ['c'])
+		self.assertEqual(registry.nbytes, nbytes)
+
+
+class JobQueueTests(SimpleTestCase):
+	'''
+	Ownership and cancellation of background calibrations
+	'''
+	def setUp(self):
+		self.jobs = JobQueue(max_workers=1)
+
+	def tearDown(self):
+		self.jobs._executor.shutdown(wait=True)
+
+	def long_calibration(self):
+		return make_model(engine='array', optimizer='DDS', max_evals=10**7, seed=0)
+
+	def test_owner(self):
+		job_id = self.jobs.submit(make_model(engine='array', optimizer='DDS', max_evals=50, seed=0), owner='a')
+		for call in (self.jobs.get, self.jobs.cancel, self.jobs.pop):
+			with self.assertRaises(KeyError):
+				call(job_id, 'b')
+			with self.assertRaises(KeyError):
+				call(job_id)
+		with self.assertRaises(KeyError):
+			self.jobs.get('unknown', 'a')
+
+		job = self.jobs.get(job_id, 'a')
+		job.future.result()
+		self.assertEqual(job.status()['state'], 'done')
+		self.assertIs(self.jobs.pop(job_id, 'a'), job)
+		with self.assertRaises(KeyError):
+			self.jobs.get(job_id, 'a')
+
+	def test_cancel(self):
+		running = self.jobs.get(self.jobs.submit(self.long_calibration(), owner='a'), 'a')
+		queued = self.jobs.get(self.jobs.submit(self.long_calibration(), owner='a'), 'a')
+		while running.started is None:
+			time.sleep(0.01)
+
+		# A queued job never starts, a running one stops at its next evaluation
+		self.assertEqual(self.jobs.cancel(queued.id, 'a')['state'], 'cancelled')
+		self.jobs.cancel(running.id, 'a')
+		running.future.exception()
+		self.assertEqual(running.status()['state'], 'cancelled')
+		self.assertFalse(running.model.cancel_requested)
+		self.assertIsNone(queued.started)
+		self.assertIs(self.jobs.pop(queued.id, 'a'), queued)
+
+
+def post_action(session, **data):
+	'''
+	Response of the home view to the AJAX POST of data in session
+	'''
+	request = RequestFactory().post('/hbv96/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+	request.session = session
+	response = views.home(request)
+	return response.status_code, json.loads(response.content)
+
+
+class JobViewTests(SimpleTestCase):
+	'''
+	Calibration jobs through the home view
+	'''
+	def test_cancel_finished_job(self):
+		session = SessionStore()
+		run = {'data': json.dumps(make_data(300)), 'par': json.dumps(PAR), 'plots': 'lazy',
+			'config': json.dumps(dict(CONFIG, engine='array', optimizer='DDS', max_evals=30, seed=0))}
+
+		status, context = post_action(session, action='submit_calibration', **run)
+		job_id = context['job_id']
+		while post_action(session, action='job_status', job_id=job_id)[1]['state'] != 'done':
+			time.sleep(0.01)
+
+		# Too late to cancel: the job stays done and its model usable
+		self.assertEqual(post_action(session, action='cancel_job', job_id=job_id)[1]['state'], 'done')
+		status, context = post_action(session, action='job_result', job_id=job_id)
+		self.assertEqual((status, context['state']), (200, 'done'))
+
+		status, context = post_action(session, action='calibrate', **run)
+		self.assertEqual(status, 200)
+		self.assertIn('scores', context)
+
+class RunIdTests(SimpleTestCase):
+	'''
+	Models and jobs of run ids, only within their session
+	'''
+	def test_sessions(self):
+		owner, other = SessionStore(), SessionStore()
+		run = {'data': json.dumps(make_data(100)), 'par': json.dumps(PAR), 'plots': 'lazy', 'st': '{}',
+			'config': json.dumps(dict(CONFIG, engine='array', calibrate_to={'index': 50})), 'run_id': 'run'}
+
+		self.assertEqual(post_action(owner, action='simulate', **run)[0], 200)
+		post_action(other, action='none', run_id='run')
+		post_action(owner, action='none')
+		models = dict((key, views.registry._entries[key].model.n_rows()) for key in
+			(owner.session_key + ':run', other.session_key + ':run', owner.session_key))
+		self.assertEqual(sorted(models.values()), [0, 0, 100])
+		self.assertEqual(models[owner.session_key + ':run'], 100)
+
+		job_id = post_action(owner, action='submit_calibration', **dict(run,
+			config=json.dumps(dict(CONFIG, engine='array', optimizer='DDS', max_evals=20, seed=0))))[1]['job_id']
+		self.assertEqual(post_action(other, action='job_status', job_id=job_id, run_id='run')[0], 404)
+		self.assertEqual(post_action(owner, action='job_status', job_id=job_id, run_id='run')[0], 200)
+
+class AdvanceViewTests(SimpleTestCase):
+	'''
+	Advance action without a simulation to resume
+	'''
+	def test_no_simulation(self):
+		rows = json.dumps(make_data(20)[:3])
+		status, context = post_action(SessionStore(), action='advance', data=rows)
+		self.assertEqual(status, 400)
+		self.assertIn('previous simulation', context['error'])
+
+		status, context = post_action(SessionStore(), action='advance', data='[{')
+		self.assertEqual(status, 400)
+
+class IngestTests(SimpleTestCase):
+	'''
+	Parsing of the uploaded CSV files
+	'''
+	ROWS = [('2000-01-{0:02d}'.format(d), 0.5*d, 1.0 + d, d - 10.0, 0.1) for d in range(1, 32)] + \
+		[('2000-02-{0:02d}'.format(d), 0.0, 2.0, 5.0 + d, 0.2) for d in range(1, 29)]
+
+	def csv(self, separator=',', title=False, rows=None, names='Date,prec,q_rec,temp,ep'):
+		lines = (['Forcings of the test catchment'] if title else []) + [names.replace(',', separator)]
+		lines += [separator.join(str(v) for v in row) for row in (self.ROWS if rows is None else rows)]
+		return '\n'.join(lines).encode('utf-8')
+
+	def test_options(self):
+		for separator, header in ((',', 0), (';', 1), ('\t', 1)):
+			raw = self.csv(separator, title=bool(header))
+			columns, data_id = ingest.read_csv(io.BytesIO(raw), separator=separator, header=header, chunksize=10)
+			self.assertEqual(data_id, hashlib.sha1(raw).hexdigest())
+			self.assertEqual(len(columns['time']), 59)
+			self.assertEqual(columns['time'][31], '2000-02-01 00:00:00')
+			np.testing.assert_array_equal(columns['prec'], [row[1] for row in self.ROWS])
+			np.testing.assert_array_equal(columns['month'], [1]*31 + [2]*28)
+
+			# Long-term monthly means of the air temperature, across chunks
+			np.testing.assert_allclose(columns['tm'][:31], np.mean([row[3] for row in self.ROWS[:31]]))
+			np.testing.assert_allclose(columns['tm'][31:], np.mean([row[3] for row in self.ROWS[31:]]))
+
+	def test_given_tm(self):
+		rows = [row + (4.0,) for row in self.ROWS]
+		columns, _ = ingest.read_csv(io.BytesIO(self.csv(rows=rows, names='time,prec,q_rec,temp,ep,tm')))
+		np.testing.assert_array_equal(columns['tm'], 4.0)
+
+	def test_missing_values(self):
+		# Missing records are kept as NaN
+		rows = list(self.ROWS)
+		rows[5] = rows[5][:2] + ('',) + rows[5][3:]
+		columns, _ = ingest.read_csv(io.BytesIO(self.csv(rows=rows)))
+		self.assertTrue(np.isnan(columns['q_rec'][5]))
+		columns, _ = ingest.read_csv(io.BytesIO(self.csv(rows=[row[:2] + row[3:] for row in self.ROWS],
+			names='date,prec,temp,ep')))
+		self.assertTrue(np.isnan(columns['q_rec']).all())
+
+		# Missing forcings are rejected
+		rows = list(self.ROWS)
+		rows[7] = rows[7][:1] + ('',) + rows[7][2:]
+		with self.assertRaisesRegexp(ValueError, 'prec value in row 8'):
+			ingest.read_csv(io.BytesIO(self.csv(rows=rows)))
+		with self.assertRaisesRegexp(ValueError, 'no ep column'):
+			ingest.read_csv(io.BytesIO(self.csv(rows=[row[:4] for row in self.ROWS], names='date,prec,q_rec,temp')))
+		with self.assertRaisesRegexp(ValueError, 'no time column'):
+			ingest.read_csv(io.BytesIO(self.csv(names='day,prec,q_rec,temp,ep')))
+		with self.assertRaisesRegexp(ValueError, 'no rows'):
+			ingest.read_csv(io.BytesIO(self.csv(rows=[])))
+
+	def test_view(self):
+		upload = SimpleUploadedFile('forcings.csv', self.csv(rows=[row[:4] for row in self.ROWS], names='date,prec,q_rec,temp'))
+		status, context = post_action(SessionStore(), action='upload_csv', file=upload, config='{}')
+		self.assertEqual(status, 400)
+		self.assertIn('ep', context['error'])
+
+class DatasetStoreTests(SimpleTestCase):
+	'''
+	Datasets stored by id and reopened from disk
+	'''
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_round_trip(self):
+		rows = make_data(50)
+		rows[3]['q_rec'] = None
+		text = json.dumps(rows)
+		data_id = DatasetStore(self.directory).put(text)
+		self.assertEqual(data_id, hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+		# From the disk, as after a restart
+		store = DatasetStore(self.directory)
+		columns = store.columns(data_id)
+		self.assertIsInstance(columns['prec'], np.memmap)
+		self.assertFalse(columns['prec'].flags.writeable)
+		for name in ('prec', 'temp', 'tm', 'ep'):
+			np.testing.assert_array_equal(columns[name], [d[name] for d in rows])
+		self.assertTrue(np.isnan(columns['q_rec'][3]))
+		self.assertEqual(list(columns['time']), [d['time'] for d in rows])
+		self.assertEqual(store.put(text), data_id)
+
+	def test_ids(self):
+		store = DatasetStore(self.directory)
+		for data_id in ('', '..', '../' + 'a'*40, 'A'*40, 'x'*40, 'a'*40):
+			with self.assertRaises(KeyError):
+				store.columns(data_id)
+		with self.assertRaises(KeyError):
+			store.put_columns('../a', {'prec': np.zeros(3)})
+		self.assertEqual(store._memory, {})
+
+
+class ColumnarTests(SimpleTestCase):
+	'''
+	Binary columnar payloads of the results
+	'''
+	def test_round_trip(self):
+		rs = np.random.RandomState(6)
+		columns = OrderedDict([('q_sim', rs.rand(101)), ('sm', rs.rand(202)[::2]),
+			('mbas', np.arange(7)), ('empty', np.zeros(0))])
+		for compress in (False, True):
+			for header in (None, {'par': {'k': 0.1}, 'x': 'é'*3}):
+				payload = columnar.pack(columns, header, compress=compress)
+				self.assertEqual(payload[:4], columnar.MAGIC)
+
+				# The body starts at a multiple of 8 bytes
+				n = struct.unpack('<I', payload[4:8])[0]
+				self.assertEqual((8 + n) % 8, 0)
+
+				actual, actual_header = columnar.unpack(payload)
+				self.assertEqual(list(actual), list(columns))
+				for name in columns:
+					self.assertEqual(actual[name].dtype, np.dtype('<f8'))
+					np.testing.assert_array_equal(actual[name], columns[name])
+				self.assertEqual(actual_header, header or {})
+
+		with self.assertRaises(ValueError):
+			columnar.unpack(b'JSON' + payload[4:])
+
+	def test_model_columns(self):
+		for engine in ('dict',) + ENGINES:
+			model = make_model(engine=engine)
+			model._simulate_without_calibration()
+			columns = columnar.model_columns(model, ['time', 'q_sim', 'gw'])
+			self.assertEqual(sorted(columns), ['gw', 'q_sim', 'time'])
+			np.testing.assert_allclose(columns['q_sim'], [d['q_sim'] for d in model.data], rtol=1e-12)
+			np.testing.assert_allclose(columns['gw'][:-1], [d['gw'] for d in model.int_tab], rtol=1e-12)
+			self.assertTrue(np.isnan(columns['gw'][-1]))
+			self.assertEqual(columns['time'][0], 946684800000.0)
@@ -2,566 +2,279 @@
 from __future__ import unicode_literals
 
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.template import loader, RequestContext
 from django.shortcuts import render, render_to_response
+from django.conf import settings
 from .hbvcore.hbv96 import HBV96, DivergentError
+from .hbvcore.cache import SimulationCache
+from .registry import ModelRegistry
+from .jobs import JobQueue
+from .datasets import DatasetStore
 import json
+from collections import OrderedDict
 
-import numpy as np
-import pandas as pd
-from bokeh.embed import components
-from bokeh.models import LinearAxis, Legend, BoxZoomTool, HoverTool, PanTool, RedoTool, ResetTool, SaveTool, UndoTool, WheelZoomTool
-from bokeh.models.ranges import Range1d
-from bokeh.palettes import magma, plasma, viridis
-from bokeh.plotting import figure, ColumnDataSource
+# Plotting (bokeh), CSV parsing and binary responses (pandas) are imported by
+# the actions needing them, see the startup_report command
 
-# Create HBV object
-mcd = HBV96()
+# Simulation results shared by all models, on disk too if HBV_CACHE_DIR is set
+simulations = SimulationCache(
+	max_bytes=getattr(settings, 'HBV_CACHE_BYTES', 256*2**20),
+	directory=getattr(settings, 'HBV_CACHE_DIR', None))
 
-mcd.DEF_q0 = 0.188
+# Models of the application, one per session or run id
+def new_model():
+	mcd = HBV96()
+	mcd.DEF_q0 = 0.188
+	mcd.cache = simulations
+	return mcd
+
+registry = ModelRegistry(new_model,
+	max_models=getattr(settings, 'HBV_MAX_MODELS', 32),
+	max_bytes=getattr(settings, 'HBV_MAX_MODELS_BYTES', 512*2**20))
+
+# Background calibrations
+jobs = JobQueue(max_workers=getattr(settings, 'HBV_CALIBRATION_WORKERS', 2))
+
+# Uploaded forcing datasets
+datasets = DatasetStore(getattr(settings, 'HBV_DATASET_DIR', None))
+
+def load_data(post, mcd):
+	'''
+	Set the data of mcd from the posted dataset id data_id, see load_file, or
+	from the posted rows
+	'''
+	data_id = post.get('data_id')
+	if not data_id:
+		mcd.data = json.loads(post.get('data'))
+		mcd.data_id = None
+	elif data_id != mcd.data_id:
+		try:
+			# Memory-mapped forcings, rows are only built if needed
+			mcd.open_store(datasets.columns(data_id))
+		except KeyError:
+			raise Http404('Unknown dataset')
+		mcd.data_id = data_id
+
+def json_rows(rows):
+	'''
+	rows as sent in JSON responses: the rows holding undefined values (NaN,
+	e.g. before the warm start of a run) are copied with null in their place
+	'''
+	return [dict((name, None if value!=value else value) for name, value in row.items())
+		if any(value!=value for value in row.values()) else row for row in rows]
+
+def results(post, context, model):
+	'''
+	Response with the results of the last run of model: its scorecard, the
+	data and intermediate values as JSON lists of rows (NaN as null), or with format=binary the
+	columnar payload of the series listed in columns (JSON list, all if
+	unspecified), zlib-compressed if compress is set, see columnar
+	'''
+	# Scorecard of the run, undefined metrics (NaN) as null
+	context['scores'] = OrderedDict((name, None if value!=value else value)
+		for name, value in model.scorecard().items())
+
+	if post.get('format')!='binary':
+		context['data'] = json_rows(model.data)
+		context['inters'] = json_rows(model.int_tab)
+		return JsonResponse(context)
+
+	from . import columnar
+
+	names = json.loads(post.get('columns') or 'null')
+	payload = columnar.pack(columnar.model_columns(model, names), context,
+		compress=bool(post.get('compress')))
+	return HttpResponse(payload, content_type='application/octet-stream')
+
+def run_id(request):
+	'''
+	Key of the model of a request: the session key, followed by the posted
+	run_id if any, so that run ids only reach the models of their session
+	'''
+	if request.session.session_key is None:
+		request.session.save()
+
+	key = request.POST.get('run_id')
+	if key:
+		return '{0}:{1}'.format(request.session.session_key, key)
+	return request.session.session_key
 
 # Home page.
 @csrf_exempt
 def home(request):
-	global mcd
 	template = 'hbvapp/home.html'
 	context = {}
 	if request.method == "POST" and request.is_ajax():
-		
-		post = request.POST
-		action = post.get('action')
-		context = {}
-
-		# Use JsonResponse to interact with JQuery
-		if action=='load_file':
-			mcd.data = json.loads(post.get('data'))
-			return JsonResponse(context)
-
-		elif action=='simulate':
-			mcd.data = json.loads(post.get('data'))
-			mcd.config.update(json.loads(post.get('config')))
-			mcd.par.update(json.loads(post.get('par')))
-			mcd.DEF_ST.update(json.loads(post.get('st')))
-			mcd._simulate_without_calibration()
-			context['par'] = mcd.par
-			context['plots'] = plot_simulation(mcd.data)
-			context['data'] = mcd.data
-			context['inters'] = mcd.int_tab
-			return JsonResponse(context)
-
-		elif action=='calibrate':
-			mcd.data = json.loads(post.get('data'))
-			mcd.config.update(json.loads(post.get('config')))
-			mcd.par.update(json.loads(post.get('par')))
-			mcd.calibrate()
-			context['par'] = mcd.par
-			context['plots'] = plot_simulation(mcd.data)
-			context['data'] = mcd.data
-			context['inters'] = mcd.int_tab
-			return JsonResponse(context)
-		
-		elif action=='summarize':
-			context['summary'] = json.dumps(mcd.summary())
-			context['size'] = len(mcd.data)
-			return JsonResponse(context)
-
-		elif action=='save_bounds':
-			mcd.P_LB = json.loads(post.get('P_LB'))
-			mcd.P_UB = json.loads(post.get('P_UB'))
-			return JsonResponse(context)
-		else:
-			return JsonResponse(context)
+		key = run_id(request)
+		with registry.session(key) as mcd:
+			return dispatch(request, mcd, key)
 	else:
 		return render(request, template)
 
-'''
-  ---------- Bokeh plots ------------
-'''
-def plot_simu_q(source):
-
-	hover = HoverTool(
-		names=['q_rec',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Simulated', '@q_sim{0.000 a}' ),
-	        ( 'Recorded', '@q_rec{0.000 a}' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='vline',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, 
-		responsive=True, x_axis_type='datetime')
-	p.title.text = "Simulation Flow Rate"
-
-	for series, name, color in zip(['q_rec', 'q_sim'], ['Measured Discharge', 'Simulated Discharge'], ['#404387', '#79D151']):
-		p.line('date', series, source=source, color=color, alpha=0.8, legend=name, name=series)
-
-	p.legend.location = "top_center"
-	p.legend.orientation = "horizontal"
-	p.legend.click_policy='hide'
-	
-	return p
-
-def plot_simu_p(source):
-
-	hover = HoverTool(
-		names=['sp',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Snow Pack', '@sp{0.000 a}' ),
-	        ( 'Precipitation', '@prec{0.000 a}' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='vline',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, responsive=True, x_axis_type='datetime')
-	p.title.text = "Precipitation Records and Simulated Snow Pack"
-
-	p.vbar(x='date', top='prec', bottom=0, width=1, source=source, color='#404387', 
-		alpha=0.8, legend='Precipitation   ', name='Precipitation')
-	p.line('date', 'sp', source=source, color='#79D151', 
-		alpha=0.8, line_width=2, legend='Snow Pack', name='sp')
-
-	p.legend.location = "top_center"
-	p.legend.orientation = "horizontal"
-	p.legend.click_policy= "hide"
-
-	return p
-
-def plot_simu_t(source):
-
-	hover = HoverTool(
-		names=['Temperature',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Measured Air Temperature', '@t{0.000 a}[°C]' ),
-	        ( 'Long-term Average', '@tm{0.000 a}[°C]' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='vline',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, responsive=True, x_axis_type='datetime')
-	p.title.text = "Air Temperature"
-
-	for series, name, color, alpha in zip(['t', 'tm'], ['Temperature', 'LTA'], ['#DD4968','#440154'], [0.9, 0.7]):
-		p.line('date', series, source=source, color=color, alpha=alpha, legend=name, name=name)
-
-	p.legend.location = "top_center"
-	p.legend.orientation = "horizontal"
-	p.legend.click_policy='hide'
-
-
-	return p
-
-def plot_simu_etp(source):
-
-	hover = HoverTool(
-		names=['sm',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Evaporation', '@ep{0.000 a}' ),
-	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
-	        ( 'Discharge', '@q_rec{0.000 a}' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='vline',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, 
-		responsive=True, x_axis_type='datetime')
-	p.title.text = "Evaporation and Soil Moisture"
-
-	for series, name, color in zip(['sm', 'ep', 'q_rec'], ['Soil Moisture', 'Measured Evaporation', 'Measured Discharge'], ['#79D151', '#DD4968', '#404387']):
-		p.line('date', series, source=source, color=color, alpha=0.8, legend=name, name=series)
-
-	p.legend.location = "top_center"
-	p.legend.orientation = "horizontal"
-	p.legend.click_policy='hide'
-	
-	return p
-
-def plot_simu_gw():
-	# To be implemented...
-		pass	
-
-def plot_simu_st(source):
-
-	hover = HoverTool(
-		names=['sm',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Snow Pack', '@sp{0.000 a}' ),
-	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
-	        ( 'Water Content', '@wc{0.000 a}' ),
-	        ( 'Upper Zone', '@uz{0.000 a}' ),
-	        ( 'Lower Zone', '@lz{0.000 a}' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='mouse',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, 
-		responsive=True, x_axis_type='datetime')
-	p.title.text = "Simulated States"
-
-	renderers = []
-	lines = ['sm', 'sp', 'wc', 'uz', 'lz']
-	names =  ['Soil Moisture', 'Snow Pack', 'Water Content', 'Upper Zone', 'Lower Zone']
-	colors = plasma(5)
-
-	for series, color in zip(lines, colors):
-		renderers.append([p.line('date', series, source=source, color=color, alpha=0.8, name=series)])
-
-	legend = Legend(
-		items=zip(names, renderers),
-		location="center",
-		orientation="horizontal",
-		click_policy="hide",
-		glyph_width = 40,
-		padding=10,
-		spacing=20,
-		border_line_width=1,
-		border_line_color='navy',
-		margin=20,
-		label_standoff=6
-		)
-	p.add_layout(legend, 'below')
-	
-	return p
-
-def plot_simu_st_without_snow(source):
-
-	hover = HoverTool(
-		names=['sm',],
-	    tooltips=[
-	        ( 'date', '@date{%F}' ),
-	        ( 'Soil Moisture', '@sm{0.000 a}' ), 
-	        ( 'Upper Zone', '@uz{0.000 a}' ),
-	        ( 'Lower Zone', '@lz{0.000 a}' ), # use @{ } for field names with spaces
-	    ],
-	    formatters={
-	        'date' : 'datetime', # use 'datetime' formatter for 'date' field
-	    },
-
-	    # display a tooltip whenever the cursor is vertically in line with a glyph
-	    mode='mouse',
-	)
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(),hover, SaveTool()]
-
-	p = figure(plot_width=800, plot_height=450, tools=tools, 
-		responsive=True, x_axis_type='datetime')
-	p.title.text = "Simulated States"
-
-	renderers = []
-	lines = ['sm', 'uz', 'lz']
-	names =  ['Soil Moisture', 'Upper Zone', 'Lower Zone']
-	colors = plasma(3)
-
-	for series, color in zip(lines, colors):
-		renderers.append([p.line('date', series, source=source, color=color, alpha=0.8, name=series)])
-
-	legend = Legend(
-		items=zip(names, renderers),
-		location="center",
-		orientation="horizontal",
-		click_policy="hide",
-		glyph_width = 40,
-		padding=10,
-		spacing=20,
-		border_line_width=1,
-		border_line_color='navy',
-		margin=20,
-		label_standoff=6
-		)
-	p.add_layout(legend, 'below')
-	
-	return p
-
-def plot_simu_perf(source):
-	from bokeh.layouts import gridplot, layout
-
-	qq_plot = plot_qqplot(source)
-	roc_plot = plot_roc(source)
-	diff_plot = plot_diff(source)
-	grid = gridplot(children=[[diff_plot], [qq_plot, roc_plot]],
-		sizing_mode="scale_width")
-	return grid
-
-def plot_qqplot(source):
-	_range = len(source.data['qt_sim'])-1
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(), SaveTool()]
-
-	p = figure(plot_width=320, plot_height=320, tools=tools,
-			toolbar_location='above')
-	p.title.text = "Q-Q Plot"
-	p.xaxis.axis_label = "Simulated Discharge Quantile [-]"
-	p.yaxis.axis_label = "Recorded Discharge Quantile [-]"
-
-	qts = p.circle(x='qt_sim', y='qt_rec', source=source, color='#404387', 
-		alpha=0.8, name='quantile', size=2)
-
-	straightline = p.line(x=[0, 1], y= [0, 1], color='red',
-		alpha=0.8, name='y=x', line_width=3)
-
-	legend = Legend(
-		items=[
-			('Q-norm', [qts]),
-			('y = x', [straightline]),
-			],
-		location=(170,0),
-		orientation="horizontal",
-		click_policy="hide",
-		glyph_width = 40,
-		padding=10,
-		spacing=20,
-		border_line_width=1,
-		border_line_color='navy',
-		margin=20,
-		label_standoff=6
-		)
-	p.add_layout(legend, 'below')
-	
-	return p
-
-def plot_roc(source):
+def dispatch(request, mcd, key):
 	'''
-	Import sklearn locally to generate roc curve
+	Run the posted action on the model mcd of the request, whose run id is key
 	'''
-	from sklearn.metrics import roc_curve, auc
-	from bokeh.models import Label
-
-    # Compute ROC curve and area the curve
-	fpr, tpr, thresholds = roc_curve(source.data['qt_bin'], source.data['qt_sim'])
-	roc_auc = auc(fpr, tpr)
-
-    # Ploting
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(), SaveTool()]
-
-	p = figure(plot_width=320, plot_height=320, tools=tools,
-			toolbar_location='above')
-	p.title.text = "ROC Curve"
-	p.xaxis.axis_label = "FPR (False Positive Rate) [-]"
-	p.yaxis.axis_label = "TPR (True Positive Rate) [-]"
-
-	roc = p.line(x=fpr, y=tpr, color='#404387', 
-		alpha=0.8, name='roc', line_width=2)
-
-	straightline = p.line(x=[0, 1], y= [0, 1], color='red',
-		alpha=0.8, name='y=x', line_width=3)
-
-	legend = Legend(
-		items=[
-			('ROC', [roc]),
-			('y = x', [straightline]),
-			],
-		location=(180, 0),
-		orientation="horizontal",
-		click_policy="hide",
-		glyph_width = 40,
-		padding=10,
-		spacing=20,
-		border_line_width=1,
-		border_line_color='navy',
-		margin=20,
-		label_standoff=6
-		)
-
-	_auc = Label(x=0.7, y=0.25, text_font_size='1.1em',
-		text_font_style='bold', text='AUC = {0:.3f}'.format(roc_auc))
-
-	p.add_layout(legend, 'below')
-	p.add_layout(_auc)
-	
-	return p
-
-def plot_diff(source):
-	import time
-
-	_range = len(source.data['diff'])-1
-	begin = source.data['time'][0]
-	end = source.data['time'][_range]
-	x_for_lines = [begin, end]
-	x_range = [time.mktime(begin.timetuple())*1000, 
-		time.mktime(end.timetuple())*1000]
-	tools = [PanTool(), WheelZoomTool(dimensions="width"),
-		BoxZoomTool(dimensions="width"), UndoTool(), RedoTool(),
-		ResetTool(), SaveTool()]
-
-	p = figure(plot_width=480, plot_height=200, tools=tools,
-			toolbar_location='above', x_axis_type="datetime",
-			x_range=x_range)
-	p.title.text = "Model Error"
-	p.xaxis.axis_label = "Time [-]"
-	p.yaxis.axis_label = "Qsim - Qobs [m³/s]"
-
-	diff = p.circle(x='time', y='diff', source=source, color='#404387', 
-		alpha=0.8, name='difference', size=2)
-
-	u = np.nanmean(source.data['diff'])
-	d = np.std(source.data['diff'])
-	u_3d = p.line(x= x_for_lines, y= [u+3*d, u+3*d], color='orangered',
-		alpha=1, name="u+3σ", line_width=2, line_dash="dotted")
-	_u_3d = p.line(x= x_for_lines, y= [u-3*d, u-3*d], color='orangered',
-		alpha=1, name="u+3σ", line_width=2, line_dash="dotted")
-	mean = p.line(x= x_for_lines, y= [u, u], color='orangered',
-		alpha=1, name='u', line_width=3)
-
-	legend = Legend(
-		items=[
-			("Qsim - Qobs [m³/s]", [diff]),
-			("mean", [mean]),
-			("u±3σ", [u_3d, _u_3d]),
-			],
-		location="top_center",
-		orientation="horizontal",
-		click_policy="hide",
-		glyph_width = 40,
-		padding=10,
-		spacing=20,
-		border_line_width=1,
-		border_line_color='navy',
-		margin=20,
-		label_standoff=6
-		)
-	p.add_layout(legend)
-	
-	return p
-
-def plot_simulation(simulation_result):
-	source = synthesize_data(simulation_result)
-
-	# script_q, div_q = components(plot_simu_q(source))
-	# script_p, div_p = components(plot_simu_p(source))
-	# script_t, div_t = components(plot_simu_t(source))
-	# script_etp, div_etp = components(plot_simu_etp(source))
-	# if mcd.config['kill_snow']:
-	# 	script_st, div_st = components(plot_simu_st_without_snow(source))
-	# else:
-	# 	script_st, div_st = components(plot_simu_st(source))
-	script_perf, div_perf = components(plot_simu_perf(source))
-
-	plots = dict(
-
-		script=dict(
-			# q=script_q,
-			# p=script_p,
-			# t=script_t,
-			# etp=script_etp,
-			# st=script_st,
-			perf=script_perf
-			),
-
-		div=dict(
-			# q=div_q,
-			# p=div_p,
-			# t=div_t,
-			# etp=div_etp,
-			# st=div_st,
-			perf=div_perf
-			)
-		)
-
-	return plots
-
-def plot_all(source):
-	return None
-
-def synthesize_data(simulation_result):
-	data = pd.DataFrame(simulation_result)
-
-	# Range for processing residus
-	_range = len(data)
-
-	''' ---------- Calculate Quantile ---------- '''
-	# Sort the two arrays
-	asc_qsim = np.sort(data['q_sim'])
-
-	def f_q(value, vec):
-		'''
-		Function to calculate the quantile of value in vec
-		
-		Input:
-			value: 	Input value
-			vec:   	Input vector
-		
-		Output:
-			quantile: _count/float(len(vec))
-		'''
-		_count = 0
-		for v in vec:
-			if value >= v: _count+=1
-		return _count/float(len(vec))
+	post = request.POST
+	action = post.get('action')
+	context = {}
+
+	# Use JsonResponse to interact with JQuery
+	if action=='load_file':
+		# Later actions reference the dataset by its id instead of posting it
+		context['data_id'] = datasets.put(post.get('data'))
+		load_data({'data_id': context['data_id']}, mcd)
+		return JsonResponse(context)
+
+	elif action=='upload_csv':
+		# Raw CSV file parsed on the server with the separator and header of the configuration
+		from . import ingest
+
+		config = json.loads(post.get('config') or '{}')
+		try:
+			columns, data_id = ingest.read_csv(request.FILES['file'],
+				separator=config.get('separator', ','), header=int(config.get('header', 0)))
+		except ValueError as e:
+			# Files without rows, time column or complete forcings
+			return JsonResponse({'error': str(e)}, status=400)
+		context['data_id'] = datasets.put_columns(data_id, columns)
+		load_data({'data_id': data_id}, mcd)
+		context['size'] = mcd.n_rows()
+		return JsonResponse(context)
+
+	elif action=='simulate':
+		load_data(post, mcd)
+		mcd.config.update(json.loads(post.get('config')))
+		mcd.par.update(json.loads(post.get('par')))
+		mcd.DEF_ST.update(json.loads(post.get('st')))
+		mcd._simulate_without_calibration()
+		context['par'] = mcd.par
+		if post.get('plots')!='lazy':
+			context['plots'] = plot_simulation(mcd, key)
+		return results(post, context, mcd)
+
+	elif action=='calibrate':
+		load_data(post, mcd)
+		mcd.config.update(json.loads(post.get('config')))
+		mcd.par.update(json.loads(post.get('par')))
+		mcd.calibrate()
+		context['par'] = mcd.par
+		if post.get('plots')!='lazy':
+			context['plots'] = plot_simulation(mcd, key)
+		return results(post, context, mcd)
 	
-	qt_rec = [f_q(q, data['q_rec']) for q in asc_qsim]
-	qt_sim = [i/float(_range) for i in xrange(1, _range+1)]
-	qt_bin = [1 if np.abs(rec-sim)/rec<0.1 else 0 for rec, sim in zip(data['q_rec'],data['q_sim'])]
-
-	''' ---------- Calculate Quantile END ---------- '''
-
-	''' ----- Convert all np.nan values into "NaN" for Javascript -----'''
-
-	source = ColumnDataSource(data=dict(
-		time=pd.to_datetime(data['time']),	# Date
-		# q_rec=data['q_rec'],				# Measured discharge
-		# q_sim=data['q_sim'],				# Simulated discharge
-		diff=(data['q_sim']-data['q_rec']), # Bias of the model, difference between simulated and measured discharge
-		# prec=data['prec'],					# Precipitation
-		# sp=data['sp'],						# Simulated snow pack
-		# diff_temp=data['temp']-data['tm'],	# Difference 
-		# t=data['temp'],						# Air temperature
-		# tm=data['tm'],						# Long-term averaged air temperature
-		# sm=data['sm'],						# Soil moisture
-		# ep=data['ep'],						# Recorded evaporation
-		# wc=data['wc'],						# Water content
-		# uz=data['uz'],						# Upper zone value
-		# lz=data['lz'],						# Lower zone value
-		qt_rec=qt_rec,						# Quantiles for simulated values in recorded values
-		qt_sim=qt_sim,						# Quantiles for simulated values in simulated values
-		qt_bin=qt_bin,						# Binary array for roc curve
-	))
-	return source
+	elif action=='submit_calibration':
+		# Calibrate a copy of the model in the background, see jobs
+		model = new_model()
+		model.DEF_ST = dict(mcd.DEF_ST)
+		model.P_LB, model.P_UB = list(mcd.P_LB), list(mcd.P_UB)
+		load_data(post, model)
+		model.config.update(mcd.config)
+		model.config.update(json.loads(post.get('config')))
+		model.par.update(mcd.par)
+		model.par.update(json.loads(post.get('par')))
+		context['job_id'] = jobs.submit(model, owner=key)
+		return JsonResponse(context)
+
+	elif action in ('job_status', 'job_result', 'cancel_job'):
+		try:
+			if action=='job_status':
+				context.update(jobs.get(post.get('job_id'), key).status())
+			elif action=='cancel_job':
+				context.update(jobs.cancel(post.get('job_id'), key))
+			else:
+				job = jobs.get(post.get('job_id'), key)
+				context.update(job.status())
+				if context['state']!='done':
+					return JsonResponse(context)
+
+				# The calibrated model becomes the model of the session
+				jobs.pop(job.id, key)
+				registry.replace(key, job.model)
+				context['par'] = job.model.par
+				if post.get('plots')!='lazy':
+					context['plots'] = plot_simulation(job.model, key)
+				return results(post, context, job.model)
+		except KeyError:
+			return JsonResponse({'error': 'Unknown job'}, status=404)
+		return JsonResponse(context)
+
+	elif action=='advance':
+		# Append new time steps to the last simulation, without running it again
+		try:
+			rows, inters = mcd.advance(json.loads(post.get('data') or '[]'))
+		except ValueError as e:
+			# No previous simulation, or rows that are not valid JSON
+			return JsonResponse({'error': str(e)}, status=400)
+		context['data'] = json_rows(rows)
+		context['inters'] = json_rows(inters)
+		context['miles'] = mcd.config['miles']
+		return JsonResponse(context)
+
+	elif action=='plot':
+		# Plots built on demand after a run posted with plots=lazy
+		from .plots import PLOTS
+
+		kinds = json.loads(post.get('kinds') or '["perf"]')
+		if not mcd.n_rows() or not set(kinds) <= set(PLOTS):
+			raise Http404('Unknown plot')
+		context['plots'] = plot_simulation(mcd, key, kinds)
+		return JsonResponse(context)
+
+	elif action=='sensitivity':
+		# Sensitivity of the objectives to the parameters, see HBV96.sensitivity;
+		# with select, the influential parameters become the ones to calibrate
+		load_data(post, mcd)
+		mcd.config.update(json.loads(post.get('config')))
+		mcd.par.update(json.loads(post.get('par')))
+		result = mcd.sensitivity(post.get('method', 'sobol'), int(post.get('n', 256)),
+			seed=json.loads(post.get('seed') or 'null'))
+		context.update(method=result['method'], par=result['par'], nfev=result['nfev'])
+		context['indices'] = dict((objective, dict((name, [None if v!=v else v for v in values.tolist()])
+			for name, values in indices.items())) for objective, indices in result['indices'].items())
+		if post.get('select'):
+			context['par_to_calibrate'] = mcd.select_parameters(threshold=float(post.get('select')))
+		return JsonResponse(context)
+
+	elif action=='uncertainty':
+		# GLUE bands of the simulated discharge, see HBV96.glue; quantile bands
+		# keyed by their probability as a string, NaN as null
+		load_data(post, mcd)
+		mcd.config.update(json.loads(post.get('config')))
+		mcd.par.update(json.loads(post.get('par')))
+		result = mcd.glue(int(post.get('n', 10000)), post.get('objective', 'NSE'),
+			float(post.get('threshold', 0.5)),
+			quantiles=json.loads(post.get('quantiles') or '[0.05, 0.5, 0.95]'),
+			seed=json.loads(post.get('seed') or 'null'))
+		context.update(nfev=result['nfev'], n_behavioural=result['n_behavioural'], best=result['best'])
+		context['bands'] = OrderedDict(('{0:g}'.format(name) if name not in ('mean', 'std') else name,
+			[None if v!=v else v for v in band.tolist()]) for name, band in result['bands'].items())
+		return JsonResponse(context)
+
+	elif action=='summarize':
+		context['summary'] = json.dumps(mcd.summary())
+		context['size'] = mcd.n_rows()
+		return JsonResponse(context)
+
+	elif action=='cache_stats':
+		# Hit rate and time saved by the cache of simulation results
+		context.update(simulations.stats())
+		return JsonResponse(context)
+
+	elif action=='save_bounds':
+		mcd.P_LB = json.loads(post.get('P_LB'))
+		mcd.P_UB = json.loads(post.get('P_UB'))
+		return JsonResponse(context)
+	else:
+		return JsonResponse(context)
+
+def plot_simulation(model, key=None, kinds=('perf',)):
+	# Bokeh and pandas are only imported once a plot is requested
+	from . import columnar, plots
+
+	# Series of the last run, without building the rows of the model
+	series = columnar.model_columns(model, ('time', 'q_sim', 'q_rec'))
+	if 'time' in series:
+		series['time'] = series['time'].astype('datetime64[ms]')
+	return plots.plot_simulation(series, key, kinds)